@@ -0,0 +1,189 @@
+"""
+Memory benchmark of the result rows of a continuous run.
+
+Stores nodes x intervals synthetic result rows in the result table and
+compares the memory they take with the previous representation, a dict per
+row appended to an openpyxl worksheet. The previous representation is
+measured on a sample of the rows and extrapolated, as it doesn't fit in
+memory at the default size.
+
+The rows are stored the way a run stores them, interval by interval
+through store_rows. With --checkpoint the run is checkpointed as well,
+and the rows the checkpoint still holds in memory at the end are reported.
+
+    python benchmark_rows.py --nodes 10000 --intervals 1000
+    python benchmark_rows.py --nodes 1000 --intervals 100 --checkpoint
+"""
+
+import argparse
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import openpyxl
+
+from osstats import (
+    RESULT_COLUMNS,
+    COMMAND_CATEGORIES,
+    Checkpoint,
+    ResultRow,
+    ResultTable,
+    RunContext,
+    store_rows,
+)
+
+
+def make_row(node, interval):
+    """Build a result row like the ones process_node returns"""
+    rng = random.Random(node * 7919 + interval)
+    row = ResultRow()
+    row["Source"] = "OSS"
+    row["ClusterId"] = "cluster-{}".format(node // 6)
+    row["NodeId"] = "10-0-{}-{}".format(node // 256, node % 256)
+    row["NodeRole"] = "Master" if node % 2 == 0 else "Replica"
+    row["NodeAddress"] = "10.0.{}.{}:6379".format(node // 256, node % 256)
+    row["RedisVersion"] = "7.2.4"
+    row["OS"] = "Linux 5.15.0-1051-aws x86_64"
+    row["TotalSystemMemory"] = 62.8
+    row["BytesUsedForCache"] = rng.randrange(2**30, 2**34)
+    row["CurrConnections"] = rng.randrange(10, 5000)
+    row["ClusterEnabled"] = 1
+    row["ConnectedSlaves"] = 1 if node % 2 == 0 else ""
+    row["MemoryUsed (Gb)"] = round(rng.uniform(1, 16), 3)
+    row["Throughput (Ops)"] = rng.randrange(0, 200000)
+    for column in COMMAND_CATEGORIES:
+        row[column] = rng.randrange(0, 50000)
+    row["CurrItems"] = rng.randrange(0, 10**8)
+    row["Namespaces"] = "db0:{}".format(row["CurrItems"])
+    row["Connections/sec"] = round(rng.uniform(0, 50), 3)
+    row["RejectedConnections/sec"] = 0.0
+    row["BlockedClients"] = rng.randrange(0, 10)
+    row["MaxClientInputBuffer"] = rng.randrange(0, 65536)
+    row["MaxClientOutputBuffer"] = rng.randrange(0, 65536)
+    row["CpuUsage (%)"] = round(rng.uniform(0, 100), 1)
+    row["Status"] = "ok"
+    return row
+
+
+def measure(store, rows):
+    """Get the bytes allocated by storing the rows"""
+    gc.collect()
+    tracemalloc.start()
+    kept = store(rows)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return allocated
+
+
+def store_table(intervals, checkpoint=None):
+    # Every interval goes through store_rows, as in a run
+    table = ResultTable()
+    context = RunContext(checkpoint=checkpoint)
+    for interval, rows in enumerate(intervals, 1):
+        context.interval = interval
+        store_rows(table, {"cluster": rows}, context)
+        if checkpoint:
+            checkpoint.compact(interval, len(table))
+    return table
+
+
+def store_worksheet(rows):
+    # The previous representation: a dict per row, copied into worksheet cells
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(RESULT_COLUMNS)
+    kept = []
+    for row in rows:
+        result = dict(zip(RESULT_COLUMNS, row))
+        kept.append(result)
+        ws.append([result.get(column, "") for column in RESULT_COLUMNS])
+    return wb, kept
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--intervals", type=int, default=1000)
+    parser.add_argument(
+        "--sample",
+        type=int,
+        default=20000,
+        help="Rows the previous representation is measured on",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="Checkpoint the run, as --checkpoint does",
+    )
+    args = parser.parse_args()
+    total = args.nodes * args.intervals
+
+    # Rows are generated lazily, one interval at a time, so that only the
+    # store is measured
+    def all_intervals():
+        template = [make_row(node, 0) for node in range(args.nodes)]
+        for interval in range(args.intervals):
+            for node, row in enumerate(template):
+                row["Throughput (Ops)"] = (node * 31 + interval * 17) % 200000
+            yield [list(row) for row in template]
+
+    checkpoint = None
+    if args.checkpoint:
+        path = os.path.join(tempfile.mkdtemp(), "rows.checkpoint")
+        checkpoint = Checkpoint(path)
+
+    # Tracing every allocation would slow millions of appends down too much,
+    # the table reports the size of its arrays and strings instead
+    started = time.perf_counter()
+    table = store_table(all_intervals(), checkpoint)
+    table_seconds = time.perf_counter() - started
+    table_bytes = table.nbytes()
+    del table
+
+    if checkpoint:
+        held = sum(
+            len(rows)
+            for sections in checkpoint.sections.values()
+            for rows in sections.values()
+        )
+        checkpoint.close()
+        disk = os.path.getsize(checkpoint.path)
+        os.remove(checkpoint.path)
+
+    sample = [make_row(node % args.nodes, node) for node in range(args.sample)]
+    # Rows/sec isn't reported, tracing the allocations slows the stores down
+    sheet_bytes = measure(store_worksheet, sample)
+
+    print("{} nodes x {} intervals = {} rows".format(args.nodes, args.intervals, total))
+    print(
+        "{:<22} {:>12} {:>14} {:>12}".format(
+            "Representation", "Bytes/row", "Total (MB)", "Rows/sec"
+        )
+    )
+    print(
+        "{:<22} {:>12.1f} {:>14.1f} {:>12.0f}".format(
+            "ResultTable",
+            table_bytes / total,
+            table_bytes / 1024**2,
+            total / table_seconds,
+        )
+    )
+    print(
+        "{:<22} {:>12.1f} {:>14.1f} {:>12}".format(
+            "dict + worksheet (*)",
+            sheet_bytes / args.sample,
+            sheet_bytes / args.sample * total / 1024**2,
+            "-",
+        )
+    )
+    print("(*) measured on {} rows and extrapolated".format(args.sample))
+    if checkpoint:
+        print("Checkpoint: {} rows held in memory, {} bytes on disk".format(held, disk))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,925 @@
 
 import os
 import sys
+import json
+import math
+import contextlib
+import copy
+import time
+import queue
+import socket
+import sqlite3
+import heapq
+import itertools
+import threading
+import multiprocessing
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from array import array
 import argparse
 import configparser
 import redis
 import openpyxl
+
+try:
+    import resource
+except ImportError:
+    resource = None
 import asyncio
 from tqdm.asyncio import trange
 
+# The commands that are counted in each one of the reported categories
+COMMAND_CATEGORIES = {
+    # Get type commands
+    "GetTypeCmds": (
+        "bitcount",
+        "bitfield_ro",
+        "bitpos",
+        "getbit",
+        "geodist",
+        "geohash",
+        "geopos",
+        "georadiusbymember_ro",
+        "georadius_ro",
+        "geosearch",
+        "hexists",
+        "hget",
+        "hgetall",
+        "hkeys",
+        "hlen",
+        "hmget",
+        "hrandfield",
+        "hscan",
+        "hstrlen",
+        "hvals",
+        "pfcount",
+        "dump",
+        "exists",
+        "expiretime",
+        "keys",
+        "pexpiretime",
+        "pttl",
+        "randomkey",
+        "scan",
+        "sort",
+        "sort_ro",
+        "touch",
+        "ttl",
+        "type",
+        "lindex",
+        "llen",
+        "lpos",
+        "lrange",
+        "scard",
+        "sdiff",
+        "sinter",
+        "sintercard",
+        "sismember",
+        "smembers",
+        "smismember",
+        "srandmember",
+        "sscan",
+        "sunion",
+        "zcard",
+        "zcount",
+        "zdiff",
+        "zinter",
+        "zintercard",
+        "zlexcount",
+        "zmscore",
+        "zrandmember",
+        "zrange",
+        "zrangebylex",
+        "zrangebyscore",
+        "zrank",
+        "zrevrange",
+        "zrevrank",
+        "zscan",
+        "zscore",
+        "zunion",
+        "get",
+        "getrange",
+        "lcs",
+        "mget",
+        "strlen",
+        "substr",
+        "xinfo",
+        "xlen",
+        "xpending",
+        "xrange",
+        "xread",
+        "xrevrange",
+    ),
+    # Set type commands
+    "SetTypeCmds": (
+        "bitfield",
+        "bitop",
+        "setbit",
+        "geoadd",
+        "georadius",
+        "georadiusbymember",
+        "geosearchstore",
+        "hdel",
+        "hincrby",
+        "hincrbyfloat",
+        "hmset",
+        "hset",
+        "hsetnx",
+        "pfadd",
+        "pfdebug",
+        "pfmerge",
+        "copy",
+        "del",
+        "expire",
+        "expireat",
+        "migrate",
+        "move",
+        "persist",
+        "pexpire",
+        "pexpireat",
+        "rename",
+        "renamenx",
+        "restore",
+        "sort",
+        "unlink",
+        "blmove",
+        "blmpop",
+        "blpop",
+        "brpop",
+        "brpoplpush",
+        "linsert",
+        "lmove",
+        "lmpop",
+        "lpop",
+        "lpush",
+        "lpushx",
+        "lrem",
+        "lset",
+        "ltrim",
+        "rpop",
+        "rpoplpush",
+        "rpush",
+        "rpushx",
+        "sadd",
+        "sdiffstore",
+        "sinterstore",
+        "smove",
+        "spop",
+        "srem",
+        "sunionstore",
+        "bzmpop",
+        "bzpopmax",
+        "bzpopmin",
+        "zadd",
+        "zdiffstore",
+        "zincrby",
+        "zinterstore",
+        "zmpop",
+        "zpopmax",
+        "zpopmin",
+        "zrangestore",
+        "zrem",
+        "zremrangebylex",
+        "zremrangebyrank",
+        "zremrangebyscore",
+        "zrevrangebylex",
+        "zrevrangebyscore",
+        "zunionstore",
+        "append",
+        "decr",
+        "decrby",
+        "getdel",
+        "getex",
+        "getset",
+        "incr",
+        "incrby",
+        "incrbyfloat",
+        "mset",
+        "msetnx",
+        "psetex",
+        "set",
+        "setex",
+        "setnx",
+        "setrange",
+        "xack",
+        "xadd",
+        "xautoclaim",
+        "xclaim",
+        "xdel",
+        "xgroup",
+        "xreadgroup",
+        "xsetid",
+        "xtrim",
+    ),
+    # Other type commands
+    "OtherTypeCmds": (
+        "asking",
+        "cluster",
+        "readonly",
+        "readwrite",
+        "auth",
+        "client",
+        "echo",
+        "hello",
+        "ping",
+        "quit",
+        "reset",
+        "select",
+        "eval",
+        "evalsha",
+        "evalsha_ro",
+        "eval_ro",
+        "fcall",
+        "fcall_ro",
+        "function",
+        "script",
+        "pfselftest",
+        "object",
+        "wait",
+        "psubscribe",
+        "publish",
+        "pubsub",
+        "punsubscribe",
+        "spublish",
+        "ssubscribe",
+        "subscribe",
+        "sunsubscribe",
+        "unsubscribe",
+        "discard",
+        "exec",
+        "multi",
+        "unwatch",
+        "watch",
+    ),
+    # Bitmaps based commands
+    "BitmapBasedCmds": (
+        "bitcount",
+        "bitfield",
+        "bitfield_ro",
+        "bitop",
+        "bitpos",
+        "getbit",
+        "setbit",
+    ),
+    # Cluster based commands
+    "ClusterBasedCmds": (
+        "asking",
+        "cluster",
+        "readonly",
+        "readwrite",
+    ),
+    # Eval based commands
+    "EvalBasedCmds": (
+        "eval",
+        "evalsha",
+        "evalsha_ro",
+        "eval_ro",
+        "fcall",
+        "fcall_ro",
+        "function",
+        "script",
+    ),
+    # GeoSpatial based commands
+    "GeoSpatialBasedCmds": (
+        "geoadd",
+        "geodist",
+        "geohash",
+        "geopos",
+        "georadius",
+        "georadiusbymember",
+        "georadiusbymember_ro",
+        "georadius_ro",
+        "geosearch",
+        "geosearchstore",
+    ),
+    # Hash based commands
+    "HashBasedCmds": (
+        "hdel",
+        "hexists",
+        "hget",
+        "hgetall",
+        "hincrby",
+        "hincrbyfloat",
+        "hkeys",
+        "hlen",
+        "hmget",
+        "hmset",
+        "hrandfield",
+        "hscan",
+        "hset",
+        "hsetnx",
+        "hstrlen",
+        "hvals",
+    ),
+    # HyperLogLog based commands
+    "HyperLogLogBasedCmds": (
+        "pfadd",
+        "pfcount",
+        "pfdebug",
+        "pfmerge",
+        "pfselftest",
+    ),
+    # Keys based commands
+    "KeyBasedCmds": (
+        "copy",
+        "del",
+        "dump",
+        "exists",
+        "expire",
+        "expireat",
+        "expiretime",
+        "keys",
+        "migrate",
+        "move",
+        "object",
+        "persist",
+        "pexpire",
+        "pexpireat",
+        "pexpiretime",
+        "pttl",
+        "randomkey",
+        "rename",
+        "renamenx",
+        "restore",
+        "scan",
+        "sort",
+        "sort_ro",
+        "touch",
+        "ttl",
+        "type",
+        "unlink",
+        "wait",
+    ),
+    # List based commands
+    "ListBasedCmds": (
+        "blmove",
+        "blmpop",
+        "blpop",
+        "brpop",
+        "brpoplpush",
+        "lindex",
+        "linsert",
+        "llen",
+        "lmove",
+        "lmpop",
+        "lpop",
+        "lpos",
+        "lpush",
+        "lpushx",
+        "lrange",
+        "lrem",
+        "lset",
+        "ltrim",
+        "rpop",
+        "rpoplpush",
+        "rpush",
+        "rpushx",
+    ),
+    # PubSub based commands
+    "PubSubBasedCmds": (
+        "psubscribe",
+        "publish",
+        "pubsub",
+        "punsubscribe",
+        "spublish",
+        "ssubscribe",
+        "subscribe",
+        "sunsubscribe",
+        "unsubscribe",
+    ),
+    # Sets based commands
+    "SetBasedCmds": (
+        "sadd",
+        "scard",
+        "sdiff",
+        "sdiffstore",
+        "sinter",
+        "sintercard",
+        "sinterstore",
+        "sismember",
+        "smembers",
+        "smismember",
+        "smove",
+        "spop",
+        "srandmember",
+        "srem",
+        "sscan",
+        "sunion",
+        "sunionstore",
+    ),
+    # SortedSets based commands
+    "SortedSetBasedCmds": (
+        "bzmpop",
+        "bzpopmax",
+        "bzpopmin",
+        "zadd",
+        "zcard",
+        "zcount",
+        "zdiff",
+        "zdiffstore",
+        "zincrby",
+        "zinter",
+        "zintercard",
+        "zinterstore",
+        "zlexcount",
+        "zmpop",
+        "zmscore",
+        "zpopmax",
+        "zpopmin",
+        "zrandmember",
+        "zrange",
+        "zrangebylex",
+        "zrangebyscore",
+        "zrangestore",
+        "zrank",
+        "zrem",
+        "zremrangebylex",
+        "zremrangebyrank",
+        "zremrangebyscore",
+        "zrevrange",
+        "zrevrangebylex",
+        "zrevrangebyscore",
+        "zrevrank",
+        "zscan",
+        "zscore",
+        "zunion",
+        "zunionstore",
+    ),
+    # String based commands
+    "StringBasedCmds": (
+        "append",
+        "decr",
+        "decrby",
+        "get",
+        "getdel",
+        "getex",
+        "getrange",
+        "getset",
+        "incr",
+        "incrby",
+        "incrbyfloat",
+        "lcs",
+        "mget",
+        "mset",
+        "msetnx",
+        "psetex",
+        "set",
+        "setex",
+        "setnx",
+        "setrange",
+        "strlen",
+        "substr",
+    ),
+    # Stream based commands
+    "StreamBasedCmds": (
+        "xack",
+        "xadd",
+        "xautoclaim",
+        "xclaim",
+        "xdel",
+        "xgroup",
+        "xinfo",
+        "xlen",
+        "xpending",
+        "xrange",
+        "xread",
+        "xreadgroup",
+        "xrevrange",
+        "xsetid",
+        "xtrim",
+    ),
+    # Transaction based commands
+    "TransactionBasedCmds": (
+        "discard",
+        "exec",
+        "multi",
+        "unwatch",
+        "watch",
+    ),
+}
+
+# The ACL categories that back each one of the reported categories when the
+# command table is built from the server itself
+ACL_CATEGORIES = {
+    "BitmapBasedCmds": "@bitmap",
+    "EvalBasedCmds": "@scripting",
+    "GeoSpatialBasedCmds": "@geo",
+    "HashBasedCmds": "@hash",
+    "HyperLogLogBasedCmds": "@hyperloglog",
+    "KeyBasedCmds": "@keyspace",
+    "ListBasedCmds": "@list",
+    "PubSubBasedCmds": "@pubsub",
+    "SetBasedCmds": "@set",
+    "SortedSetBasedCmds": "@sortedset",
+    "StringBasedCmds": "@string",
+    "StreamBasedCmds": "@stream",
+    "TransactionBasedCmds": "@transaction",
+}
+
+# The columns of the result rows, in the order they are written
+RESULT_COLUMNS = (
+    [
+        "Source",
+        "ClusterId",
+        "NodeId",
+        "NodeRole",
+        "RedisVersion",
+        "OS",
+        "TotalSystemMemory",
+        "BytesUsedForCache",
+        "CurrConnections",
+        "ClusterEnabled",
+        "ConnectedSlaves",
+        "MemoryUsed (Gb)",
+        "Throughput (Ops)",
+    ]
+    + list(COMMAND_CATEGORIES)
+    + [
+        "CurrItems",
+        "Namespaces",
+        "Connections/sec",
+        "RejectedConnections/sec",
+        "BlockedClients",
+        "MaxClientInputBuffer",
+        "MaxClientOutputBuffer",
+        "CpuUsage (%)",
+        "PubSubChannels",
+        "PubSubPatterns",
+        "PubSubDeliveries/sec",
+        "PeakOps/sec",
+        "Bursts",
+        "Status",
+        "Error",
+        "NodeAddress",
+    ]
+)
+
+# The position of every column in a result row
+COLUMN_INDEX = {column: index for index, column in enumerate(RESULT_COLUMNS)}
+
+# The result columns holding text and fractional numbers, all the others
+# hold integers
+TEXT_COLUMNS = {
+    "Source",
+    "ClusterId",
+    "NodeId",
+    "NodeRole",
+    "NodeAddress",
+    "RedisVersion",
+    "OS",
+    "Namespaces",
+    "Status",
+    "Error",
+}
+FLOAT_COLUMNS = {
+    "TotalSystemMemory",
+    "MemoryUsed (Gb)",
+    "Connections/sec",
+    "RejectedConnections/sec",
+    "CpuUsage (%)",
+    "PubSubDeliveries/sec",
+}
+
+# Seconds a single redis call may take, and how many times it is retried
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF = 0.5
+
+# The threads the calls bounded by a deadline run in, sized to the nodes
+# sampled together so that no call waits for a thread. Unset, the default
+# executor of the loop is used
+DEADLINE_EXECUTOR = contextvars.ContextVar("DEADLINE_EXECUTOR", default=None)
+
+# The errors a node can fail to be sampled with
+SAMPLING_ERRORS = (redis.RedisError, OSError, asyncio.TimeoutError)
+
+# ACL categories of the commands that are neither reads nor writes but are
+# still reported as OtherTypeCmds
+OTHER_ACL_CATEGORIES = {"@connection", "@scripting", "@pubsub", "@transaction"}
+
+
+class Tracer:
+    """
+    Record how long the phases of a run take, in the Chrome trace event
+    format (also readable by speedscope and Perfetto).
+    When it is disabled span() hands out a shared no-op context manager, so
+    instrumented code pays a single attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.lags = []
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.perf_counter()
+
+    def span(self, name, lane="main", args=None):
+        """
+        Time a block of code
+        Args:
+            name: the name of the phase
+            lane: the trace lane (the node being processed, or main)
+            args: extra details shown with the span
+        """
+        if not self.enabled:
+            return NO_SPAN
+        return self._span(name, lane, args)
+
+    @contextlib.contextmanager
+    def _span(self, name, lane, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, lane, start, time.perf_counter() - start, args))
+
+    async def watch_loop(self, interval=0.05):
+        """Measure how late the event loop wakes up while tasks are running"""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            self.lags.append((now, max(now - start - interval, 0)))
+
+    def summary(self):
+        """
+        Summarise the recorded phases
+        Returns:
+            the summary lines
+        """
+        phases = {}
+        for name, _, _, duration, _ in self.spans:
+            count, total, slowest = phases.get(name, (0, 0, 0))
+            phases[name] = (count + 1, total + duration, max(slowest, duration))
+
+        lines = ["{:<20} {:>7} {:>10} {:>10}".format("Phase", "Count", "Total", "Max")]
+        for name, (count, total, slowest) in sorted(
+            phases.items(), key=lambda item: -item[1][1]
+        ):
+            lines.append(
+                "{:<20} {:>7} {:>9.3f}s {:>9.3f}s".format(name, count, total, slowest)
+            )
+        if self.lags:
+            lags = sorted(lag for _, lag in self.lags)
+            lines.append(
+                "Event loop lag: p99 {:.1f}ms, max {:.1f}ms".format(
+                    percentile(lags, 99) * 1000, lags[-1] * 1000
+                )
+            )
+        if resource:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak = peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+            lines.append("Peak memory: {:.1f}MB".format(peak))
+        return lines
+
+    def drain(self):
+        """
+        Hand the recorded spans and lags over to another process, with
+        their times turned into wall clock times
+        Returns:
+            the spans and the lags, which are cleared
+        """
+        offset = time.time() - time.perf_counter()
+        spans = [
+            (name, lane, start + offset, duration, args)
+            for name, lane, start, duration, args in self.spans
+        ]
+        lags = [(now + offset, lag) for now, lag in self.lags]
+        self.spans, self.lags = [], []
+        return spans, lags
+
+    def merge(self, trace, prefix):
+        """
+        Add the spans and lags drained in another process
+        Args:
+            trace: the spans and lags returned by drain()
+            prefix: prepended to the lanes of the spans, e.g. the worker
+        """
+        spans, lags = trace
+        offset = time.time() - time.perf_counter()
+        self.spans.extend(
+            (name, "{} {}".format(prefix, lane), start - offset, duration, args)
+            for name, lane, start, duration, args in spans
+        )
+        self.lags.extend((now - offset, lag) for now, lag in lags)
+
+    def save(self, path):
+        lanes = {"main": 0}
+        events = []
+        for name, lane, start, duration, args in self.spans:
+            tid = lanes.setdefault(lane, len(lanes))
+            event = {
+                "name": name,
+                "cat": "osstats",
+                "ph": "X",
+                "ts": round((start - self.origin) * 1e6),
+                "dur": round(duration * 1e6),
+                "pid": 1,
+                "tid": tid,
+            }
+            if args:
+                event["args"] = args
+            events.append(event)
+        for now, lag in self.lags:
+            events.append(
+                {
+                    "name": "event loop lag",
+                    "ph": "C",
+                    "ts": round((now - self.origin) * 1e6),
+                    "pid": 1,
+                    "args": {"ms": round(lag * 1000, 3)},
+                }
+            )
+        for lane, tid in lanes.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": lane},
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+NO_SPAN = contextlib.nullcontext()
+TRACER = Tracer()
+
+
+class ResultRow(list):
+    """
+    The result of a node: a list ordered like RESULT_COLUMNS, whose values
+    can also be read and set by column name through COLUMN_INDEX
+    """
+
+    __slots__ = ()
+
+    def __init__(self, values=None):
+        super().__init__([""] * len(RESULT_COLUMNS) if values is None else values)
+
+    @classmethod
+    def of(cls, result):
+        """Get the row of a result, a row or a mapping of column values"""
+        if isinstance(result, list):
+            return cls(result)
+        return cls([result.get(column, "") for column in RESULT_COLUMNS])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = COLUMN_INDEX[key]
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str):
+            key = COLUMN_INDEX[key]
+        super().__setitem__(key, value)
+
+    def get(self, column, default=None):
+        index = COLUMN_INDEX.get(column)
+        return default if index is None else super().__getitem__(index)
+
+    def keys(self):
+        return list(RESULT_COLUMNS)
+
+
+class ResultTable:
+    """
+    Column oriented store of the result rows of a run.
+    Integers are kept in typed arrays that widen as their values grow, and
+    text is dictionary encoded, so a row costs 3 to 4 bytes per column
+    (about 170 bytes, see benchmark_rows.py) instead of the 10 KB or so of a
+    dict and a worksheet row of cell objects. Values that don't match the
+    type of their column are kept aside as they are.
+    """
+
+    # Integer array types from narrowest to widest, and the value marking
+    # an empty cell in each one of them (its lowest value)
+    INT_TYPES = "bhiq"
+    EMPTY = {
+        typecode: -(2 ** (8 * array(typecode).itemsize - 1)) for typecode in "bhiq"
+    }
+
+    def __init__(self):
+        self.kinds = []
+        self.columns = []
+        for column in RESULT_COLUMNS:
+            if column in TEXT_COLUMNS:
+                self.kinds.append("text")
+            elif column in FLOAT_COLUMNS:
+                self.kinds.append("float")
+            else:
+                self.kinds.append("int")
+            self.columns.append(array("d" if column in FLOAT_COLUMNS else "b"))
+        self.strings = [""]
+        self.codes = {"": 0}
+        self.extra = {}
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, row):
+        """
+        Append a result row
+        Args:
+            row: the values of the row, ordered like RESULT_COLUMNS
+        """
+        empty = self.EMPTY
+        for index, (value, kind, column) in enumerate(
+            zip(row, self.kinds, self.columns)
+        ):
+            if kind == "text":
+                if type(value) is not str:
+                    self.extra[(self.length, index)] = value
+                    value = ""
+                code = self.codes.get(value)
+                if code is None:
+                    code = self.codes[value] = len(self.strings)
+                    self.strings.append(value)
+                value = code
+            elif kind == "float":
+                if type(value) is not float and type(value) is not int:
+                    if value != "":
+                        self.extra[(self.length, index)] = value
+                    value = math.nan
+                column.append(value)
+                continue
+            elif type(value) is not int:
+                if value != "":
+                    self.extra[(self.length, index)] = value
+                column.append(empty[column.typecode])
+                continue
+            if empty[column.typecode] < value < -empty[column.typecode]:
+                column.append(value)
+            else:
+                self._widen(index, value)
+        self.length += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def _widen(self, index, value):
+        """Widen a column to the type the value fits in, and append it"""
+        column = self.columns[index]
+        empty = self.EMPTY[column.typecode]
+        typecode = column.typecode
+        while not self.EMPTY[typecode] < value < -self.EMPTY[typecode]:
+            typecode = self.INT_TYPES[self.INT_TYPES.index(typecode) + 1]
+        # Empty cells are moved to the marker of the new type
+        widened = self.EMPTY[typecode]
+        column = self.columns[index] = array(
+            typecode, (widened if item == empty else item for item in column)
+        )
+        column.append(value)
+
+    def row(self, position):
+        """
+        Get a row back
+        Args:
+            position: the position of the row
+        Returns:
+            the values of the row, ordered like RESULT_COLUMNS
+        """
+        values = []
+        for kind, column in zip(self.kinds, self.columns):
+            value = column[position]
+            if kind == "text":
+                value = self.strings[value]
+            elif kind == "float":
+                value = "" if math.isnan(value) else value
+            elif value == self.EMPTY[column.typecode]:
+                value = ""
+            values.append(value)
+        if self.extra:
+            for index in range(len(values)):
+                if (position, index) in self.extra:
+                    values[index] = self.extra[(position, index)]
+        return values
+
+    def rows(self, start=0):
+        for position in range(start, self.length):
+            yield self.row(position)
+
+    def __iter__(self):
+        return self.rows()
+
+    def nbytes(self):
+        """Get the approximate number of bytes the stored values take"""
+        return (
+            sum(column.itemsize * len(column) for column in self.columns)
+            + sum(sys.getsizeof(string) for string in self.strings)
+            + sys.getsizeof(self.strings)
+            + sys.getsizeof(self.codes)
+            + sys.getsizeof(self.extra)
+        )
+
 
 def get_value(value):
     if "," not in value or "=" not in value:
@@ -59,19 +971,6 @@ def parse_response(response):
     return res
 
 
-def create_workbook():
-    """Create an empty workbook with headers
-    Args:
-    Returns:
-    The newely created pandas dataframe
-    """
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "ClusterData"
-
-    return wb
-
-
 def get_command_by_args(cmds1, cmds2, *args):
     count = 0
     for cmd in args:
@@ -92,12 +991,13 @@ def get_redis_client(
     ca_cert=None,
     client_cert=None,
     client_key=None,
+    socket_timeout=DEFAULT_TIMEOUT,
 ):
 
     connection_args = {
         "host": host,
         "port": port,
-        "socket_timeout": 10,
+        "socket_timeout": socket_timeout,
         "decode_responses": True,
     }
 
@@ -120,721 +1020,3271 @@ def get_redis_client(
     return client
 
 
-async def sleep(duration):
-    await asyncio.sleep(duration)
-
-
-async def progress(duration):
-    duration = duration * 60
-    for i in trange(duration):
-        await asyncio.sleep(1)
-
-
-async def process_node(section, config, node, is_master_shard, duration):
+def get_config_client(config, node=None, socket_timeout=DEFAULT_TIMEOUT):
     """
-    Get the current command stats of the passed node
+    Get a client using the connection settings of a config section
     Args:
-        row: a row from the input file
-        node: the node to be processed
-        is_master_shard: is master shard
-        duration: the duration between runs
+        config: the config section
+        node: the ip:port to connect to instead of the configured host
+        socket_timeout: the socket timeout in seconds
     Returns:
-        command stats output
+        the redis client
     """
-    params = node.split(":")
-    print("Processing node {}:{}".format(params[0], params[1]))
+    host, port = config.get("host"), config.get("port", 6379)
+    if node:
+        host, port = node.rsplit(":", 1)
 
-    client = get_redis_client(
-        host=config.get("host"),
-        port=int(config.get("port", 6379)),
+    return get_redis_client(
+        host=host,
+        port=int(port),
         password=config.get("password") or None,
         username=config.get("username") or None,
         tls=config.getboolean("tls", fallback=False),
         ca_cert=config.get("ca_cert", fallback=None) or None,
         client_cert=config.get("client_cert", fallback=None) or None,
         client_key=config.get("client_key", fallback=None) or None,
+        socket_timeout=socket_timeout,
     )
 
-    result = {}
 
-    # first run
-    res1 = parse_response(client.execute_command("info commandstats"))
-    info1 = client.execute_command("info")
-    await sleep(duration * 60)
+async def call_with_deadline(fn, *args, deadline=DEFAULT_TIMEOUT, retries=0):
+    """
+    Run a blocking redis call in a worker thread, bounded by a deadline
+    The deadline starts once the call runs, not while it waits for a thread.
+    Failed attempts are retried with an exponential backoff.
+    Args:
+        fn: the blocking call
+        args: the arguments of the call
+        deadline: the maximum number of seconds a single attempt may take
+        retries: the number of extra attempts
+    Returns:
+        the result of the call
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(retries + 1):
+        running = loop.create_future()
 
-    # second run
-    res2 = parse_response(client.execute_command("info commandstats"))
-    info2 = client.execute_command("info")
+        def run():
+            loop.call_soon_threadsafe(
+                lambda: running.done() or running.set_result(None)
+            )
+            return fn(*args)
 
-    duration_in_seconds = 60 * duration
+        call = loop.run_in_executor(DEADLINE_EXECUTOR.get(), run)
+        try:
+            await asyncio.wait({running, call}, return_when=asyncio.FIRST_COMPLETED)
+            return await asyncio.wait_for(call, deadline)
+        except SAMPLING_ERRORS:
+            if attempt == retries:
+                raise
+            await sleep(RETRY_BACKOFF * 2**attempt)
 
-    result["Source"] = "OSS"
-    result["ClusterId"] = section
-    result["NodeId"] = params[0].replace(".", "-")
-    result["NodeRole"] = "Master" if is_master_shard else "Replica"
-    result["RedisVersion"] = info2["redis_version"]
-    result["OS"] = info2["os"]
-    result["TotalSystemMemory"] = round(info2["total_system_memory"] / 1024**3, 3)
-    result["BytesUsedForCache"] = info2["used_memory_peak"]
-    result["CurrConnections"] = info2["connected_clients"]
-    result["ClusterEnabled"] = info2["cluster_enabled"]
-    result["ConnectedSlaves"] = (
-        info2["connected_slaves"] if "connected_slaves" in info2 else ""
-    )
-    result["MemoryUsed (Gb)"] = round(info2["used_memory_peak"] / 1024**3, 3)
-    result["Throughput (Ops)"] = round(
-        (info2["total_commands_processed"] - info1["total_commands_processed"])
-        / duration_in_seconds
-    )
 
-    # Get type commands
-    result["GetTypeCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "bitcount",
-            "bitfield_ro",
-            "bitpos",
-            "getbit",
-            "geodist",
-            "geohash",
-            "geopos",
-            "georadiusbymember_ro",
-            "georadius_ro",
-            "geosearch",
-            "hexists",
-            "hget",
-            "hgetall",
-            "hkeys",
-            "hlen",
-            "hmget",
-            "hrandfield",
-            "hscan",
-            "hstrlen",
-            "hvals",
-            "pfcount",
-            "dump",
-            "exists",
-            "expiretime",
-            "keys",
-            "pexpiretime",
-            "pttl",
-            "randomkey",
-            "scan",
-            "sort",
-            "sort_ro",
-            "touch",
-            "ttl",
-            "type",
-            "lindex",
-            "llen",
-            "lpos",
-            "lrange",
-            "scard",
-            "sdiff",
-            "sinter",
-            "sintercard",
-            "sismember",
-            "smembers",
-            "smismember",
-            "srandmember",
-            "sscan",
-            "sunion",
-            "zcard",
-            "zcount",
-            "zdiff",
-            "zinter",
-            "zintercard",
-            "zlexcount",
-            "zmscore",
-            "zrandmember",
-            "zrange",
-            "zrangebylex",
-            "zrangebyscore",
-            "zrank",
-            "zrevrange",
-            "zrevrank",
-            "zscan",
-            "zscore",
-            "zunion",
-            "get",
-            "getrange",
-            "lcs",
-            "mget",
-            "strlen",
-            "substr",
-            "xinfo",
-            "xlen",
-            "xpending",
-            "xrange",
-            "xread",
-            "xrevrange",
+async def take_snapshot(client, deadline=DEFAULT_TIMEOUT, retries=0, node="main"):
+    """
+    Take the commandstats and INFO snapshot of a node
+    Returns:
+        the parsed commandstats and the INFO output
+    """
+    with TRACER.span("info commandstats", node):
+        cmds = await call_with_deadline(
+            client.execute_command,
+            "info commandstats",
+            deadline=deadline,
+            retries=retries,
         )
-        / duration_in_seconds
-    )
-
-    # Set type commands
-    result["SetTypeCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "bitfield",
-            "bitop",
-            "setbit",
-            "geoadd",
-            "georadius",
-            "georadiusbymember",
-            "geosearchstore",
-            "hdel",
-            "hincrby",
-            "hincrbyfloat",
-            "hmset",
-            "hset",
-            "hsetnx",
-            "pfadd",
-            "pfdebug",
-            "pfmerge",
-            "copy",
-            "del",
-            "expire",
-            "expireat",
-            "migrate",
-            "move",
-            "persist",
-            "pexpire",
-            "pexpireat",
-            "rename",
-            "renamenx",
-            "restore",
-            "sort",
-            "unlink",
-            "blmove",
-            "blmpop",
-            "blpop",
-            "brpop",
-            "brpoplpush",
-            "linsert",
-            "lmove",
-            "lmpop",
-            "lpop",
-            "lpush",
-            "lpushx",
-            "lrem",
-            "lset",
-            "ltrim",
-            "rpop",
-            "rpoplpush",
-            "rpush",
-            "rpushx",
-            "sadd",
-            "sdiffstore",
-            "sinterstore",
-            "smove",
-            "spop",
-            "srem",
-            "sunionstore",
-            "bzmpop",
-            "bzpopmax",
-            "bzpopmin",
-            "zadd",
-            "zdiffstore",
-            "zincrby",
-            "zinterstore",
-            "zmpop",
-            "zpopmax",
-            "zpopmin",
-            "zrangestore",
-            "zrem",
-            "zremrangebylex",
-            "zremrangebyrank",
-            "zremrangebyscore",
-            "zrevrangebylex",
-            "zrevrangebyscore",
-            "zunionstore",
-            "append",
-            "decr",
-            "decrby",
-            "getdel",
-            "getex",
-            "getset",
-            "incr",
-            "incrby",
-            "incrbyfloat",
-            "mset",
-            "msetnx",
-            "psetex",
-            "set",
-            "setex",
-            "setnx",
-            "setrange",
-            "xack",
-            "xadd",
-            "xautoclaim",
-            "xclaim",
-            "xdel",
-            "xgroup",
-            "xreadgroup",
-            "xsetid",
-            "xtrim",
+    with TRACER.span("info", node):
+        info = await call_with_deadline(
+            client.execute_command, "info", deadline=deadline, retries=retries
         )
-        / duration_in_seconds
-    )
+    with TRACER.span("parse_response", node):
+        cmds = parse_response(cmds)
+    return cmds, info
 
-    # Other type commands
-    result["OtherTypeCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "asking",
-            "cluster",
-            "readonly",
-            "readwrite",
-            "auth",
-            "client",
-            "echo",
-            "hello",
-            "ping",
-            "quit",
-            "reset",
-            "select",
-            "eval",
-            "evalsha",
-            "evalsha_ro",
-            "eval_ro",
-            "fcall",
-            "fcall_ro",
-            "function",
-            "script",
-            "pfselftest",
-            "object",
-            "wait",
-            "psubscribe",
-            "publish",
-            "pubsub",
-            "punsubscribe",
-            "spublish",
-            "ssubscribe",
-            "subscribe",
-            "sunsubscribe",
-            "unsubscribe",
-            "discard",
-            "exec",
-            "multi",
-            "unwatch",
-            "watch",
-        )
-        / duration_in_seconds
-    )
 
-    # Bitmaps based commands
-    result["BitmapBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "bitcount",
-            "bitfield",
-            "bitfield_ro",
-            "bitop",
-            "bitpos",
-            "getbit",
-            "setbit",
-        )
-        / duration_in_seconds
-    )
+async def sleep(duration):
+    await asyncio.sleep(duration)
 
-    # Cluster based commands
-    result["ClusterBasedCmds"] = round(
-        get_command_by_args(res1, res2, "asking", "cluster", "readonly", "readwrite")
-        / duration_in_seconds
-    )
 
-    # Eval based commands
-    result["EvalBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "eval",
-            "evalsha",
-            "evalsha_ro",
-            "eval_ro",
-            "fcall",
-            "fcall_ro",
-            "function",
-            "script",
-        )
-        / duration_in_seconds
-    )
+async def progress(duration):
+    duration = duration * 60
+    for i in trange(duration):
+        await asyncio.sleep(1)
 
-    # GeoSpatial based commands
-    result["GeoSpatialBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "geoadd",
-            "geodist",
-            "geohash",
-            "geopos",
-            "georadius",
-            "georadiusbymember",
-            "georadiusbymember_ro",
-            "georadius_ro",
-            "geosearch",
-            "geosearchstore",
-        )
-        / duration_in_seconds
-    )
 
-    # Hash based commands
-    result["HashBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "hdel",
-            "hexists",
-            "hget",
-            "hgetall",
-            "hincrby",
-            "hincrbyfloat",
-            "hkeys",
-            "hlen",
-            "hmget",
-            "hmset",
-            "hrandfield",
-            "hscan",
-            "hset",
-            "hsetnx",
-            "hstrlen",
-            "hvals",
-        )
-        / duration_in_seconds
-    )
+def index_categories(categories):
+    """
+    Invert a category table into a command -> categories lookup
+    Args:
+        categories: a dict with the commands of each category
+    Returns:
+        a dict with the categories every command is counted in
+    """
+    index = {}
+    for column, commands in categories.items():
+        for command in commands:
+            index.setdefault(command, []).append(column)
+    return index
 
-    # HyperLogLog based commands
-    result["HyperLogLogBasedCmds"] = round(
-        get_command_by_args(
-            res1, res2, "pfadd", "pfcount", "pfdebug", "pfmerge", "pfselftest"
-        )
-        / duration_in_seconds
-    )
 
-    # Keys based commands
-    result["KeyBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "copy",
-            "del",
-            "dump",
-            "exists",
-            "expire",
-            "expireat",
-            "expiretime",
-            "keys",
-            "migrate",
-            "move",
-            "object",
-            "persist",
-            "pexpire",
-            "pexpireat",
-            "pexpiretime",
-            "pttl",
-            "randomkey",
-            "rename",
-            "renamenx",
-            "restore",
-            "scan",
-            "sort",
-            "sort_ro",
-            "touch",
-            "ttl",
-            "type",
-            "unlink",
-            "wait",
-        )
-        / duration_in_seconds
-    )
+def execute_raw(client, *args):
+    """
+    Run a command and return the reply without the redis-py response callbacks
+    Args:
+        client: the redis client
+        args: the command and its arguments
+    Returns:
+        the unparsed reply
+    """
+    pool = client.connection_pool
+    connection = pool.get_connection(args[0])
+    try:
+        connection.send_command(*args)
+        return connection.read_response()
+    finally:
+        pool.release(connection)
 
-    # List based commands
-    result["ListBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "blmove",
-            "blmpop",
-            "blpop",
-            "brpop",
-            "brpoplpush",
-            "lindex",
-            "linsert",
-            "llen",
-            "lmove",
-            "lmpop",
-            "lpop",
-            "lpos",
-            "lpush",
-            "lpushx",
-            "lrange",
-            "lrem",
-            "lset",
-            "ltrim",
-            "rpop",
-            "rpoplpush",
-            "rpush",
-            "rpushx",
-        )
-        / duration_in_seconds
-    )
 
-    # PubSub based commands
-    result["PubSubBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "psubscribe",
-            "publish",
-            "pubsub",
-            "punsubscribe",
-            "spublish",
-            "ssubscribe",
-            "subscribe",
-            "sunsubscribe",
-            "unsubscribe",
-        )
-        / duration_in_seconds
-    )
+def build_command_categories(reply):
+    """
+    Build a category table out of the COMMAND reply of the server
+    Args:
+        reply: the raw reply of the COMMAND command
+    Returns:
+        a table shaped like COMMAND_CATEGORIES, or None when the server
+        doesn't report ACL categories (Redis < 6)
+    """
+    entries = list(reply)
+    for entry in reply:
+        # Redis >= 7 reports the subcommands (e.g. config|get) separately
+        if len(entry) > 9:
+            entries.extend(entry[9])
+    if not entries or any(len(entry) < 7 for entry in entries):
+        return None
 
-    # Sets based commands
-    result["SetBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "sadd",
-            "scard",
-            "sdiff",
-            "sdiffstore",
-            "sinter",
-            "sintercard",
-            "sinterstore",
-            "sismember",
-            "smembers",
-            "smismember",
-            "smove",
-            "spop",
-            "srandmember",
-            "srem",
-            "sscan",
-            "sunion",
-            "sunionstore",
-        )
-        / duration_in_seconds
-    )
+    cluster_commands = COMMAND_CATEGORIES["ClusterBasedCmds"]
+    table = {column: [] for column in COMMAND_CATEGORIES}
+    for entry in entries:
+        name = native_str(entry[0]).lower()
+        flags = {native_str(flag) for flag in entry[2]}
+        acl = {native_str(category) for category in entry[6]}
 
-    # SortedSets based commands
-    result["SortedSetBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "bzmpop",
-            "bzpopmax",
-            "bzpopmin",
-            "zadd",
-            "zcard",
-            "zcount",
-            "zdiff",
-            "zdiffstore",
-            "zincrby",
-            "zinter",
-            "zintercard",
-            "zinterstore",
-            "zlexcount",
-            "zmpop",
-            "zmscore",
-            "zpopmax",
-            "zpopmin",
-            "zrandmember",
-            "zrange",
-            "zrangebylex",
-            "zrangebyscore",
-            "zrangestore",
-            "zrank",
-            "zrem",
-            "zremrangebylex",
-            "zremrangebyrank",
-            "zremrangebyscore",
-            "zrevrange",
-            "zrevrangebylex",
-            "zrevrangebyscore",
-            "zrevrank",
-            "zscan",
-            "zscore",
-            "zunion",
-            "zunionstore",
-        )
-        / duration_in_seconds
-    )
+        is_read = "@read" in acl
+        is_write = "@write" in acl
+        if not is_read and not is_write and ("module" in flags or "." in name):
+            # Module commands don't always declare ACL categories
+            is_read = "readonly" in flags
+            is_write = "write" in flags
 
-    # String based commands
-    result["StringBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "append",
-            "decr",
-            "decrby",
-            "get",
-            "getdel",
-            "getex",
-            "getrange",
-            "getset",
-            "incr",
-            "incrby",
-            "incrbyfloat",
-            "lcs",
-            "mget",
-            "mset",
-            "msetnx",
-            "psetex",
-            "set",
-            "setex",
-            "setnx",
-            "setrange",
-            "strlen",
-            "substr",
-        )
-        / duration_in_seconds
-    )
+        if is_read:
+            table["GetTypeCmds"].append(name)
+        if is_write:
+            table["SetTypeCmds"].append(name)
+        if name.split("|")[0] in cluster_commands:
+            table["ClusterBasedCmds"].append(name)
+            if not is_read and not is_write:
+                table["OtherTypeCmds"].append(name)
+        elif not is_read and not is_write and acl & OTHER_ACL_CATEGORIES:
+            table["OtherTypeCmds"].append(name)
+        for column, category in ACL_CATEGORIES.items():
+            if category in acl:
+                table[column].append(name)
 
-    # Stream based commands
-    result["StreamBasedCmds"] = round(
-        get_command_by_args(
-            res1,
-            res2,
-            "xack",
-            "xadd",
-            "xautoclaim",
-            "xclaim",
-            "xdel",
-            "xgroup",
-            "xinfo",
-            "xlen",
-            "xpending",
-            "xrange",
-            "xread",
-            "xreadgroup",
-            "xrevrange",
-            "xsetid",
-            "xtrim",
+    return {column: tuple(commands) for column, commands in table.items()}
+
+
+def read_command_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_command_cache(cache_file, key, table):
+    cache = read_command_cache(cache_file)
+    cache[key] = table
+    tmp_file = "{}.tmp".format(cache_file)
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print("Unable to write the command cache {}: {}".format(cache_file, e))
+
+
+def get_command_categories(client, info, cache_file=None, memo=None):
+    """
+    Get the category table of a server
+    The table is built from the server's own COMMAND reply and cached, both
+    in memory and on disk, per Redis version and loaded modules.
+    Args:
+        client: the redis client
+        info: the INFO output of the server
+        cache_file: the file the tables are cached in
+        memo: a dict used as in memory cache
+    Returns:
+        a table shaped like COMMAND_CATEGORIES
+    """
+    try:
+        modules = client.execute_command("info", "modules").get("modules", [])
+    except redis.RedisError:
+        modules = []
+    key = "|".join(
+        [str(info.get("redis_version", ""))]
+        + sorted(
+            "{}:{}".format(module.get("name"), module.get("ver")) for module in modules
         )
-        / duration_in_seconds
     )
 
-    # Transaction based commands
-    result["TransactionBasedCmds"] = round(
-        get_command_by_args(res1, res2, "discard", "exec", "multi", "unwatch", "watch")
-        / duration_in_seconds
-    )
+    if memo is not None and key in memo:
+        return memo[key]
 
-    result["CurrItems"] = 0
-    result["Namespaces"] = ""
-    for x in range(16):
-        db = "db{}".format(x)
-        if db in info2:
-            # debug('num of keys %s' % info2[db]['keys'])
-            result["CurrItems"] += info2[db]["keys"]
-            if x > 0:
-                result["Namespaces"] += ", "
-            result["Namespaces"] += f"{db}:{info2[db]['keys']}"
+    table = read_command_cache(cache_file).get(key) if cache_file else None
+    if table is None:
+        try:
+            table = build_command_categories(execute_raw(client, "COMMAND"))
+        except redis.RedisError:
+            table = None
+        if table is not None and cache_file:
+            write_command_cache(cache_file, key, table)
+    if table is None:
+        print("Using the built-in command categories for Redis {}".format(key))
+        table = COMMAND_CATEGORIES
 
-    return result
+    if memo is not None:
+        memo[key] = table
+    return table
 
 
-async def run_tasks(tasks):
-    res = await asyncio.gather(*tasks)
-    return res
+class SlowlogHarvester:
+    """
+    Incrementally collect the SLOWLOG entries of the sampled nodes.
+    The id of the last entry seen is tracked per node so an entry is never
+    fetched twice, and entries are folded into per node aggregates as soon
+    as they arrive instead of being kept around. They are added up per
+    cluster when the rows are built.
+    """
 
+    def __init__(self, poll_interval=30, max_entries=128):
+        self.poll_interval = poll_interval
+        self.max_entries = max_entries
+        self.indexes = {}
+        self.last_ids = {}
+        self.commands = {}
+        self.categories = {}
+        self.missed = {}
 
-def process_database(config, section, workbook, duration, loop):
+    def harvest(self, client, section, node, categories=COMMAND_CATEGORIES):
+        """
+        Fetch the entries logged on a node since the previous harvest
+        Args:
+            client: the redis client of the node
+            section: the cluster the node belongs to
+            node: the node to be processed
+            categories: the category table of the node
+        Returns:
+            the number of new entries
+        """
+        try:
+            entries, last_id, newest_id = self.fetch(client, section, node)
+        except SAMPLING_ERRORS as e:
+            print("Error harvesting the SLOWLOG of node {}: {}".format(node, e))
+            return 0
+        return self.fold(section, node, entries, last_id, newest_id, categories)
 
-    print("\nConnecting to {} database ..".format(section))
+    async def poll(
+        self, client, section, node, categories=COMMAND_CATEGORIES, deadline=None
+    ):
+        """
+        Harvest a node without blocking the event loop, the SLOWLOG calls
+        run in a worker thread and are bounded by a deadline
+        Returns:
+            the number of new entries
+        """
+        try:
+            entries, last_id, newest_id = await call_with_deadline(
+                self.fetch, client, section, node, deadline=deadline or DEFAULT_TIMEOUT
+            )
+        except SAMPLING_ERRORS as e:
+            print("Error harvesting the SLOWLOG of node {}: {}".format(node, e))
+            return 0
+        return self.fold(section, node, entries, last_id, newest_id, categories)
 
-    client = get_redis_client(
-        host=config.get("host"),
-        port=int(config.get("port", 6379)),
-        password=config.get("password") or None,
-        username=config.get("username") or None,
-        tls=config.getboolean("tls", fallback=False),
-        ca_cert=config.get("ca_cert", fallback=None) or None,
-        client_cert=config.get("client_cert", fallback=None) or None,
-        client_key=config.get("client_key", fallback=None) or None,
-    )
+    def fetch(self, client, section, node):
+        """
+        Get the entries logged on a node since the previous harvest
+        The last id seen is only moved on by fold(), so entries fetched by a
+        call that ran past its deadline are fetched again.
+        Returns:
+            the new entries, the id of the last entry seen before them and
+            the id of the newest entry
+        """
+        newest = client.slowlog_get(1)
+        newest_id = newest[0]["id"] if newest else -1
+        last_id = self.last_ids.get((section, node))
 
-    try:
-        client.ping()
-        print("Connected to {} database".format(section))
-    except BaseException:
-        print("Error connecting to {} database".format(section))
-        return workbook
+        # Entries logged before the first harvest are outside of the window
+        if last_id is None:
+            return [], newest_id, newest_id
+        # Ids are restarted only when the server itself is restarted
+        if newest_id < last_id:
+            last_id = -1
 
-    info = client.execute_command("info")
-    if "cluster_enabled" in info and info["cluster_enabled"] == 1:
-        nodes = client.execute_command("cluster nodes")
-    else:
-        nodes = {
-            "%s:%s"
-            % (config["host"], config["port"]): {"flags": "master", "connected": True}
-        }
+        count = newest_id - last_id
+        if count <= 0:
+            return [], last_id, newest_id
+        if count > 1:
+            newest = client.slowlog_get(min(count, self.max_entries))
+        entries = [entry for entry in newest if entry["id"] > last_id]
+        return entries, last_id, newest_id
 
-    ws = workbook.active
+    def fold(self, section, node, entries, last_id, newest_id, categories):
+        """Fold the new entries of a node into its aggregates"""
+        key = (section, node)
+        self.last_ids[key] = newest_id
+        if entries and entries[-1]["id"] > last_id + 1:
+            # The log wrapped before we could read it
+            self.missed[key] = self.missed.get(key, 0) + entries[-1]["id"] - last_id - 1
 
-    # Process Redis nodes in parallel
+        # Keep a reference to the table so that its id can't be reused
+        _, index = self.indexes.setdefault(
+            id(categories), (categories, index_categories(categories))
+        )
+        for entry in entries:
+            command = entry["command"].split(" ", 1)[0].lower()
+            self._add(self.commands, key, command, entry["duration"])
+            for column in index.get(command, ()):
+                self._add(self.categories, key, column, entry["duration"])
 
-    tasks = []
-    for node, stats in nodes.items():
-        is_master_shard = False
-        if stats["flags"].find("master") >= 0:
-            is_master_shard = True
-        if stats["connected"] is True:
-            tasks.append(
-                loop.create_task(
-                    process_node(section, config, node, is_master_shard, duration)
-                )
-            )
-    tasks.append(loop.create_task(progress(duration)))
-    results = loop.run_until_complete(run_tasks(tasks))
+        return len(entries)
 
-    for result in results:
-        node_stats = result
-        if node_stats is not None:
-            if ws.max_row == 1:
-                ws.append(list(node_stats.keys()))
-            ws.append(list(node_stats.values()))
+    async def watch(self, client, section, node, duration, categories, deadline=None):
+        """Keep harvesting a node while its sampling window is open"""
+        elapsed = 0
+        while elapsed + self.poll_interval < duration:
+            await sleep(self.poll_interval)
+            elapsed += self.poll_interval
+            await self.poll(client, section, node, categories, deadline)
 
-    # End
+    @staticmethod
+    def _add(stats, key, name, duration):
+        entry = stats.setdefault(key, {}).setdefault(name, [0, 0, 0])
+        entry[0] += 1
+        entry[1] += duration
+        entry[2] = max(entry[2], duration)
 
-    return workbook
+    def rows(self, references=None):
+        """
+        Summarise the slowest commands and categories of every cluster
+        Args:
+            references: the sections referencing the shared nodes, keyed by
+                the (section, node) they were sampled as
+        Returns:
+            one dict per command and per category, slowest first
+        """
+        commands, categories, missed = {}, {}, {}
+        for key, node_commands in self.commands.items():
+            for section in sections_of(key, references):
+                for totals, stats in (
+                    (commands, node_commands),
+                    (categories, self.categories.get(key, {})),
+                ):
+                    for name, (count, total, slowest) in stats.items():
+                        entry = totals.setdefault(section, {}).setdefault(
+                            name, [0, 0, 0]
+                        )
+                        entry[0] += count
+                        entry[1] += total
+                        entry[2] = max(entry[2], slowest)
+                missed[section] = missed.get(section, 0) + self.missed.get(key, 0)
 
+        for section, section_commands in commands.items():
+            groups = (
+                ("Command", section_commands),
+                ("Category", categories.get(section, {})),
+            )
+            for kind, stats in groups:
+                ordered = sorted(stats.items(), key=lambda item: -item[1][2])
+                for name, (count, total, slowest) in ordered:
+                    yield {
+                        "ClusterId": section,
+                        "Type": kind,
+                        "Name": name,
+                        "Count": count,
+                        "TotalDuration (us)": total,
+                        "AvgDuration (us)": round(total / count),
+                        "MaxDuration (us)": slowest,
+                        "MissedEntries": missed[section],
+                    }
 
-def print_results(wb):
-    sheet = wb.active
-    print("\n--------------------")
-    for row_num in range(2, sheet.max_row + 1):
-        for col_idx, col in enumerate(sheet.iter_cols(min_row=1, max_row=1)):
-            header_value = col[0].value
-            cell_value = sheet.cell(row=row_num, column=col_idx + 1).value
-            print(f"{header_value}: {cell_value}")
-        print("--------------------\n")
 
+def percentile(values, q):
+    """
+    Get the q-th percentile of a sorted list using the nearest rank method
+    """
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
 
-def main():
-    if not sys.version_info >= (3, 9):
-        print("Please upgrade python to a version at least 3.9")
-        sys.exit(1)
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-c",
-        "--config",
-        dest="configFile",
+def discount_commands(cmds, info, issued):
+    """
+    Remove the commands osstats itself sent during the window from the second
+    snapshot so they don't show up in the deltas
+    Args:
+        cmds: the parsed commandstats of the second snapshot
+        info: the INFO output of the second snapshot
+        issued: the number of calls osstats made per command
+    """
+    for command, calls in issued.items():
+        # Subcommands are reported on their own by Redis 7 only
+        stats = cmds.get("cmdstat_%s" % command) or cmds.get(
+            "cmdstat_%s" % command.split("|")[0]
+        )
+        if isinstance(stats, dict) and "calls" in stats:
+            stats["calls"] -= calls
+        if "total_commands_processed" in info:
+            info["total_commands_processed"] -= calls
+
+
+class LatencyProbe:
+    """
+    Measure the round trip time and the pipelining throughput of the nodes
+    from the collector's side of the network.
+    A few short bursts of PING are spread over the sampling window, so the
+    load each node gets from the probe is small and bounded.
+    """
+
+    def __init__(self, pings=20, pipeline=50, bursts=5):
+        self.pings = pings
+        self.pipeline = pipeline
+        self.bursts = bursts
+        self.results = []
+
+    def burst(self, client):
+        """
+        Run a single burst against a node
+        Returns:
+            the round trip times in seconds and the pipelined commands/sec
+        """
+        rtts = []
+        for _ in range(self.pings):
+            start = time.perf_counter()
+            client.ping()
+            rtts.append(time.perf_counter() - start)
+
+        pipe = client.pipeline(transaction=False)
+        for _ in range(self.pipeline):
+            pipe.ping()
+        start = time.perf_counter()
+        pipe.execute()
+        elapsed = time.perf_counter() - start
+        return rtts, self.pipeline / elapsed if elapsed > 0 else 0
+
+    async def watch(self, client, section, node, duration):
+        """
+        Probe a node while its sampling window is open
+        Returns:
+            the number of PING calls sent to the node
+        """
+        rtts = []
+        throughput = []
+        issued = 0
+        spacing = duration / (self.bursts + 1)
+        for _ in range(self.bursts):
+            await sleep(spacing)
+            try:
+                burst_rtts, ops = await asyncio.to_thread(self.burst, client)
+            except SAMPLING_ERRORS as e:
+                print("Error probing node {}: {}".format(node, e))
+                continue
+            rtts.extend(burst_rtts)
+            throughput.append(ops)
+            issued += len(burst_rtts) + self.pipeline
+
+        rtts = sorted(rtt * 1000 for rtt in rtts)
+        self.results.append(
+            (
+                (section, node),
+                {
+                    "ClusterId": section,
+                    "NodeId": node_id(node),
+                    "Samples": len(rtts),
+                    "RttP50 (ms)": round(percentile(rtts, 50), 3) if rtts else "",
+                    "RttP99 (ms)": round(percentile(rtts, 99), 3) if rtts else "",
+                    "RttMax (ms)": round(rtts[-1], 3) if rtts else "",
+                    "PipelineBatch": self.pipeline,
+                    "PipelineOps": round(max(throughput)) if throughput else "",
+                },
+            )
+        )
+        return issued
+
+    def rows(self, references=None):
+        for key, row in self.results:
+            yield from fan_out(key, row, references)
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters sketch: counts the most frequent items of a
+    stream in a fixed number of counters. An item that finds all of them
+    taken replaces the smallest one and inherits its count, which is kept
+    as the item's maximum overestimate.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counters = {}
+
+    def add(self, item, weight=1):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [weight, 0]
+        else:
+            smallest = min(self.counters, key=lambda key: self.counters[key][0])
+            count = self.counters.pop(smallest)[0]
+            self.counters[item] = [count + weight, count]
+
+    def top(self):
+        """Get the (item, count, overestimate) of the counters, largest first"""
+        return sorted(
+            ((item, count, error) for item, (count, error) in self.counters.items()),
+            key=lambda counter: -counter[1],
+        )
+
+
+class KeyspaceTable:
+    """
+    Per database breakdown of the keyspace of every node: keys, keys with an
+    expire and their average TTL, with their change over the window.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def add(self, section, node, info1, info2):
+        """
+        Add the databases of a node
+        Args:
+            section: the cluster the node belongs to
+            node: the node the snapshots were taken from
+            info1: the INFO output of the first snapshot
+            info2: the INFO output of the second snapshot
+        """
+        dbs = {key for key in list(info1) + list(info2) if is_db_key(key)}
+        for db in sorted(dbs, key=lambda key: int(key[2:])):
+            before = info1.get(db, {})
+            after = info2.get(db, {})
+            row = {
+                "ClusterId": section,
+                "NodeId": node_id(node),
+                "Db": int(db[2:]),
+                "Keys": after.get("keys", 0),
+                "KeysChange": after.get("keys", 0) - before.get("keys", 0),
+                "Expires": after.get("expires", 0),
+                "ExpiresChange": after.get("expires", 0) - before.get("expires", 0),
+                "AvgTtl (s)": round(after.get("avg_ttl", 0) / 1000, 3),
+                "AvgTtlChange (s)": round(
+                    (after.get("avg_ttl", 0) - before.get("avg_ttl", 0)) / 1000, 3
+                ),
+            }
+            self.results.append(((section, node), row))
+
+    def rows(self, references=None):
+        for key, row in self.results:
+            yield from fan_out(key, row, references)
+
+
+def is_db_key(key):
+    """Tell whether an INFO field is the keyspace line of a database"""
+    return key.startswith("db") and key[2:].isdigit()
+
+
+class KeyPrefixSampler:
+    """
+    Histogram of the key prefixes of every node, built out of SCAN.
+    Each window scans a little more of the keyspace, where the previous one
+    stopped, until the sampled share of every database is covered. The
+    calls are spread over the window and bounded by a budget of keys per
+    window, and the prefixes are counted in a Space-Saving sketch so memory
+    stays bounded however many distinct prefixes there are.
+    """
+
+    def __init__(
+        self, sample=0.01, budget=10000, count=100, capacity=100, separator=":"
+    ):
+        self.sample = sample
+        self.budget = budget
+        self.count = count
+        self.capacity = capacity
+        self.separator = separator
+        self.scans = {}
+
+    def scan(self, client, db, cursor):
+        """
+        Run a single SCAN call on a database of a node
+        Returns:
+            the next cursor and the keys
+        """
+        pool = client.connection_pool
+        connection = pool.get_connection("SCAN")
+        try:
+            if db:
+                connection.send_command("SELECT", db)
+                connection.read_response()
+            connection.send_command("SCAN", cursor, "COUNT", self.count)
+            cursor, keys = connection.read_response()
+            if db:
+                connection.send_command("SELECT", 0)
+                connection.read_response()
+        except BaseException:
+            # The connection may be left on another database
+            connection.disconnect()
+            raise
+        finally:
+            pool.release(connection)
+        return int(cursor), keys
+
+    def prefix(self, key):
+        if isinstance(key, bytes):
+            key = key.decode(errors="replace")
+        head, separator, _ = key.partition(self.separator)
+        return head + separator if separator else "(none)"
+
+    async def watch(self, client, section, node, duration, info):
+        """
+        Scan the databases of a node while its sampling window is open
+        Args:
+            client: the redis client
+            section: the cluster the node belongs to
+            node: the node to scan
+            duration: the seconds the window stays open
+            info: the INFO output of the first snapshot
+        Returns:
+            the number of calls sent to the node per command
+        """
+        todo = []
+        dbs = sorted(int(key[2:]) for key in info if is_db_key(key))
+        for db in dbs:
+            key = "db{}".format(db)
+            if not info[key].get("keys"):
+                continue
+            state = self.scans.setdefault(
+                (section, node, db),
+                {
+                    "cursor": 0,
+                    "scanned": 0,
+                    "done": False,
+                    "sketch": SpaceSaving(self.capacity),
+                },
+            )
+            state["keys"] = info[key]["keys"]
+            target = math.ceil(self.sample * state["keys"])
+            if not state["done"] and state["scanned"] < target:
+                todo.append((db, state, target))
+
+        calls = sum(
+            math.ceil(min(target - state["scanned"], self.budget) / self.count)
+            for _, state, target in todo
+        )
+        calls = min(calls, math.ceil(self.budget / self.count))
+        issued = {"scan": 0, "select": 0}
+        spacing = duration / (calls + 1)
+        scanned = 0
+        for db, state, target in todo:
+            while state["scanned"] < target and scanned < self.budget:
+                await sleep(spacing)
+                try:
+                    cursor, keys = await asyncio.to_thread(
+                        self.scan, client, db, state["cursor"]
+                    )
+                except SAMPLING_ERRORS as e:
+                    print("Error scanning node {}: {}".format(node, e))
+                    return issued
+                issued["scan"] += 1
+                issued["select"] += 2 if db else 0
+                for key in keys:
+                    state["sketch"].add(self.prefix(key))
+                state["scanned"] += len(keys)
+                scanned += len(keys)
+                state["cursor"] = cursor
+                if cursor == 0:
+                    # The whole database has been scanned
+                    state["done"] = True
+                    break
+        return issued
+
+    def rows(self, references=None):
+        for (section, node, db), state in self.scans.items():
+            scanned = state["scanned"]
+            if not scanned:
+                continue
+            scale = 1 if state["done"] else max(state["keys"] / scanned, 1)
+            for prefix, count, error in state["sketch"].top():
+                row = {
+                    "ClusterId": section,
+                    "NodeId": node_id(node),
+                    "Db": db,
+                    "Prefix": prefix,
+                    "SampledKeys": count,
+                    "EstimatedKeys": round(count * scale),
+                    "Share (%)": round(100 * count / scanned, 2),
+                    "MaxOverestimate": error,
+                    "ScannedKeys": scanned,
+                }
+                yield from fan_out((section, node), row, references)
+
+
+class BacklogCollector:
+    """
+    Fan-out of Pub/Sub channels and backlog of stream consumer groups.
+    The subscribers of the channels of every node (at most max_channels of
+    them, matching pattern) are counted with PUBSUB NUMSUB, and streams found by a SCAN walk (resumed across intervals like
+    the key prefix one) are inspected with XINFO GROUPS. Calls are sent in
+    pipelined batches, paced to at most rate commands per second.
+    """
+
+    def __init__(
+        self,
+        top=20,
+        batch=100,
+        rate=1000,
+        max_channels=10000,
+        max_streams=1000,
+        scan_budget=10000,
+        pattern=None,
+    ):
+        self.top = top
+        self.batch = batch
+        self.rate = rate
+        self.max_channels = max_channels
+        self.pattern = pattern
+        self.max_streams = max_streams
+        self.scan_budget = scan_budget
+        self.streams = {}
+        self.fanout = {}
+        self.channels = {}
+        self.groups = {}
+
+    # The commandstats names of the pipelined calls
+    COMMANDS = {"pubsub_numsub": "pubsub|numsub", "xinfo_groups": "xinfo|groups"}
+
+    async def paced(self, client, commands, issued):
+        """
+        Run commands in pipelined batches
+        Args:
+            client: the redis client
+            commands: (command, args) tuples
+            issued: the calls sent per command, updated
+        Returns:
+            the replies, in order
+        """
+
+        def execute(batch):
+            pipe = client.pipeline(transaction=False)
+            for command, args in batch:
+                getattr(pipe, command)(*args)
+            return pipe.execute(raise_on_error=False)
+
+        replies = []
+        for start in range(0, len(commands), self.batch):
+            batch = commands[start : start + self.batch]
+            replies.extend(await asyncio.to_thread(execute, batch))
+            for command, _ in batch:
+                name = self.COMMANDS[command]
+                issued[name] = issued.get(name, 0) + 1
+            await sleep(len(batch) / self.rate)
+        return replies
+
+    async def watch(self, client, section, node):
+        """
+        Collect the fan-out and backlog of a node
+        Returns:
+            the number of calls sent to the node per command
+        """
+        issued = {}
+        try:
+            await self.collect(client, (section, node), issued)
+        except SAMPLING_ERRORS as e:
+            print("Error collecting the backlog of node {}: {}".format(node, e))
+        return issued
+
+    async def collect(self, client, key, issued):
+        """Collect the channels and stream groups of the node behind key"""
+
+        # Channels, with their number of subscribers on this node. Only the
+        # first max_channels are read off the reply
+        channels = await asyncio.to_thread(
+            lambda: list(
+                itertools.islice(
+                    stream_pubsub_channels(client, self.pattern), self.max_channels
+                )
+            )
+        )
+        issued["pubsub|channels"] = 1
+        counts = []
+        replies = await self.paced(
+            client,
+            [
+                ("pubsub_numsub", channels[start : start + self.batch])
+                for start in range(0, len(channels), self.batch)
+            ],
+            issued,
+        )
+        for reply in replies:
+            if not isinstance(reply, Exception):
+                counts.extend(reply)
+        subscribers = sum(count for _, count in counts)
+        self.fanout[key] = subscribers / len(counts) if counts else 0
+        self.channels[key] = heapq.nlargest(
+            self.top, counts, key=lambda channel: channel[1]
+        )
+
+        # Streams, found a little at a time
+        state = self.streams.setdefault(key, {"cursor": 0, "names": [], "done": False})
+        scanned = 0
+        while not state["done"] and scanned < self.scan_budget:
+            try:
+                cursor, names = await asyncio.to_thread(
+                    client.scan, state["cursor"], None, self.batch, "stream"
+                )
+            except redis.ResponseError:
+                # SCAN TYPE needs Redis 6
+                state["done"] = True
+                break
+            issued["scan"] = issued.get("scan", 0) + 1
+            scanned += self.batch
+            for name in names:
+                if len(state["names"]) < self.max_streams:
+                    state["names"].append(name)
+            state["cursor"] = cursor
+            state["done"] = cursor == 0
+            await sleep(1 / self.rate)
+
+        replies = await self.paced(
+            client, [("xinfo_groups", (name,)) for name in state["names"]], issued
+        )
+        groups = []
+        for name, reply in zip(state["names"], replies):
+            if isinstance(reply, Exception):
+                continue
+            for group in reply:
+                groups.append(
+                    (
+                        name,
+                        group.get("name"),
+                        group.get("consumers", 0),
+                        group.get("pending", 0),
+                        group.get("lag"),
+                    )
+                )
+        self.groups[key] = groups
+
+    def deliveries(self, section, node, publishes):
+        """Estimate the messages delivered per second out of the publish rate"""
+        return round(publishes * self.fanout.get((section, node), 0), 1)
+
+    def channel_rows(self, references=None):
+        for (section, node), channels in self.channels.items():
+            for channel, subscribers in channels:
+                row = {
+                    "ClusterId": section,
+                    "NodeId": node_id(node),
+                    "Channel": channel,
+                    "Subscribers": subscribers,
+                }
+                yield from fan_out((section, node), row, references)
+
+    def stream_rows(self, references=None):
+        for (section, node), groups in self.groups.items():
+            for stream, group, consumers, pending, lag in groups:
+                row = {
+                    "ClusterId": section,
+                    "NodeId": node_id(node),
+                    "Stream": stream,
+                    "Group": group,
+                    "Consumers": consumers,
+                    "Pending": pending,
+                    # Lag is reported by Redis 7 and later
+                    "Lag": "" if lag is None else lag,
+                }
+                yield from fan_out((section, node), row, references)
+
+
+def sum_rates(series):
+    """
+    Add up the command rates of several nodes
+    Args:
+        series: one list of (start, end, rate, peak) readings per node, the
+            rate being constant between start and end
+    Returns:
+        the (start, end, rate, peak) readings of the sum, over the spans
+        covered by at least one node
+    """
+    events = sorted(
+        (at, sign, rate, peak)
+        for readings in series
+        for start, end, rate, peak in readings
+        for at, sign in ((start, 1), (end, -1))
+    )
+    rate = peak = covered = 0
+    previous = None
+    for at, sign, reading_rate, reading_peak in events:
+        if covered and at > previous:
+            yield previous, at, max(rate, 0), max(peak, 0)
+        covered += sign
+        rate += sign * reading_rate
+        peak += sign * reading_peak
+        previous = at
+
+
+class BurstTracker:
+    """
+    Detect bursts in a series of rates as it comes in.
+    The baseline is the median of the last readings that weren't part of a
+    burst, and a reading above factor times the baseline opens a burst. A
+    burst that is still open after window readings is a new level of
+    traffic rather than a burst: it is closed and its readings become the
+    baseline. Only the last max_bursts bursts are kept.
+    """
+
+    # Readings needed before the baseline is trusted
+    WARMUP = 3
+
+    def __init__(self, factor=3, window=30, min_ops=100, max_bursts=100):
+        self.factor = factor
+        self.window = window
+        self.min_ops = min_ops
+        self.max_bursts = max_bursts
+        self.baseline = []
+        self.current = None
+        self.rates = []
+        self.bursts = []
+
+    def level(self):
+        """Get the baseline rate, None until enough readings were seen"""
+        if len(self.baseline) < self.WARMUP:
+            return None
+        return percentile(sorted(self.baseline), 50)
+
+    def rising(self, rate):
+        """Tell whether a rate is halfway to a burst or more"""
+        level = self.level()
+        return level is not None and rate > level * (1 + self.factor) / 2
+
+    def add(self, start, end, rate, peak=0):
+        """
+        Add the rate measured between start and end
+        Args:
+            peak: the highest rate seen within the reading, if it is known
+        Returns:
+            whether a burst is open
+        """
+        level = self.level()
+        if level is not None and rate > max(self.factor * level, self.min_ops):
+            if self.current is None:
+                self.current = {"start": start, "peak": 0, "baseline": level}
+                self.rates = []
+            self.current["end"] = end
+            self.current["peak"] = max(self.current["peak"], rate, peak)
+            self.rates.append(rate)
+            if len(self.rates) < self.window:
+                return True
+            # The traffic stepped up, the baseline follows
+            self.close()
+            self.baseline = self.rates
+            return False
+
+        self.close()
+        self.baseline.append(rate)
+        del self.baseline[: -self.window]
+        return False
+
+    def close(self):
+        """Close the open burst, if any"""
+        if self.current is not None:
+            self.bursts.append(self.current)
+            del self.bursts[: -self.max_bursts]
+            self.current = None
+
+    def all(self):
+        """Get the bursts, the one still open included"""
+        if self.current is not None:
+            return self.bursts + [self.current]
+        return self.bursts
+
+
+class ClusterRates:
+    """
+    Add up the rates of the nodes of a cluster as their readings come in,
+    and feed the sum to a BurstTracker.
+    A reading is held until every node has reported past its end, the held
+    readings are then swept into the sum (see sum_rates) and dropped. A node
+    that falls more than history readings behind another one isn't waited
+    for anymore, so what is held stays bounded.
+    """
+
+    def __init__(self, tracker, history=1000):
+        self.tracker = tracker
+        self.window = tracker.window
+        self.history = history
+        self.pending = {}
+        self.ends = {}
+        self.swept = None
+
+    def join(self, node, at):
+        """Wait for the readings of a node from the time it is first polled"""
+        self.pending.setdefault(node, [])
+        self.ends.setdefault(node, at)
+        # Every node adds its readings, the baseline covers the same time
+        self.tracker.window = self.window * len(self.pending)
+
+    def add(self, node, start, end, rate, peak):
+        """Add the rate of a node measured between start and end"""
+        if self.swept is not None:
+            start = max(start, self.swept)
+        if end <= start:
+            return
+        readings = self.pending[node]
+        readings.append((start, end, rate, peak))
+        self.ends[node] = end
+        if len(readings) > self.history:
+            oldest = readings[0][1]
+            for other in [other for other, at in self.ends.items() if at < oldest]:
+                del self.ends[other]
+
+        watermark = min(self.ends.values())
+        swept = []
+        for readings in self.pending.values():
+            taken = []
+            while readings and readings[0][0] < watermark:
+                start, end, rate, peak = readings[0]
+                if end > watermark:
+                    # Split at the watermark, the rest is swept later
+                    readings[0] = (watermark, end, rate, peak)
+                    end = watermark
+                else:
+                    readings.pop(0)
+                taken.append((start, end, rate, peak))
+            swept.append(taken)
+        for reading in sum_rates(swept):
+            self.tracker.add(*reading)
+        self.swept = max(self.swept or watermark, watermark)
+
+    def all(self):
+        """Get the bursts of the sum, the readings still held included"""
+        tracker = copy.deepcopy(self.tracker)
+        for reading in sum_rates(self.pending.values()):
+            tracker.add(*reading)
+        return tracker.all()
+
+
+class BurstDetector:
+    """
+    Find the bursts of traffic of every node and cluster within the sampling
+    windows. INFO stats is polled while the window is open, every slow
+    seconds while traffic is steady and every fast seconds once the rate is
+    halfway to a burst, and the rate between two readings is fed to a
+    BurstTracker. The readings of the nodes of a cluster are added up as they
+    come in to find the bursts of the whole cluster.
+    """
+
+    def __init__(
+        self,
+        factor=3,
+        fast=1,
+        slow=10,
+        window=30,
+        min_ops=100,
+        history=1000,
+        max_bursts=100,
+    ):
+        self.factor = factor
+        self.fast = fast
+        self.slow = slow
+        self.window = window
+        self.min_ops = min_ops
+        self.history = history
+        self.max_bursts = max_bursts
+        self.trackers = {}
+        self.clusters = {}
+        self.last = {}
+        self.windows = {}
+
+    def tracker(self):
+        return BurstTracker(self.factor, self.window, self.min_ops, self.max_bursts)
+
+    async def watch(self, client, section, node, duration, clusters=None):
+        """
+        Poll a node while its sampling window is open
+        Args:
+            clusters: the clusters the node is part of, its section by default
+        Returns:
+            the number of calls sent to the node per command
+        """
+        key = (section, node)
+        tracker = self.trackers.setdefault(key, self.tracker())
+        sums = [
+            self.clusters.setdefault(
+                cluster, ClusterRates(self.tracker(), self.history)
+            )
+            for cluster in clusters or [section]
+        ]
+        for rates in sums:
+            rates.join(key, time.time())
+        polls = bursts = elapsed = 0
+        peak = None
+        active = False
+        while True:
+            try:
+                stats = await asyncio.to_thread(client.info, "stats")
+            except SAMPLING_ERRORS as e:
+                print("Error polling the stats of node {}: {}".format(node, e))
+                break
+            now = time.time()
+            polls += 1
+            total = stats["total_commands_processed"]
+            instant = stats.get("instantaneous_ops_per_sec", 0)
+
+            # The previous reading may come from the previous interval
+            previous = self.last.get(key)
+            self.last[key] = (now, total)
+            rising = False
+            if previous and now > previous[0] and total >= previous[1]:
+                rate = (total - previous[1]) / (now - previous[0])
+                for rates in sums:
+                    rates.add(key, previous[0], now, rate, max(rate, instant))
+                opened = tracker.add(previous[0], now, rate, instant)
+                if opened and not active:
+                    bursts += 1
+                active = opened
+                rising = tracker.rising(max(rate, instant))
+                peak = max(peak or 0, rate, instant)
+
+            if elapsed >= duration:
+                break
+            interval = self.fast if active or rising else self.slow
+            interval = min(interval, duration - elapsed)
+            await sleep(interval)
+            elapsed += interval
+
+        self.windows[key] = (peak, bursts)
+        return {"info": polls}
+
+    def summary(self, section, node):
+        """
+        Get the peak rate and the number of bursts of the last window of a node
+        """
+        peak, bursts = self.windows.get((section, node), (None, 0))
+        return ("" if peak is None else round(peak)), bursts
+
+    def rows(self, references=None):
+        for (section, node), tracker in self.trackers.items():
+            for cluster in sections_of((section, node), references):
+                for burst in tracker.all():
+                    yield self.row(cluster, "Node", node_id(node), burst)
+
+        for section, rates in self.clusters.items():
+            for burst in rates.all():
+                yield self.row(section, "Cluster", "", burst)
+
+    @staticmethod
+    def row(section, scope, node, burst):
+        baseline = burst["baseline"]
+        return {
+            "ClusterId": section,
+            "Scope": scope,
+            "NodeId": node,
+            "Start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(burst["start"])),
+            "Duration (s)": round(burst["end"] - burst["start"], 1),
+            "PeakOps": round(burst["peak"]),
+            "BaselineOps": round(baseline),
+            "Multiple": round(burst["peak"] / baseline, 1) if baseline else "",
+        }
+
+
+class CommandRateTable:
+    """
+    Long format table with the rates of every single command of every node.
+    Only the commands that moved during the window are kept, and command
+    names are stored once and referenced by their index, so large fleets
+    don't end up with a mostly empty node x command matrix.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.entries = []
+
+    def add(self, section, node, cmds1, cmds2, duration):
+        """
+        Add the commands of a node that changed between two snapshots
+        Args:
+            section: the cluster the node belongs to
+            node: the node the snapshots were taken from
+            cmds1: the parsed commandstats of the first snapshot
+            cmds2: the parsed commandstats of the second snapshot
+            duration: the seconds between the two snapshots
+        """
+        for key, stats in cmds2.items():
+            if not key.startswith("cmdstat_") or not isinstance(stats, dict):
+                continue
+            before = cmds1.get(key, {})
+            calls, usec, rejected, failed = (
+                stats.get(field, 0) - before.get(field, 0)
+                for field in ("calls", "usec", "rejected_calls", "failed_calls")
+            )
+            if calls <= 0 and rejected <= 0 and failed <= 0:
+                continue
+
+            command = key[len("cmdstat_") :]
+            command_id = self.ids.get(command)
+            if command_id is None:
+                command_id = self.ids[command] = len(self.names)
+                self.names.append(command)
+            self.entries.append(
+                (
+                    section,
+                    node,
+                    command_id,
+                    calls / duration,
+                    usec / calls if calls > 0 else 0,
+                    rejected / duration,
+                    failed / duration,
+                )
+            )
+
+    def rows(self, references=None):
+        for section, node, command_id, calls, usec, rejected, failed in self.entries:
+            row = {
+                "ClusterId": section,
+                "NodeId": node_id(node),
+                "Command": self.names[command_id],
+                "Calls/sec": round(calls, 3),
+                "Usec/call": round(usec, 3),
+                "Rejected/sec": round(rejected, 3),
+                "Failed/sec": round(failed, 3),
+            }
+            yield from fan_out((section, node), row, references)
+
+
+def stream_client_list(client):
+    """
+    Stream the CLIENT LIST reply of a server one client at a time
+    The reply is read off the connection socket line by line instead of
+    being loaded and split as a whole, so the memory used stays flat
+    whatever the number of clients.
+    Args:
+        client: the redis client
+    Returns:
+        a generator of dicts holding the fields of every client
+    """
+    pool = client.connection_pool
+    connection = pool.get_connection("CLIENT")
+    clean = False
+    try:
+        connection.send_command("CLIENT", "LIST")
+        reader = connection._sock.makefile("rb")
+        try:
+            header = reader.readline()
+            if header.startswith(b"-"):
+                clean = True
+                raise redis.ResponseError(header[1:].decode().strip())
+            if not header.startswith(b"$"):
+                raise redis.ConnectionError("Unexpected CLIENT LIST reply")
+            left = int(header[1:])
+            while left > 0:
+                line = reader.readline(left)
+                if not line:
+                    raise redis.ConnectionError("Connection closed by server")
+                left -= len(line)
+                fields = line.decode(errors="replace").split()
+                yield dict(field.partition("=")[::2] for field in fields)
+            clean = reader.read(2) == b"\r\n"
+        finally:
+            reader.close()
+    finally:
+        # A reply that wasn't read to the end leaves the connection unusable
+        if not clean:
+            connection.disconnect()
+        pool.release(connection)
+
+
+def stream_pubsub_channels(client, pattern=None):
+    """
+    Stream the PUBSUB CHANNELS reply of a server one channel at a time
+    Channels are read off the connection socket as they are consumed, and a
+    generator closed before the end of the reply drops the connection, so
+    only the channels actually used are ever read.
+    Args:
+        client: the redis client
+        pattern: only list the channels matching this glob-style pattern
+    Returns:
+        a generator of channel names
+    """
+    pool = client.connection_pool
+    connection = pool.get_connection("PUBSUB")
+    clean = False
+    try:
+        connection.send_command("PUBSUB", "CHANNELS", *([pattern] if pattern else []))
+        reader = connection._sock.makefile("rb")
+        try:
+            header = reader.readline()
+            if header.startswith(b"-"):
+                clean = True
+                raise redis.ResponseError(header[1:].decode().strip())
+            if not header.startswith(b"*"):
+                raise redis.ConnectionError("Unexpected PUBSUB CHANNELS reply")
+            for _ in range(int(header[1:])):
+                length = reader.readline()
+                if not length.startswith(b"$"):
+                    raise redis.ConnectionError("Connection closed by server")
+                channel = reader.read(int(length[1:]) + 2)
+                if not channel.endswith(b"\r\n"):
+                    raise redis.ConnectionError("Connection closed by server")
+                yield connection.encoder.decode(channel[:-2])
+            clean = True
+        finally:
+            reader.close()
+    finally:
+        # A reply that wasn't read to the end leaves the connection unusable
+        if not clean:
+            connection.disconnect()
+        pool.release(connection)
+
+
+class ClientListSummary:
+    """
+    Summary of the CLIENT LIST of every node, grouped by client name, client
+    host and last command. Only the largest groups of a node are kept, the
+    rest are folded into a single (other) group.
+    """
+
+    def __init__(self, top=20):
+        self.top = top
+        self.entries = []
+
+    def sample(self, client, section, node):
+        """
+        Summarise the clients connected to a node
+        Args:
+            client: the redis client
+            section: the cluster the node belongs to
+            node: the node the clients are connected to
+        """
+        groups = {}
+        for fields in stream_client_list(client):
+            key = (
+                fields.get("name", ""),
+                fields.get("addr", "").rsplit(":", 1)[0],
+                fields.get("cmd", ""),
+            )
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [0, 0, 0, 0, 0, 0]
+            group[0] += 1
+            group[1] = max(group[1], int(fields.get("idle", 0)))
+            group[2] += int(fields.get("qbuf", 0))
+            group[3] += int(fields.get("omem", 0))
+            group[4] = max(group[4], int(fields.get("omem", 0)))
+            group[5] += int(fields.get("tot-mem", 0))
+
+        ranked = sorted(groups.items(), key=lambda item: -item[1][0])
+        if len(ranked) > self.top:
+            other = [0, 0, 0, 0, 0, 0]
+            for _, group in ranked[self.top :]:
+                other[0] += group[0]
+                other[1] = max(other[1], group[1])
+                other[2] += group[2]
+                other[3] += group[3]
+                other[4] = max(other[4], group[4])
+                other[5] += group[5]
+            ranked = ranked[: self.top] + [(("(other)", "", ""), other)]
+        for key, group in ranked:
+            self.entries.append((section, node) + key + tuple(group))
+
+    def rows(self, references=None):
+        for entry in self.entries:
+            section, node, name, host, cmd = entry[:5]
+            clients, idle, qbuf, omem, omem_max, total = entry[5:]
+            row = {
+                "ClusterId": section,
+                "NodeId": node_id(node),
+                "Name": name,
+                "Host": host,
+                "LastCommand": cmd,
+                "Clients": clients,
+                "MaxIdle (s)": idle,
+                "QueryBuffer (bytes)": qbuf,
+                "OutputBuffer (bytes)": omem,
+                "MaxOutputBuffer (bytes)": omem_max,
+                "TotalMemory (bytes)": total,
+            }
+            yield from fan_out((section, node), row, references)
+
+
+class CapacityModel:
+    """
+    What a single shard is expected to sustain. Writes, scripts and Pub/Sub
+    deliveries are weighted against the plain operations a shard is rated for.
+    """
+
+    def __init__(
+        self,
+        shard_ops=25000,
+        shard_memory=25,
+        headroom=0.3,
+        write_cost=1.5,
+        eval_cost=3,
+        shard_cpu=100,
+        delivery_cost=1,
+    ):
+        self.shard_ops = shard_ops
+        self.shard_memory = shard_memory
+        self.headroom = headroom
+        self.write_cost = write_cost
+        self.eval_cost = eval_cost
+        self.shard_cpu = shard_cpu
+        self.delivery_cost = delivery_cost
+
+
+class CapacityPlanner:
+    """
+    Turn the measured rates into a recommended shard count per cluster.
+    The rows of every interval are folded into per cluster peaks as they
+    arrive, so planning again after each interval costs one pass over the
+    clusters whatever the length of the run.
+    """
+
+    # The per cluster totals kept for every interval, and their peaks
+    METRICS = (
+        "Nodes",
+        "Masters",
+        "Ops",
+        "Reads",
+        "Writes",
+        "Evals",
+        "ClusterCmds",
+        "WeightedOps",
+        "Memory",
+        "Cpu",
+        "Deliveries",
+    )
+
+    def __init__(self, model=None):
+        self.model = model or CapacityModel()
+        self.peaks = {}
+
+    def add(self, rows):
+        """
+        Add the rows of a sampling interval
+        Args:
+            rows: result rows, as lists ordered like RESULT_COLUMNS
+        """
+
+        def number(row, column):
+            value = row[COLUMN_INDEX[column]]
+            return value if isinstance(value, (int, float)) else 0
+
+        totals = {}
+        for row in rows:
+            if row[COLUMN_INDEX["Status"]] == "error":
+                continue
+            master = row[COLUMN_INDEX["NodeRole"]] == "Master"
+            reads = number(row, "GetTypeCmds")
+            if master:
+                ops = number(row, "Throughput (Ops)")
+                writes = number(row, "SetTypeCmds")
+                evals = number(row, "EvalBasedCmds")
+                cluster_cmds = number(row, "ClusterBasedCmds")
+            else:
+                # Replicas replay the writes of their master, only the reads
+                # they serve add to the load
+                ops, writes, evals, cluster_cmds = reads, 0, 0, 0
+            deliveries = number(row, "PubSubDeliveries/sec")
+            weighted = (
+                ops
+                + writes * (self.model.write_cost - 1)
+                + evals * (self.model.eval_cost - 1)
+                + deliveries * self.model.delivery_cost
+            )
+            values = (
+                1,
+                master,
+                ops,
+                reads,
+                writes,
+                evals,
+                cluster_cmds,
+                weighted,
+                number(row, "MemoryUsed (Gb)") if master else 0,
+                number(row, "CpuUsage (%)") if master else 0,
+                deliveries,
+            )
+            total = totals.setdefault(row[COLUMN_INDEX["ClusterId"]], [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+
+        for cluster, total in totals.items():
+            peak = self.peaks.get(cluster)
+            self.peaks[cluster] = (
+                total if peak is None else [max(a, b) for a, b in zip(peak, total)]
+            )
+
+    def plan(self, cluster):
+        """
+        Plan the shards of a cluster
+        Args:
+            cluster: the ClusterId
+        Returns:
+            the plan row
+        """
+        model = self.model
+        peak = dict(zip(self.METRICS, self.peaks[cluster]))
+        usable = 1 - model.headroom
+        loads = {
+            "Ops": (peak["WeightedOps"], model.shard_ops),
+            "Memory": (peak["Memory"], model.shard_memory),
+            "Cpu": (peak["Cpu"], model.shard_cpu),
+        }
+        shards = {
+            name: max(math.ceil(load / (capacity * usable)), 1)
+            for name, (load, capacity) in loads.items()
+        }
+        recommended = max(shards.values())
+        limited_by = max(shards, key=lambda name: (shards[name], name == "Ops"))
+        utilisation = max(
+            load / (capacity * recommended) for load, capacity in loads.values()
+        )
+
+        def share(value):
+            return round(100 * value / peak["Ops"], 1) if peak["Ops"] else 0
+
+        return {
+            "ClusterId": cluster,
+            "Nodes": peak["Nodes"],
+            "CurrentShards": peak["Masters"],
+            "PeakOps": peak["Ops"],
+            "Reads (%)": share(peak["Reads"]),
+            "Writes (%)": share(peak["Writes"]),
+            "Eval (%)": share(peak["Evals"]),
+            "ClusterCmds (%)": share(peak["ClusterCmds"]),
+            "Deliveries/sec": round(peak["Deliveries"], 1),
+            "WeightedOps": round(peak["WeightedOps"]),
+            "MemoryUsed (Gb)": round(peak["Memory"], 3),
+            "CpuUsage (%)": round(peak["Cpu"], 1),
+            "ShardsByOps": shards["Ops"],
+            "ShardsByMemory": shards["Memory"],
+            "ShardsByCpu": shards["Cpu"],
+            "RecommendedShards": recommended,
+            "LimitedBy": limited_by,
+            "Headroom (%)": round(100 * (1 - utilisation), 1),
+        }
+
+    def rows(self):
+        for cluster in self.peaks:
+            yield self.plan(cluster)
+
+
+class Checkpoint:
+    """
+    Append only journal of a run, used to resume it after a crash.
+    It records the first snapshot of every node, every node result and the
+    rows of every completed section of the interval in progress as soon as
+    they are available. Once an interval is over its rows are in the output
+    file, so only the number of result rows it ended at is kept. Records
+    are written by a background thread so the event loop never waits on
+    the disk.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.snapshots = {}
+        self.results = {}
+        self.sections = {}
+        self.finished = []
+        if resume:
+            self._load()
+        else:
+            open(path, "w").close()
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last record may have been cut short by the crash
+                        continue
+                    key = (record.get("interval"), record.get("section"))
+                    if record["type"] == "snapshot":
+                        self.snapshots[key + (record["node"],)] = (
+                            record["cmds"],
+                            record["info"],
+                            record["taken_at"],
+                        )
+                    elif record["type"] == "result":
+                        self.results[key + (record["node"],)] = record["result"]
+                    elif record["type"] == "rows":
+                        self.sections.setdefault(key[0], {})[key[1]] = record["rows"]
+                    elif record["type"] == "finished":
+                        self.finished = record["rows"]
+        except FileNotFoundError:
+            print("No checkpoint found in {}, starting over".format(self.path))
+
+    def _write(self):
+        f = open(self.path, "a")
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if record == "compact":
+                f.close()
+                self._rewrite()
+                f = open(self.path, "a")
+                continue
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+
+    def _rewrite(self):
+        # Once an interval is over only where its rows end is needed
+        tmp_file = "{}.tmp".format(self.path)
+        with open(tmp_file, "w") as f:
+            record = {"type": "finished", "rows": list(self.finished)}
+            f.write(json.dumps(record) + "\n")
+            for interval, sections in list(self.sections.items()):
+                for section, rows in list(sections.items()):
+                    record = {
+                        "type": "rows",
+                        "interval": interval,
+                        "section": section,
+                        "rows": rows,
+                    }
+                    f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+
+    def snapshot(self, interval, section, node):
+        return self.snapshots.get((interval, section, node))
+
+    def result(self, interval, section, node):
+        return self.results.get((interval, section, node))
+
+    def completed(self, interval):
+        """Get the rows of the sections completed in an interval"""
+        return self.sections.get(interval, {})
+
+    def save_snapshot(self, interval, section, node, cmds, info):
+        self.queue.put(
+            {
+                "type": "snapshot",
+                "interval": interval,
+                "section": section,
+                "node": node,
+                "taken_at": time.time(),
+                "cmds": cmds,
+                "info": info,
+            }
+        )
+
+    def save_result(self, interval, section, node, result):
+        self.results[(interval, section, node)] = result
+        self.queue.put(
+            {
+                "type": "result",
+                "interval": interval,
+                "section": section,
+                "node": node,
+                "result": result,
+            }
+        )
+
+    def save_rows(self, interval, section, rows):
+        self.sections.setdefault(interval, {})[section] = rows
+        self.queue.put(
+            {"type": "rows", "interval": interval, "section": section, "rows": rows}
+        )
+
+    def compact(self, interval, rows=None):
+        """
+        Drop everything kept for a finished interval
+        Args:
+            interval: the interval
+            rows: the number of result rows of the run once it was over,
+                None in the checkpoint of a worker process
+        """
+        self.snapshots.clear()
+        self.results.clear()
+        self.sections.pop(interval, None)
+        if rows is not None:
+            self.finished.append(rows)
+        self.queue.put("compact")
+
+    def close(self, remove=False):
+        self.queue.put(None)
+        self.writer.join()
+        if remove:
+            os.remove(self.path)
+
+
+class HistoryStore:
+    """
+    SQLite store the per node, per category values of every run are
+    appended to, so that trends can be queried across runs.
+    Node values are kept in long format (one row per node, category and
+    sample) and indexed by category/time, cluster, node, role and run. A per
+    cluster and role rollup is maintained as rows are appended, so cluster
+    level queries only read one row per cluster and sample.
+    """
+
+    SCHEMA = """
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            started_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS samples (
+            run INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            cluster TEXT NOT NULL,
+            node TEXT NOT NULL,
+            role TEXT NOT NULL,
+            category TEXT NOT NULL,
+            value REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS samples_category_ts ON samples (category, ts);
+        CREATE INDEX IF NOT EXISTS samples_cluster_ts ON samples (cluster, ts);
+        CREATE INDEX IF NOT EXISTS samples_node_ts ON samples (node, ts);
+        CREATE INDEX IF NOT EXISTS samples_role ON samples (role);
+        CREATE INDEX IF NOT EXISTS samples_run ON samples (run);
+        CREATE TABLE IF NOT EXISTS cluster_samples (
+            run INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            cluster TEXT NOT NULL,
+            role TEXT NOT NULL,
+            category TEXT NOT NULL,
+            total REAL NOT NULL,
+            peak REAL NOT NULL,
+            nodes INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS cluster_samples_category_ts
+            ON cluster_samples (category, ts, cluster, role, run, total, peak, nodes);
+    """
+
+    AGGREGATES = {
+        "sum": "SUM(total)",
+        "max": "MAX(peak)",
+        "avg": "SUM(total) / SUM(nodes)",
+    }
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+        self.run = None
+
+    def start_run(self):
+        with self.db:
+            self.run = self.db.execute(
+                "INSERT INTO runs (started_at) VALUES (?)", (time.time(),)
+            ).lastrowid
+        return self.run
+
+    def append(self, rows, ts=None):
+        """
+        Append result rows to the store
+        Args:
+            rows: result rows, as lists ordered like RESULT_COLUMNS
+            ts: the time the rows were sampled at
+        """
+        if self.run is None:
+            self.start_run()
+        ts = ts or time.time()
+        cluster = COLUMN_INDEX["ClusterId"]
+        node = COLUMN_INDEX["NodeId"]
+        address = COLUMN_INDEX["NodeAddress"]
+        role = COLUMN_INDEX["NodeRole"]
+
+        samples = []
+        rollup = {}
+        for row in rows:
+            name = node_key(row[node], row[address])
+            for column, value in zip(RESULT_COLUMNS, row):
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                samples.append(
+                    (self.run, ts, row[cluster], name, row[role], column, value)
+                )
+                key = (row[cluster], row[role], column)
+                total, peak, nodes = rollup.get(key, (0, value, 0))
+                rollup[key] = (total + value, max(peak, value), nodes + 1)
+
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)", samples
+            )
+            self.db.executemany(
+                "INSERT INTO cluster_samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((self.run, ts) + key + value for key, value in rollup.items()),
+            )
+
+    def query(self, category, q=95, since=None, cluster=None, role=None, agg="sum"):
+        """
+        Get the q-th percentile of a category per cluster
+        The values of the nodes of a cluster are first aggregated per sample.
+        Args:
+            category: the category (result column) to query
+            q: the percentile
+            since: only use the samples taken after this time
+            cluster: only query this cluster
+            role: only use the nodes with this role
+            agg: how the nodes of a cluster are aggregated (sum, max or avg)
+        Returns:
+            one dict per cluster
+        """
+        sql = "SELECT cluster, {} AS value FROM cluster_samples WHERE category = ?"
+        params = [category]
+        if since is not None:
+            sql += " AND ts >= ?"
+            params.append(since)
+        if cluster:
+            sql += " AND cluster = ?"
+            params.append(cluster)
+        if role:
+            sql += " AND role = ?"
+            params.append(role)
+        sql += " GROUP BY cluster, run, ts ORDER BY cluster, value"
+        sql = sql.format(self.AGGREGATES[agg])
+
+        results = []
+        current, values = None, []
+        for name, value in self.db.execute(sql, params):
+            if name != current and values:
+                results.append(self._summary(current, category, q, values))
+                values = []
+            current = name
+            values.append(value)
+        if values:
+            results.append(self._summary(current, category, q, values))
+        return results
+
+    def iter_run(self, run):
+        """
+        Stream the values recorded by a run
+        Returns:
+            (cluster, node, category, value) tuples
+        """
+        return self.db.execute(
+            "SELECT cluster, node, category, value FROM samples WHERE run = ?",
+            (run,),
+        )
+
+    @staticmethod
+    def _summary(cluster, category, q, values):
+        return {
+            "ClusterId": cluster,
+            "Category": category,
+            "Samples": len(values),
+            "P{}".format(q): percentile(values, q),
+            "Max": values[-1],
+        }
+
+    def close(self):
+        self.db.close()
+
+
+def query_history(args):
+    """Run the history subcommand"""
+    if not os.path.isfile(args.historyFile):
+        print("Can't find the specified {} history store".format(args.historyFile))
+        sys.exit(1)
+    store = HistoryStore(args.historyFile)
+    since = time.time() - args.days * 86400 if args.days else None
+    results = store.query(
+        args.category, args.percentile, since, args.cluster, args.role, args.agg
+    )
+    store.close()
+
+    if not results:
+        print("No samples found")
+    for result in results:
+        print(", ".join("{}: {}".format(k, v) for k, v in result.items()))
+
+
+# The result columns compared between two runs
+COMPARED_COLUMNS = [
+    "MemoryUsed (Gb)",
+    "Throughput (Ops)",
+    *COMMAND_CATEGORIES,
+    "CurrItems",
+    "CurrConnections",
+    "Connections/sec",
+]
+
+
+def iter_result_file(path):
+    """
+    Stream the values of the ClusterData sheet of an output file
+    Returns:
+        (cluster, node, category, value) tuples, node being the node_key
+    """
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        rows = wb["ClusterData"].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        cluster = header.index("ClusterId")
+        node = header.index("NodeId")
+        address = header.index("NodeAddress") if "NodeAddress" in header else None
+        if address is None:
+            print(
+                "{} has no NodeAddress column, the nodes sharing a host are "
+                "merged".format(path)
+            )
+        columns = [
+            (index, column)
+            for index, column in enumerate(header)
+            if column in COMPARED_COLUMNS
+        ]
+        for row in rows:
+            key = node_key(row[node], None if address is None else row[address])
+            for index, column in columns:
+                value = row[index]
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield row[cluster], key, column, value
+    finally:
+        wb.close()
+
+
+def aggregate_samples(samples):
+    """
+    Fold a stream of values into running statistics per node and category.
+    Only the count, mean and sum of squared deviations (Welford) are kept,
+    so the memory used doesn't depend on the number of intervals.
+    Returns:
+        a dict keyed by (cluster, node) of dicts keyed by category
+    """
+    stats = {}
+    for cluster, node, column, value in samples:
+        entry = stats.setdefault((cluster, node), {}).setdefault(column, [0, 0.0, 0.0])
+        entry[0] += 1
+        delta = value - entry[1]
+        entry[1] += delta / entry[0]
+        entry[2] += delta * (value - entry[1])
+    return stats
+
+
+def betainc(a, b, x):
+    """Regularized incomplete beta function (continued fraction)"""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):
+        return 1 - betainc(b, a, 1 - x)
+
+    front = math.exp(
+        math.lgamma(a + b)
+        - math.lgamma(a)
+        - math.lgamma(b)
+        + a * math.log(x)
+        + b * math.log(1 - x)
+    )
+    tiny = 1e-300
+    c, d = 1.0, 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    result = d
+    for m in range(1, 200):
+        for numerator in (
+            m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+            -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1)),
+        ):
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            result *= c * d
+        if abs(c * d - 1) < 1e-12:
+            break
+    return front * result / a
+
+
+def welch_test(before, after):
+    """
+    Two sided Welch's t-test between two running statistics
+    Args:
+        before: [count, mean, m2] of the first sample
+        after: [count, mean, m2] of the second sample
+    Returns:
+        the p-value, or None when there are not enough intervals
+    """
+    (n1, mean1, m2_1), (n2, mean2, m2_2) = before, after
+    if n1 < 2 or n2 < 2:
+        return None
+    var1, var2 = m2_1 / (n1 - 1) / n1, m2_2 / (n2 - 1) / n2
+    if var1 + var2 == 0:
+        return 1.0 if mean1 == mean2 else 0.0
+    t = (mean2 - mean1) / math.sqrt(var1 + var2)
+    df = (var1 + var2) ** 2 / (var1**2 / (n1 - 1) + var2**2 / (n2 - 1))
+    return betainc(df / 2, 0.5, df / (df + t * t))
+
+
+def compare_results(before, after):
+    """
+    Join two aggregated result sets by ClusterId and node (see node_key)
+    Args:
+        before: the aggregated values of the first result set
+        after: the aggregated values of the second result set
+    Returns:
+        one dict per node and category
+    """
+    for key in list(before) + [key for key in after if key not in before]:
+        cluster, node = key
+        if key not in after:
+            status = "removed"
+        elif key not in before:
+            status = "added"
+        else:
+            status = "matched"
+        columns = {**before.get(key, {}), **after.get(key, {})}
+        for column in COMPARED_COLUMNS:
+            if column not in columns:
+                continue
+            old = before.get(key, {}).get(column)
+            new = after.get(key, {}).get(column)
+            old_mean = old[1] if old else 0
+            new_mean = new[1] if new else 0
+            p_value = welch_test(old, new) if old and new else None
+            yield {
+                "ClusterId": cluster,
+                "NodeId": node,
+                "Status": status,
+                "Category": column,
+                "Before": round(old_mean, 3),
+                "After": round(new_mean, 3),
+                "Change": round(new_mean - old_mean, 3),
+                "Change (%)": (
+                    round((new_mean - old_mean) * 100 / old_mean, 1) if old_mean else ""
+                ),
+                "Intervals": "{}/{}".format(old[0] if old else 0, new[0] if new else 0),
+                "PValue": round(p_value, 4) if p_value is not None else "",
+            }
+
+
+def run_compare(args):
+    """Run the compare subcommand"""
+
+    def load(source):
+        if args.historyStore:
+            store = HistoryStore(args.historyStore)
+            try:
+                return aggregate_samples(store.iter_run(int(source)))
+            finally:
+                store.close()
+        if not os.path.isfile(source):
+            print("Can't find the specified {} results file".format(source))
+            sys.exit(1)
+        return aggregate_samples(iter_result_file(source))
+
+    rows = compare_results(load(args.before), load(args.after))
+    if args.printOnly:
+        print("\n--------------------")
+        for row in rows:
+            for key, value in row.items():
+                print(f"{key}: {value}")
+            print("--------------------\n")
+        return
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Comparison")
+    header = None
+    for row in rows:
+        if header is None:
+            header = list(row.keys())
+            ws.append(header)
+        ws.append(list(row.values()))
+    print("Writing output file {}".format(args.outputFile))
+    wb.save(args.outputFile)
+
+
+class RunContext:
+    """
+    State shared by all the sections and sampling intervals of a run
+    """
+
+    def __init__(
+        self,
+        slowlog=None,
+        command_cache=None,
+        server_categories=True,
+        probe=None,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        commands=None,
+        clients=None,
+        planner=None,
+        keyspace=None,
+        prefixes=None,
+        backlog=None,
+        bursts=None,
+        checkpoint=None,
+        history=None,
+    ):
+        self.interval = 1
+        self.history = history
+        self.checkpoint = checkpoint
+        self.shared_nodes = {}
+        self.references = {}
+        self.slowlog = slowlog
+        self.probe = probe
+        self.commands = commands
+        self.clients = clients
+        self.planner = planner
+        self.keyspace = keyspace
+        self.prefixes = prefixes
+        self.backlog = backlog
+        self.bursts = bursts
+        self.timeout = timeout
+        self.retries = retries
+        self.command_cache = command_cache
+        self.server_categories = server_categories
+        self.command_tables = {}
+        self.discovery = {}
+        self.progress = True
+        self.worker_sheets = {}
+
+
+async def process_node(
+    section,
+    config,
+    node,
+    is_master_shard,
+    duration,
+    context=None,
+    categories=COMMAND_CATEGORIES,
+):
+    """
+    Get the current command stats of the passed node
+    Args:
+        row: a row from the input file
+        node: the node to be processed
+        is_master_shard: is master shard
+        duration: the duration between runs
+        context: the state shared across the run
+        categories: the command category table of the node
+    Returns:
+        command stats output
+    """
+    params = node.split(":")
+    print("Processing node {}:{}".format(params[0], params[1]))
+
+    deadline = float(
+        config.get("timeout") or (context.timeout if context else DEFAULT_TIMEOUT)
+    )
+    retries = int(
+        config.get("retries") or (context.retries if context else DEFAULT_RETRIES)
+    )
+
+    client = get_config_client(config, node, socket_timeout=deadline)
+
+    slowlog = context.slowlog if context else None
+    probe = context.probe if context else None
+
+    checkpoint = context.checkpoint if context else None
+    interval = context.interval if context else 1
+
+    # first run, unless a resumed run already took it
+    if slowlog:
+        await slowlog.poll(client, section, node, categories, deadline)
+    resumed = checkpoint.snapshot(interval, section, node) if checkpoint else None
+    try:
+        if resumed:
+            server = await call_with_deadline(
+                client.execute_command,
+                "info",
+                "server",
+                deadline=deadline,
+                retries=retries,
+            )
+            if restarted(resumed[1], server):
+                print("Node {} restarted since the checkpoint".format(node))
+                resumed = None
+        if resumed:
+            res1, info1, taken_at = resumed
+            # The counters moved for as long as the run was down
+            elapsed = max(time.time() - taken_at, 0)
+        else:
+            with TRACER.span("first snapshot", node):
+                res1, info1 = await take_snapshot(client, deadline, retries, node)
+            if checkpoint:
+                checkpoint.save_snapshot(interval, section, node, res1, info1)
+            elapsed = 0
+    except SAMPLING_ERRORS as e:
+        print("Error sampling node {}: {}".format(node, e))
+        return failed_result(section, node, is_master_shard, e)
+    started = time.monotonic() - elapsed
+    remaining = max(duration * 60 - elapsed, 0)
+
+    # Anything else that has to watch the node runs while the window is open
+    prefixes = context.prefixes if context else None
+    backlog = context.backlog if context else None
+    bursts = context.bursts if context else None
+
+    async def halfway():
+        # The nearest valid sample to fall back to if the second snapshot
+        # is missed
+        await sleep(remaining / 2)
+        try:
+            with TRACER.span("halfway snapshot", node):
+                snapshot = await take_snapshot(client, deadline, 0, node)
+        except SAMPLING_ERRORS:
+            return None
+        return snapshot + (time.monotonic(),)
+
+    window = {"sleep": sleep(remaining)}
+    if remaining:
+        window["halfway"] = halfway()
+    if slowlog:
+        window["slowlog"] = slowlog.watch(
+            client, section, node, remaining, categories, deadline
+        )
+    if probe:
+        window["probe"] = probe.watch(client, section, node, remaining)
+    if prefixes:
+        window["prefixes"] = prefixes.watch(client, section, node, remaining, info1)
+    if backlog:
+        window["backlog"] = backlog.watch(client, section, node)
+    if bursts:
+        window["bursts"] = bursts.watch(
+            client,
+            section,
+            node,
+            remaining,
+            sections_of((section, node), context.references),
+        )
+    with TRACER.span("window", node):
+        done = dict(zip(window, await asyncio.gather(*window.values())))
+
+    # second run, retried with backoff. If it can't be taken at all the
+    # rates are measured up to the halfway snapshot, or left empty without it
+    error = None
+    window_in_seconds = 60 * duration
+    try:
+        with TRACER.span("second snapshot", node):
+            res2, info2 = await take_snapshot(client, deadline, retries, node)
+        taken_at = time.monotonic()
+    except SAMPLING_ERRORS as e:
+        print("Error sampling node {}: {}".format(node, e))
+        if not done.get("halfway"):
+            result = build_result(section, node, is_master_shard, info1)
+            result["Status"] = "partial"
+            result["Error"] = describe_error(e)
+            return result
+        # The calls of the watchers can't be told apart before and after it
+        res2, info2, taken_at = done["halfway"]
+        window_in_seconds -= remaining / 2
+        error = e
+    if slowlog and error is None:
+        await slowlog.poll(client, section, node, categories, deadline)
+    issued = {"info": 2} if done.get("halfway") else {}
+    for watcher in ("prefixes", "backlog", "bursts"):
+        for command, calls in (done.get(watcher) or {}).items():
+            issued[command] = issued.get(command, 0) + calls
+    if probe:
+        issued["ping"] = done["probe"]
+    if error is None:
+        discount_commands(res2, info2, issued)
+    if context and context.clients and error is None:
+        try:
+            with TRACER.span("client list", node):
+                await call_with_deadline(
+                    context.clients.sample, client, section, node, deadline=deadline
+                )
+        except SAMPLING_ERRORS as e:
+            print("Error listing the clients of node {}: {}".format(node, e))
+
+    # A late snapshot widens the window
+    duration_in_seconds = max(window_in_seconds, taken_at - started)
+
+    with TRACER.span("aggregate", node):
+        result = build_result(section, node, is_master_shard, info2)
+        result["Throughput (Ops)"] = round(
+            (info2["total_commands_processed"] - info1["total_commands_processed"])
+            / duration_in_seconds
+        )
+
+        for column, commands in categories.items():
+            result[column] = round(
+                get_command_by_args(res1, res2, *commands) / duration_in_seconds
+            )
+
+        for column, field in (
+            ("Connections/sec", "total_connections_received"),
+            ("RejectedConnections/sec", "rejected_connections"),
+        ):
+            result[column] = round(
+                (info2.get(field, 0) - info1.get(field, 0)) / duration_in_seconds, 3
+            )
+
+        cpu = sum(
+            info2.get(field, 0) - info1.get(field, 0)
+            for field in ("used_cpu_sys", "used_cpu_user")
+        )
+        result["CpuUsage (%)"] = round(100 * cpu / duration_in_seconds, 1)
+
+        if backlog:
+            publishes = get_command_by_args(res1, res2, "publish", "spublish")
+            result["PubSubDeliveries/sec"] = backlog.deliveries(
+                section, node, publishes / duration_in_seconds
+            )
+        if bursts:
+            result["PeakOps/sec"], result["Bursts"] = bursts.summary(section, node)
+
+        if context and context.commands is not None:
+            context.commands.add(section, node, res1, res2, duration_in_seconds)
+        if context and context.keyspace is not None:
+            context.keyspace.add(section, node, info1, info2)
+
+    if error is not None:
+        result["Status"] = "partial"
+        result["Error"] = describe_error(error)
+        return result
+    result["Status"] = "ok"
+    return result
+
+
+def restarted(before, after):
+    """
+    Tell whether a node was restarted between two INFO snapshots
+    """
+    if before.get("run_id") and after.get("run_id"):
+        return before["run_id"] != after["run_id"]
+    return after.get("uptime_in_seconds", 0) < before.get("uptime_in_seconds", 0)
+
+
+def build_result(section, node, is_master_shard, info):
+    """
+    Build the result row of a node out of a single INFO snapshot
+    The rate columns are left empty.
+    Args:
+        section: the cluster the node belongs to
+        node: the node to be processed
+        is_master_shard: is master shard
+        info: the INFO output of the node
+    Returns:
+        the result row
+    """
+    # A failover since the discovery shows in the role the node reports
+    if info.get("role") in ("master", "slave"):
+        is_master_shard = info["role"] == "master"
+    result = ResultRow()
+    result["Source"] = "OSS"
+    result["ClusterId"] = section
+    result["NodeId"] = node_id(node)
+    result["NodeRole"] = "Master" if is_master_shard else "Replica"
+    result["NodeAddress"] = node
+    result["RedisVersion"] = info["redis_version"]
+    result["OS"] = info["os"]
+    result["TotalSystemMemory"] = round(info["total_system_memory"] / 1024**3, 3)
+    result["BytesUsedForCache"] = info["used_memory_peak"]
+    result["CurrConnections"] = info["connected_clients"]
+    result["ClusterEnabled"] = info["cluster_enabled"]
+    result["ConnectedSlaves"] = (
+        info["connected_slaves"] if "connected_slaves" in info else ""
+    )
+    result["MemoryUsed (Gb)"] = round(info["used_memory_peak"] / 1024**3, 3)
+    result["BlockedClients"] = info.get("blocked_clients", "")
+    result["MaxClientInputBuffer"] = info.get("client_recent_max_input_buffer", "")
+    result["MaxClientOutputBuffer"] = info.get("client_recent_max_output_buffer", "")
+    result["PubSubChannels"] = info.get("pubsub_channels", "")
+    result["PubSubPatterns"] = info.get("pubsub_patterns", "")
+
+    result["CurrItems"] = 0
+    result["Namespaces"] = ""
+    for x in range(16):
+        db = "db{}".format(x)
+        if db in info:
+            # debug('num of keys %s' % info[db]['keys'])
+            result["CurrItems"] += info[db]["keys"]
+            if x > 0:
+                result["Namespaces"] += ", "
+            result["Namespaces"] += f"{db}:{info[db]['keys']}"
+
+    return result
+
+
+def failed_result(section, node, is_master_shard, error):
+    """
+    Build the result row of a node that couldn't be sampled
+    """
+    result = ResultRow()
+    result["Source"] = "OSS"
+    result["ClusterId"] = section
+    result["NodeId"] = node_id(node)
+    result["NodeRole"] = "Master" if is_master_shard else "Replica"
+    result["NodeAddress"] = node
+    result["Status"] = "error"
+    result["Error"] = describe_error(error)
+    return result
+
+
+def node_id(node):
+    """Get the NodeId a node is reported under"""
+    return node.split(":")[0].replace(".", "-")
+
+
+def sections_of(key, references=None):
+    """
+    Get the sections referencing a node
+    Args:
+        key: the (section, node) the node was sampled as
+        references: the sections referencing the shared nodes, by key
+    """
+    return (references or {}).get(key) or [key[0]]
+
+
+def fan_out(key, row, references=None):
+    """Repeat the sheet row of a node for every section referencing it"""
+    for section in sections_of(key, references):
+        yield dict(row, ClusterId=section)
+
+
+def node_key(node, address):
+    """
+    Get the key a node is matched by across result sets, its NodeId and the
+    port of its NodeAddress, as the NodeId alone is shared by the nodes of a
+    host
+    """
+    if isinstance(address, str) and ":" in address:
+        return "{}:{}".format(node, address.rsplit(":", 1)[1])
+    return node
+
+
+def describe_error(error):
+    return "{}: {}".format(type(error).__name__, error)
+
+
+async def run_tasks(tasks):
+    monitor = None
+    if TRACER.enabled:
+        monitor = asyncio.ensure_future(TRACER.watch_loop())
+    res = await asyncio.gather(*tasks, return_exceptions=True)
+    if monitor:
+        monitor.cancel()
+    return res
+
+
+def discover_nodes(config, section, context=None):
+    """
+    Discover the nodes of a database
+    Args:
+        config: the config section of the database
+        section: the name of the database
+        context: the state shared across the run
+    Returns:
+        a list of (node, is_master_shard) and the command category table of
+        the database, or None when the database can't be reached
+    """
+    print("\nConnecting to {} database ..".format(section))
+
+    client = get_config_client(
+        config,
+        socket_timeout=float(
+            config.get("timeout") or (context.timeout if context else DEFAULT_TIMEOUT)
+        ),
+    )
+
+    try:
+        with TRACER.span("connect", args={"section": section}):
+            client.ping()
+        print("Connected to {} database".format(section))
+    except BaseException:
+        print("Error connecting to {} database".format(section))
+        return None
+
+    try:
+        with TRACER.span("info", args={"section": section}):
+            info = client.execute_command("info")
+        if "cluster_enabled" in info and info["cluster_enabled"] == 1:
+            with TRACER.span("cluster nodes", args={"section": section}):
+                nodes = client.execute_command("cluster nodes")
+        else:
+            nodes = None
+    except SAMPLING_ERRORS as e:
+        print("Error discovering the nodes of {} database: {}".format(section, e))
+        return None
+    if nodes is None:
+        nodes = {
+            "%s:%s"
+            % (config["host"], config["port"]): {"flags": "master", "connected": True}
+        }
+
+    categories = resolve_categories(client, info, section, context)
+
+    targets = []
+    for node, stats in nodes.items():
+        is_master_shard = False
+        if stats["flags"].find("master") >= 0:
+            is_master_shard = True
+        if stats["connected"] is True:
+            targets.append((node, is_master_shard))
+
+    return targets, categories
+
+
+def resolve_categories(client, info, section, context=None):
+    """Get the command category table a database is sampled with"""
+    if context is not None and not context.server_categories:
+        return COMMAND_CATEGORIES
+    with TRACER.span("command categories", args={"section": section}):
+        return get_command_categories(
+            client,
+            info,
+            context.command_cache if context else None,
+            context.command_tables if context else None,
+        )
+
+
+def is_sentinel(config):
+    """Tell whether a config section points at a Sentinel"""
+    value = config.get("sentinel")
+    if not isinstance(value, str):
+        return False
+    return configparser.ConfigParser.BOOLEAN_STATES.get(value.strip().lower(), False)
+
+
+def discover_sentinel(config, section, context=None):
+    """
+    Discover the masters monitored by a Sentinel and their replicas
+    Every monitored master is reported as a database of its own, named
+    <section>/<master name>. Nodes Sentinel sees as down are left out.
+    Args:
+        config: the config section of the sentinel
+        section: the name of the section
+        context: the state shared across the run
+    Returns:
+        a list of (database, [(node, is_master_shard)], categories)
+    """
+    print("\nConnecting to {} sentinel ..".format(section))
+
+    deadline = float(
+        config.get("timeout") or (context.timeout if context else DEFAULT_TIMEOUT)
+    )
+    sentinel = get_redis_client(
+        host=config.get("host"),
+        port=int(config.get("port", 26379)),
+        password=config.get("sentinel_password") or None,
+        username=config.get("sentinel_username") or None,
+        tls=config.getboolean("tls", fallback=False),
+        ca_cert=config.get("ca_cert", fallback=None) or None,
+        client_cert=config.get("client_cert", fallback=None) or None,
+        client_key=config.get("client_key", fallback=None) or None,
+        socket_timeout=deadline,
+    )
+    wanted = [name.strip() for name in config.get("masters", "").split(",")]
+    wanted = [name for name in wanted if name]
+
+    def is_up(state):
+        return not (state["is_sdown"] or state["is_odown"] or state["is_disconnected"])
+
+    databases = []
+    try:
+        with TRACER.span("sentinel masters", args={"section": section}):
+            masters = sentinel.sentinel_masters()
+        for name, master in sorted(masters.items()):
+            if wanted and name not in wanted:
+                continue
+            with TRACER.span("sentinel replicas", args={"section": section}):
+                replicas = sentinel.sentinel_slaves(name)
+            nodes = [
+                ("{}:{}".format(state["ip"], state["port"]), state is master)
+                for state in [master] + replicas
+                if is_up(state)
+            ]
+            databases.append(("{}/{}".format(section, name), nodes))
+    except SAMPLING_ERRORS as e:
+        print("Error discovering the masters of {} sentinel: {}".format(section, e))
+        return []
+    print("Found {} monitored masters in {} sentinel".format(len(databases), section))
+
+    discovered = []
+    for database, nodes in databases:
+        categories = COMMAND_CATEGORIES
+        for node, _ in nodes:
+            client = get_config_client(config, node, socket_timeout=deadline)
+            try:
+                with TRACER.span("info", node):
+                    info = client.execute_command("info")
+            except SAMPLING_ERRORS:
+                continue
+            categories = resolve_categories(client, info, database, context)
+            break
+        discovered.append((database, nodes, categories))
+    return discovered
+
+
+def discover_databases(config, section, context=None):
+    """
+    Discover the databases of a config section
+    Sentinel discoveries are cached in the context until one of their nodes
+    fails to be sampled, so continuous runs don't ask Sentinel every interval.
+    Returns:
+        a list of (database, [(node, is_master_shard)], categories)
+    """
+    if not is_sentinel(config):
+        discovered = discover_nodes(config, section, context)
+        return [] if discovered is None else [(section,) + tuple(discovered)]
+
+    if context is not None and section in context.discovery:
+        return context.discovery[section]
+    discovered = discover_sentinel(config, section, context)
+    if context is not None and discovered:
+        context.discovery[section] = discovered
+    return discovered
+
+
+def normalize_address(node):
+    """
+    Get the ip:port a node address resolves to, so that the same node is
+    recognised whatever host name it is configured with
+    """
+    host, port = node.rsplit(":", 1)
+    try:
+        host = socket.gethostbyname(host)
+    except (OSError, UnicodeError):
+        host = host.lower()
+    return "{}:{}".format(host, port)
+
+
+async def identify_targets(targets, deadline=DEFAULT_TIMEOUT):
+    """
+    Merge the targets that turn out to be the same server (same run_id)
+    behind different addresses
+    Args:
+        targets: the targets keyed by address
+        deadline: the maximum number of seconds the INFO call may take
+    Returns:
+        the targets keyed by run_id, or by address when it is unknown
+    """
+
+    async def get_run_id(target):
+        client = get_config_client(
+            target["config"], target["node"], socket_timeout=deadline
+        )
+        try:
+            info = await call_with_deadline(
+                client.execute_command, "info", "server", deadline=deadline
+            )
+            return info.get("run_id")
+        except SAMPLING_ERRORS:
+            return None
+
+    run_ids = await asyncio.gather(*(get_run_id(t) for t in targets.values()))
+
+    identified = {}
+    for (address, target), run_id in zip(targets.items(), run_ids):
+        target["run_id"] = run_id or ""
+        key = run_id or address
+        if key in identified:
+            identified[key]["references"].extend(target["references"])
+            identified[key]["addresses"].extend(target["addresses"])
+        else:
+            identified[key] = target
+    return identified
+
+
+def process_databases(configs, results, duration, loop, context=None):
+    """
+    Sample the nodes of several databases in a single window
+    Every physical node is sampled once, even when more than one section
+    points at it, and its result is written for each one of them.
+    Args:
+        configs: the config sections keyed by database name
+        results: the result table the rows are appended to
+        duration: the duration between runs
+        loop: the event loop
+        context: the state shared across the run
+    Returns:
+        the result table
+    """
+    rows = sample_databases(configs, duration, loop, context)
+    store_rows(results, rows, context)
+    return results
+
+
+def sample_databases(configs, duration, loop, context=None):
+    """
+    Sample the nodes of several databases in a single window
+    Returns:
+        the result rows of every section, as lists ordered like RESULT_COLUMNS
+    """
+    targets = {}
+    for section, config in configs.items():
+        with TRACER.span("discover", args={"section": section}):
+            discovered = discover_databases(config, section, context)
+        for database, nodes, categories in discovered:
+            for node, is_master_shard in nodes:
+                address = normalize_address(node)
+                target = targets.setdefault(
+                    address,
+                    {
+                        "node": node,
+                        "section": database,
+                        "config": config,
+                        "categories": categories,
+                        "is_master_shard": is_master_shard,
+                        "addresses": [],
+                        "references": [],
+                    },
+                )
+                if (database, node) not in target["addresses"]:
+                    target["addresses"].append((database, node))
+                    target["references"].append((section, database, is_master_shard))
+
+    if not targets:
+        return {}
+
+    with TRACER.span("identify"):
+        targets = loop.run_until_complete(
+            identify_targets(targets, context.timeout if context else DEFAULT_TIMEOUT)
+        )
+
+    # The side tables are keyed to the section a node is sampled as, and
+    # listed under all the sections referencing it
+    for target in targets.values():
+        sections = sorted({database for _, database, _ in target["references"]})
+        if len(sections) > 1 and context is not None:
+            context.references[(target["section"], target["node"])] = [
+                target["section"]
+            ] + [section for section in sections if section != target["section"]]
+
+    # Process Redis nodes in parallel
+
+    checkpoint = context.checkpoint if context else None
+    interval = context.interval if context else 1
+
+    async def sample(target):
+        key = (interval, target["section"], target["node"])
+        if checkpoint and checkpoint.result(*key) is not None:
+            return ResultRow.of(checkpoint.result(*key))
+        result = await process_node(
+            target["section"],
+            target["config"],
+            target["node"],
+            target["is_master_shard"],
+            duration,
+            context,
+            target["categories"],
+        )
+        if checkpoint:
+            checkpoint.save_result(*key, result)
+        return result
+
+    # The tasks inherit the executor of the calls bounded by a deadline
+    executor = ThreadPoolExecutor(len(targets), thread_name_prefix="osstats")
+    token = DEADLINE_EXECUTOR.set(executor)
+    try:
+        tasks = []
+        for target in targets.values():
+            tasks.append(loop.create_task(sample(target)))
+        if context is None or context.progress:
+            tasks.append(loop.create_task(progress(duration)))
+        with TRACER.span("sample"):
+            results = loop.run_until_complete(run_tasks(tasks))
+    finally:
+        DEADLINE_EXECUTOR.reset(token)
+        # Calls that ran past their deadline are not waited for
+        executor.shutdown(wait=False)
+
+    # Fan the results out to every section referencing the node
+    rows = {section: [] for section in configs}
+    for target, result in zip(targets.values(), results):
+        if isinstance(result, BaseException):
+            print("Error processing node {}: {}".format(target["node"], result))
+        failed = isinstance(result, BaseException) or result["Status"] == "error"
+        for section, database, is_master_shard in target["references"]:
+            moved = False
+            if isinstance(result, BaseException):
+                node_stats = failed_result(
+                    database, target["node"], is_master_shard, result
+                )
+            else:
+                node_stats = ResultRow.of(result)
+                node_stats["ClusterId"] = database
+                # The role the node reports wins over the discovered one
+                role = "Master" if is_master_shard else "Replica"
+                if not node_stats.get("NodeRole"):
+                    node_stats["NodeRole"] = role
+                moved = node_stats["NodeRole"] != role
+            rows[section].append(node_stats)
+            # A node that went away or changed role means a failover,
+            # discover it again
+            if (failed or moved) and context is not None:
+                context.discovery.pop(section, None)
+
+        sections = sorted({database for _, database, _ in target["references"]})
+        if len(target["references"]) > 1 and context is not None:
+            context.shared_nodes[target["run_id"] or target["node"]] = {
+                "NodeId": node_id(target["node"]),
+                "RunId": target["run_id"],
+                "SampledAs": "{} {}".format(target["section"], target["node"]),
+                "Addresses": ", ".join(
+                    "{} {}".format(section, node)
+                    for section, node in target["addresses"]
+                ),
+                "Sections": ", ".join(sections),
+            }
+
+    return {
+        section: [list(node_stats) for node_stats in section_rows]
+        for section, section_rows in rows.items()
+    }
+
+
+def store_rows(results, rows, context=None):
+    """
+    Append the result rows of an interval to the result table, and hand
+    them to the planner, the history store and the checkpoint
+    Args:
+        results: the result table of the run
+        rows: the result rows of every section
+        context: the state shared across the run
+    """
+    history = context.history if context else None
+    checkpoint = context.checkpoint if context else None
+    interval = context.interval if context else 1
+    sampled_at = time.time()
+    for section, values in rows.items():
+        with TRACER.span("append rows", args={"section": section}):
+            results.extend(values)
+        if context and context.planner:
+            context.planner.add(values)
+        if history:
+            with TRACER.span("history", args={"section": section}):
+                history.append(values, sampled_at)
+        if checkpoint:
+            checkpoint.save_rows(interval, section, values)
+
+
+def process_database(config, section, results, duration, loop, context=None):
+    return process_databases({section: config}, results, duration, loop, context)
+
+
+def write_sheet(wb, title, rows):
+    """
+    (Re)create a worksheet holding the passed rows
+    Args:
+        wb: the workbook
+        title: the title of the worksheet
+        rows: an iterable of dicts sharing the same keys
+    """
+    if title in wb.sheetnames:
+        del wb[title]
+    ws = wb.create_sheet(title)
+    header = None
+    for row in rows:
+        if header is None:
+            header = list(row.keys())
+            ws.append(header)
+        ws.append(list(row.values()))
+
+
+def print_results(results, sheets, start=0):
+    """
+    Print the result rows from start on, and the extra worksheets
+    Args:
+        results: the result table
+        sheets: the rows of the extra worksheets keyed by title
+        start: the position of the first result row to print
+    """
+    print("\n--------------------")
+    for row in results.rows(start):
+        for header_value, cell_value in zip(RESULT_COLUMNS, row):
+            print(f"{header_value}: {cell_value}")
+        print("--------------------\n")
+    for title, rows in sheets.items():
+        print("\n==== {} ====".format(title))
+        print("\n--------------------")
+        for row in rows:
+            for header_value, cell_value in row.items():
+                print(f"{header_value}: {cell_value}")
+            print("--------------------\n")
+
+
+def save_results(path, results, sheets):
+    """
+    Write the result rows and the extra worksheets to an Excel file
+    The workbook is written in streaming mode, straight from the result
+    table, without building a cell object for every value.
+    Args:
+        path: the output file
+        results: the result table
+        sheets: the rows of the extra worksheets keyed by title
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("ClusterData")
+    if len(results):
+        ws.append(RESULT_COLUMNS)
+    for row in results:
+        ws.append(row)
+    for title, rows in sheets.items():
+        write_sheet(wb, title, rows)
+    wb.save(path)
+
+
+def collect_sheets(context):
+    """Get the rows of the extra worksheets of a run, keyed by title"""
+    sheets = {}
+    if context.shared_nodes:
+        sheets["SharedNodes"] = list(context.shared_nodes.values())
+    # The nodes shared by several sections are listed under every one of them
+    references = context.references
+    if context.slowlog:
+        sheets["SlowLog"] = list(context.slowlog.rows(references))
+    if context.probe:
+        sheets["Latency"] = list(context.probe.rows(references))
+    if context.commands is not None:
+        sheets["CommandStats"] = list(context.commands.rows(references))
+    if context.clients:
+        sheets["Clients"] = list(context.clients.rows(references))
+    if context.keyspace is not None:
+        sheets["Keyspace"] = list(context.keyspace.rows(references))
+    if context.prefixes:
+        sheets["KeyPrefixes"] = list(context.prefixes.rows(references))
+    if context.backlog:
+        sheets["PubSub"] = list(context.backlog.channel_rows(references))
+        sheets["Streams"] = list(context.backlog.stream_rows(references))
+    if context.bursts:
+        sheets["Bursts"] = list(context.bursts.rows(references))
+    if context.planner:
+        sheets["Capacity"] = list(context.planner.rows())
+    return sheets
+
+
+def load_results(path, results):
+    """
+    Append the rows of the ClusterData sheet of an output file to the result
+    table
+    Returns:
+        the number of rows loaded
+    """
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        rows = wb["ClusterData"].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        indexes = [
+            header.index(column) if column in header else None
+            for column in RESULT_COLUMNS
+        ]
+        count = 0
+        for row in rows:
+            results.append(
+                [
+                    "" if index is None or row[index] is None else row[index]
+                    for index in indexes
+                ]
+            )
+            count += 1
+    finally:
+        wb.close()
+    return count
+
+
+def write_results(results, args, context, start=0):
+    # The sheets of the worker processes, if any, come first
+    sheets = {}
+    for worker_sheets in context.worker_sheets.values():
+        for title, rows in worker_sheets.items():
+            sheets.setdefault(title, []).extend(rows)
+    for title, rows in collect_sheets(context).items():
+        sheets.setdefault(title, []).extend(rows)
+
+    if args.printOnly:
+        with TRACER.span("print"):
+            print_results(results, sheets, start)
+    else:
+        print("\nWriting output file {}".format(args.outputFile))
+        with TRACER.span("save"):
+            save_results(args.outputFile, results, sheets)
+
+
+def resume_results(results, args, context, finished):
+    """
+    Reload the rows of the intervals a resumed run already finished from
+    its output file
+    Args:
+        results: the result table of the run
+        args: the command line arguments
+        context: the state shared across the run
+        finished: the number of result rows at the end of every interval
+    """
+    print("Resuming after interval {}".format(len(finished)))
+    # The console output of the finished intervals is already out
+    if args.printOnly:
+        return
+    loaded = ResultTable()
+    if os.path.exists(args.outputFile):
+        load_results(args.outputFile, loaded)
+    if len(loaded) < finished[-1]:
+        print(
+            "{} doesn't hold the rows of the finished intervals, "
+            "they are left out".format(args.outputFile)
+        )
+        return
+    # The rows of the interrupted interval follow, the checkpoint has them
+    rows = list(loaded)[: finished[-1]]
+    results.extend(rows)
+    if context.planner:
+        for begin, end in zip([0] + finished, finished):
+            context.planner.add(rows[begin:end])
+
+
+def build_context(args):
+    """Build the state shared across a run out of the command line arguments"""
+    return RunContext(
+        slowlog=SlowlogHarvester(args.slowlogPoll) if args.slowlog else None,
+        command_cache=args.commandCache,
+        server_categories=not args.builtinCategories,
+        probe=(
+            LatencyProbe(args.probePings, args.probePipeline)
+            if args.latencyProbe
+            else None
+        ),
+        timeout=args.timeout,
+        retries=args.retries,
+        commands=CommandRateTable() if args.commandStats else None,
+        clients=ClientListSummary(args.clientTop) if args.clientList else None,
+        planner=(
+            CapacityPlanner(
+                CapacityModel(
+                    shard_ops=args.shardOps,
+                    shard_memory=args.shardMemory,
+                    headroom=args.headroom,
+                    write_cost=args.writeCost,
+                    eval_cost=args.evalCost,
+                    delivery_cost=args.deliveryCost,
+                )
+            )
+            if args.plan
+            else None
+        ),
+        keyspace=KeyspaceTable() if args.keyspace else None,
+        prefixes=(
+            KeyPrefixSampler(args.scanSample, args.scanBudget)
+            if args.keyPrefixes
+            else None
+        ),
+        backlog=(
+            BacklogCollector(rate=args.backlogRate, pattern=args.backlogChannels)
+            if args.backlog
+            else None
+        ),
+        bursts=(
+            BurstDetector(args.burstFactor, args.burstFastPoll, args.burstPoll)
+            if args.bursts
+            else None
+        ),
+    )
+
+
+def run_worker(connection, args, sections, index=0):
+    """
+    Sample a share of the config sections in a worker process, interval
+    after interval, as requested by the coordinator
+    Args:
+        connection: the pipe to the coordinator
+        args: the command line arguments
+        sections: the names of the config sections of the worker
+        index: the index of the worker
+    """
+    config = configparser.ConfigParser()
+    config.read(args.configFile)
+    context = build_context(args)
+    # The spans are sent along with the rows, and merged into the trace
+    if args.profileFile:
+        TRACER.enable()
+    # Planning and the progress bar are left to the coordinator
+    context.planner = None
+    context.progress = False
+    # Every worker journals the snapshots and results of its own nodes
+    path = checkpoint_path(args)
+    if path:
+        context.checkpoint = Checkpoint(worker_checkpoint(path, index), args.resume)
+    loop = asyncio.new_event_loop()
+    # None until the worker sampled an interval, a resumed worker must keep
+    # the snapshots it reloaded
+    sampled = None
+    try:
+        connection.send("ready")
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            interval, start_at, pending = message
+            # A new interval means the coordinator saved the previous one
+            if context.checkpoint and sampled is not None and interval != sampled:
+                context.checkpoint.compact(sampled)
+            context.interval = sampled = interval
+            time.sleep(max(start_at - time.time(), 0))
+            try:
+                rows = sample_databases(
+                    {section: config[section] for section in pending},
+                    args.duration,
+                    loop,
+                    context,
+                )
+            except Exception as e:
+                rows, sheets, error = None, {}, describe_error(e)
+            else:
+                sheets, error = collect_sheets(context), None
+            trace = TRACER.drain() if TRACER.enabled else None
+            connection.send((rows, sheets, error, trace))
+    except (KeyboardInterrupt, EOFError, BrokenPipeError):
+        pass
+    finally:
+        if context.checkpoint:
+            context.checkpoint.close()
+        loop.close()
+
+
+def checkpoint_path(args):
+    """Get the checkpoint file of a run, None when it isn't checkpointed"""
+    if args.checkpointFile or args.resume:
+        return args.checkpointFile or "{}.checkpoint".format(args.outputFile)
+    return None
+
+
+def worker_checkpoint(path, index):
+    """Get the checkpoint file of a worker process"""
+    return "{}.{}".format(path, index)
+
+
+class WorkerPool:
+    """
+    Local worker processes the config sections are partitioned across.
+    Every worker samples its sections in an event loop of its own and sends
+    the result rows back over a pipe. All of them open their window at the
+    same time, so the merged results cover the same period.
+    """
+
+    # Seconds given to the workers to receive a request before they start
+    START_DELAY = 0.5
+
+    def __init__(self, args, sections, workers):
+        spawn = multiprocessing.get_context("spawn")
+        self.workers = []
+        for index in range(min(workers, len(sections))):
+            share = sections[index::workers]
+            connection, child = spawn.Pipe()
+            process = spawn.Process(
+                target=run_worker, args=(child, args, share, index), daemon=True
+            )
+            process.start()
+            child.close()
+            self.workers.append((process, connection, share))
+        self.checkpoint = checkpoint_path(args)
+        for index in range(len(self.workers)):
+            self.receive(index)
+
+    def receive(self, index):
+        process, connection, share = self.workers[index]
+        try:
+            return connection.recv()
+        except (EOFError, OSError):
+            print(
+                "Worker {} stopped, not sampling {}".format(
+                    process.pid, ", ".join(share)
+                )
+            )
+            return None
+
+    def process_databases(self, configs, results, duration, loop, context):
+        """
+        Sample the passed sections in the worker processes, and append the
+        merged results to the result table as process_databases does
+        """
+        start_at = time.time() + self.START_DELAY
+        busy = []
+        for index, (process, connection, share) in enumerate(self.workers):
+            pending = [section for section in share if section in configs]
+            if not pending:
+                continue
+            try:
+                connection.send((context.interval, start_at, pending))
+            except OSError:
+                continue
+            busy.append(index)
+
+        async def wait():
+            replies = [asyncio.to_thread(self.receive, index) for index in busy]
+            return await asyncio.gather(*replies, progress(duration))
+
+        with TRACER.span("workers"):
+            replies = loop.run_until_complete(wait())
+
+        rows = {}
+        for index, reply in zip(busy, replies):
+            if reply is None:
+                continue
+            worker_rows, sheets, error, trace = reply
+            if trace:
+                TRACER.merge(trace, "worker {}".format(index))
+            if error:
+                print("Worker {} failed: {}".format(self.workers[index][0].pid, error))
+                continue
+            rows.update(worker_rows)
+            context.worker_sheets[index] = sheets
+
+        store_rows(
+            results,
+            {section: rows[section] for section in configs if section in rows},
+            context,
+        )
+        return results
+
+    def close(self, remove=False):
+        """
+        Stop the workers
+        Args:
+            remove: remove the checkpoints of the workers as well
+        """
+        for process, connection, _ in self.workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process, _, _ in self.workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        if remove and self.checkpoint:
+            for index in range(len(self.workers)):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(worker_checkpoint(self.checkpoint, index))
+
+
+def main():
+    if not sys.version_info >= (3, 9):
+        print("Please upgrade python to a version at least 3.9")
+        sys.exit(1)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--config",
+        dest="configFile",
         default="config.ini",
         help="The filename for configuration file. By default the script will try to open the config.ini file.",
         metavar="FILE",
@@ -860,8 +4310,304 @@ def main():
         action="store_true",
         help="Print results only in console",
     )
+    parser.add_argument(
+        "-i",
+        "--intervals",
+        type=int,
+        default=1,
+        help="Number of consecutive sampling windows. Use 0 to keep sampling until interrupted (continuous mode)",
+    )
+    parser.add_argument(
+        "--slowlog",
+        dest="slowlog",
+        action="store_true",
+        help="Harvest the SLOWLOG of every node during the sampling window",
+    )
+    parser.add_argument(
+        "--slowlog-poll",
+        dest="slowlogPoll",
+        type=int,
+        default=30,
+        help="Seconds between SLOWLOG harvests while the window is open. Defaults to 30",
+    )
+    parser.add_argument(
+        "--command-cache",
+        dest="commandCache",
+        default=".osstats_commands.json",
+        help="File the per Redis version command categories are cached in. Defaults to .osstats_commands.json",
+    )
+    parser.add_argument(
+        "--builtin-categories",
+        dest="builtinCategories",
+        action="store_true",
+        help="Use the built-in command categories instead of asking the servers",
+    )
+    parser.add_argument(
+        "--latency-probe",
+        dest="latencyProbe",
+        action="store_true",
+        help="Measure the RTT and pipelining throughput of every node from the collector",
+    )
+    parser.add_argument(
+        "--probe-pings",
+        dest="probePings",
+        type=int,
+        default=20,
+        help="PING calls per probe burst. Defaults to 20",
+    )
+    parser.add_argument(
+        "--probe-pipeline",
+        dest="probePipeline",
+        type=int,
+        default=50,
+        help="Pipelined PING calls per probe burst. Defaults to 50",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="Seconds a single call to a node may take. Defaults to 10",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="Number of times a failed call to a node is retried. Defaults to 2",
+    )
+    parser.add_argument(
+        "--command-stats",
+        dest="commandStats",
+        action="store_true",
+        help="Also report the rates of every single command in the CommandStats sheet",
+    )
+    parser.add_argument(
+        "--client-list",
+        dest="clientList",
+        action="store_true",
+        help="Also summarise the CLIENT LIST of every node in the Clients sheet",
+    )
+    parser.add_argument(
+        "--client-top",
+        dest="clientTop",
+        type=int,
+        default=20,
+        help="Number of client groups reported per node. Defaults to 20",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Recommend a shard count per cluster in the Capacity sheet",
+    )
+    parser.add_argument(
+        "--shard-ops",
+        dest="shardOps",
+        type=int,
+        default=25000,
+        help="Operations per second a shard sustains. Defaults to 25000",
+    )
+    parser.add_argument(
+        "--shard-memory",
+        dest="shardMemory",
+        type=float,
+        default=25,
+        help="Memory of a shard in GB. Defaults to 25",
+    )
+    parser.add_argument(
+        "--headroom",
+        type=float,
+        default=0.3,
+        help="Share of the shard capacity kept free. Defaults to 0.3",
+    )
+    parser.add_argument(
+        "--write-cost",
+        dest="writeCost",
+        type=float,
+        default=1.5,
+        help="Cost of a write relative to a read. Defaults to 1.5",
+    )
+    parser.add_argument(
+        "--eval-cost",
+        dest="evalCost",
+        type=float,
+        default=3,
+        help="Cost of a script call relative to a read. Defaults to 3",
+    )
+    parser.add_argument(
+        "--delivery-cost",
+        dest="deliveryCost",
+        type=float,
+        default=1,
+        help="Cost of a Pub/Sub message delivered to a subscriber relative to a read. Defaults to 1",
+    )
+    parser.add_argument(
+        "--keyspace",
+        action="store_true",
+        help="Also break the keyspace of every node down per database in the Keyspace sheet",
+    )
+    parser.add_argument(
+        "--key-prefixes",
+        dest="keyPrefixes",
+        action="store_true",
+        help="Also build a histogram of the key prefixes of every node with SCAN, in the KeyPrefixes sheet",
+    )
+    parser.add_argument(
+        "--scan-sample",
+        dest="scanSample",
+        type=float,
+        default=0.01,
+        help="Share of the keys of every database that is scanned over the run. Defaults to 0.01",
+    )
+    parser.add_argument(
+        "--scan-budget",
+        dest="scanBudget",
+        type=int,
+        default=10000,
+        help="Maximum number of keys scanned per node and window. Defaults to 10000",
+    )
+    parser.add_argument(
+        "--backlog",
+        action="store_true",
+        help="Also collect the subscribers of Pub/Sub channels and the consumer group backlog of streams",
+    )
+    parser.add_argument(
+        "--backlog-rate",
+        dest="backlogRate",
+        type=int,
+        default=1000,
+        help="Maximum number of commands per second sent to a node by --backlog. Defaults to 1000",
+    )
+    parser.add_argument(
+        "--backlog-channels",
+        dest="backlogChannels",
+        help="Only count the subscribers of the channels matching this pattern with --backlog, e.g. 'orders.*'. Defaults to all the channels",
+    )
+    parser.add_argument(
+        "--bursts",
+        action="store_true",
+        help="Also poll INFO stats during the window to find the bursts of traffic of every node and cluster",
+    )
+    parser.add_argument(
+        "--burst-factor",
+        dest="burstFactor",
+        type=float,
+        default=3,
+        help="Multiple of the baseline rate a burst goes above. Defaults to 3",
+    )
+    parser.add_argument(
+        "--burst-poll",
+        dest="burstPoll",
+        type=float,
+        default=10,
+        help="Seconds between two INFO stats polls while traffic is steady. Defaults to 10",
+    )
+    parser.add_argument(
+        "--burst-fast-poll",
+        dest="burstFastPoll",
+        type=float,
+        default=1,
+        help="Seconds between two INFO stats polls during a burst. Defaults to 1",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Split the config sections across this number of worker processes",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpointFile",
+        help="Checkpoint the run to this file, so that it can be resumed with --resume",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted run from its checkpoint. Defaults to the output file name followed by .checkpoint",
+    )
+    parser.add_argument(
+        "--history",
+        dest="historyFile",
+        help="SQLite file the results of every run are appended to",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profileFile",
+        help="Write a Chrome trace of the run phases, those of the workers included, to this file and print a summary",
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+    history_parser = subparsers.add_parser(
+        "history", help="Query the results stored with --history"
+    )
+    history_parser.add_argument(
+        "historyFile", metavar="FILE", help="The history store to query"
+    )
+    history_parser.add_argument(
+        "-m",
+        "--category",
+        default="Throughput (Ops)",
+        help="The category to query. Defaults to Throughput (Ops)",
+    )
+    history_parser.add_argument(
+        "-p",
+        "--percentile",
+        type=int,
+        default=95,
+        help="The percentile to compute. Defaults to 95",
+    )
+    history_parser.add_argument(
+        "--days",
+        type=float,
+        default=30,
+        help="Only use the samples of the last days. Defaults to 30, 0 uses all",
+    )
+    history_parser.add_argument("--cluster", help="Only query this cluster")
+    history_parser.add_argument(
+        "--role", choices=["Master", "Replica"], help="Only use nodes with this role"
+    )
+    history_parser.add_argument(
+        "--agg",
+        choices=["sum", "max", "avg"],
+        default="sum",
+        help="How the nodes of a cluster are aggregated per sample. Defaults to sum",
+    )
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare the results of two runs node by node"
+    )
+    compare_parser.add_argument(
+        "before", help="The results file (or history run id) to compare from"
+    )
+    compare_parser.add_argument(
+        "after", help="The results file (or history run id) to compare to"
+    )
+    compare_parser.add_argument(
+        "--history",
+        dest="historyStore",
+        metavar="FILE",
+        help="Compare two runs recorded in this history store instead of two files",
+    )
+    compare_parser.add_argument(
+        "-o",
+        "--output-file",
+        dest="outputFile",
+        default="OSStats-compare.xlsx",
+        help="Name of file the comparison is written to. Defaults to OSStats-compare.xlsx",
+    )
+    compare_parser.add_argument(
+        "-po",
+        "--print-only",
+        dest="printOnly",
+        action="store_true",
+        help="Print the comparison only in console",
+    )
     args = parser.parse_args()
 
+    if args.command == "history":
+        query_history(args)
+        return
+    if args.command == "compare":
+        run_compare(args)
+        return
+
     if not os.path.isfile(args.configFile):
         print("Can't find the specified {} configuration file".format(args.configFile))
         sys.exit(1)
@@ -874,27 +4620,86 @@ def main():
         )
         sys.exit(1)
 
+    if args.intervals < 0:
+        print("Invalid number of intervals specified")
+        sys.exit(1)
+
     # Open and parse the configuration file.
     config = configparser.ConfigParser()
     config.read(args.configFile)
 
     print("The output will be stored in {}".format(args.outputFile))
 
-    wb = create_workbook()
+    results = ResultTable()
     loop = asyncio.get_event_loop()
 
     #   loop = asyncio.new_event_loop()
     #   asyncio.set_event_loop(loop)
 
-    for section in config.sections():
-        wb = process_database(config[section], section, wb, args.duration, loop)
+    context = build_context(args)
+
+    if args.historyFile:
+        context.history = HistoryStore(args.historyFile)
+    if args.profileFile:
+        TRACER.enable()
+
+    checkpoint = None
+    if checkpoint_path(args):
+        checkpoint = context.checkpoint = Checkpoint(checkpoint_path(args), args.resume)
+
+    pool = None
+    if args.workers > 1:
+        print("Starting {} worker processes".format(args.workers))
+        pool = WorkerPool(args, config.sections(), args.workers)
+
+    interval = 0
+    start = 0
+    remove = True
+    if checkpoint and checkpoint.finished:
+        interval = len(checkpoint.finished)
+        resume_results(results, args, context, checkpoint.finished)
+    try:
+        while args.intervals == 0 or interval < args.intervals:
+            interval += 1
+            context.interval = interval
+            start = len(results)
+
+            # Sections completed before a resumed run stopped are not sampled again
+            completed = checkpoint.completed(interval) if checkpoint else {}
+            for section in config.sections():
+                results.extend(completed.get(section, []))
+                if context.planner and section in completed:
+                    context.planner.add(completed[section])
+            pending = {
+                section: config[section]
+                for section in config.sections()
+                if section not in completed
+            }
+            if pending and pool:
+                pool.process_databases(pending, results, args.duration, loop, context)
+            elif pending:
+                process_databases(pending, results, args.duration, loop, context)
+            write_results(results, args, context, start)
+            if checkpoint:
+                checkpoint.compact(interval, len(results))
+    except KeyboardInterrupt:
+        print("\nInterrupted, stopping after {} interval(s)".format(interval - 1))
+        write_results(results, args, context, start)
+        if checkpoint and args.intervals != 0:
+            print("Use --resume to continue the run from its checkpoint")
+            remove = False
+    if checkpoint:
+        checkpoint.close(remove=remove)
+    if pool:
+        pool.close(remove=remove)
+    if context.history:
+        context.history.close()
     loop.close()
 
-    if args.printOnly:
-        print_results(wb)
-    else:
-        print("\nWriting output file {}".format(args.outputFile))
-        wb.save(args.outputFile)
+    if args.profileFile:
+        TRACER.save(args.profileFile)
+        print("\nProfile written to {}".format(args.profileFile))
+        print("\n".join(TRACER.summary()))
 
     print("Done!")
 
@@ -1,18 +1,71 @@
 import pytest
 import redis
+import openpyxl
 from unittest.mock import Mock, patch, MagicMock
 import configparser
 import asyncio
+import time
+import threading
+import multiprocessing
+import io
+import itertools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from osstats import (
     get_value,
     native_str,
     parse_response,
-    create_workbook,
     get_command_by_args,
     get_redis_client,
     process_node,
     process_database,
     main,
+    index_categories,
+    SlowlogHarvester,
+    RunContext,
+    write_sheet,
+    build_command_categories,
+    get_command_categories,
+    COMMAND_CATEGORIES,
+    percentile,
+    discount_commands,
+    LatencyProbe,
+    call_with_deadline,
+    DEADLINE_EXECUTOR,
+    RESULT_COLUMNS,
+    CommandRateTable,
+    normalize_address,
+    identify_targets,
+    process_databases,
+    Checkpoint,
+    HistoryStore,
+    iter_result_file,
+    aggregate_samples,
+    welch_test,
+    compare_results,
+    Tracer,
+    discover_databases,
+    ClientListSummary,
+    CapacityModel,
+    CapacityPlanner,
+    WorkerPool,
+    run_worker,
+    ResultRow,
+    ResultTable,
+    SpaceSaving,
+    KeyspaceTable,
+    KeyPrefixSampler,
+    BacklogCollector,
+    stream_pubsub_channels,
+    BurstDetector,
+    BurstTracker,
+    ClusterRates,
+    sum_rates,
+    save_results,
+    resume_results,
+    store_rows,
+    collect_sheets,
 )
 
 
@@ -72,13 +125,6 @@ class TestParseResponse:
         assert "invalid_line_without_colon" in result["__raw__"]
 
 
-class TestCreateWorkbook:
-    def test_create_workbook(self):
-        wb = create_workbook()
-        assert wb is not None
-        assert wb.active.title == "ClusterData"
-
-
 class TestGetCommandByArgs:
     def test_get_command_by_args(self):
         cmds1 = {"cmdstat_get": {"calls": 100}, "cmdstat_set": {"calls": 50}}
@@ -158,14 +204,19 @@ class TestProcessNode:
             "connected_clients": 10,
             "cluster_enabled": 0,
             "total_commands_processed": 1000,
+            "total_connections_received": 50,
+            "blocked_clients": 2,
             "db0": {"keys": 100, "expires": 0},
         }
         mock_info_dict2 = mock_info_dict.copy()
         mock_info_dict2["total_commands_processed"] = 1200
+        mock_info_dict2["total_connections_received"] = 80
 
         mock_client.execute_command.side_effect = [
             "cmdstat_get:calls=100,usec=1000",  # First commandstats
             mock_info_dict,  # First info - return dict directly
+            "cmdstat_get:calls=120,usec=1200",  # Halfway commandstats
+            mock_info_dict,  # Halfway info
             "cmdstat_get:calls=150,usec=1500",  # Second commandstats
             mock_info_dict2,  # Second info - return dict directly
         ]
@@ -173,6 +224,7 @@ class TestProcessNode:
         # Mock parse_response to return proper dictionaries
         mock_parse.side_effect = [
             {"cmdstat_get": {"calls": 100, "usec": 1000}},
+            {"cmdstat_get": {"calls": 120, "usec": 1200}},
             {"cmdstat_get": {"calls": 150, "usec": 1500}},
         ]
 
@@ -182,6 +234,1644 @@ class TestProcessNode:
         assert result["Source"] == "OSS"
         assert result["ClusterId"] == "test-section"
         assert result["NodeRole"] == "Master"
+        assert result["Status"] == "ok"
+        assert result["Connections/sec"] == 0.5
+        assert result["RejectedConnections/sec"] == 0
+        assert result["BlockedClients"] == 2
+        assert list(result.keys()) == RESULT_COLUMNS
+
+    @staticmethod
+    def mock_config():
+        config = Mock()
+        config.get.side_effect = lambda key, default=None, fallback=None: {
+            "host": "localhost",
+            "port": "6379",
+        }.get(key, fallback or default)
+        config.getboolean.return_value = False
+        return config
+
+    @pytest.mark.asyncio
+    @patch("osstats.get_redis_client")
+    @patch("osstats.sleep")
+    async def test_process_node_missed_second_snapshot(
+        self, mock_sleep, mock_get_client
+    ):
+        mock_client = Mock()
+        mock_get_client.return_value = mock_client
+        info = {
+            "redis_version": "6.2.0",
+            "os": "Linux",
+            "total_system_memory": 8589934592,
+            "used_memory_peak": 1048576,
+            "connected_clients": 10,
+            "cluster_enabled": 0,
+            "total_commands_processed": 1000,
+        }
+        mock_client.execute_command.side_effect = [
+            "cmdstat_get:calls=100,usec=1000",
+            info,
+        ] + [redis.ConnectionError("Connection refused")] * 4
+
+        result = await process_node(
+            "test-section", self.mock_config(), "localhost:6379", True, 1
+        )
+
+        assert result["Status"] == "partial"
+        assert "Connection refused" in result["Error"]
+        assert result["RedisVersion"] == "6.2.0"
+        assert result["Throughput (Ops)"] == ""
+
+    @pytest.mark.asyncio
+    @patch("osstats.get_redis_client")
+    @patch("osstats.sleep")
+    async def test_process_node_falls_back_to_halfway_snapshot(
+        self, mock_sleep, mock_get_client
+    ):
+        mock_client = Mock()
+        mock_get_client.return_value = mock_client
+        info = {
+            "redis_version": "6.2.0",
+            "os": "Linux",
+            "total_system_memory": 8589934592,
+            "used_memory_peak": 1048576,
+            "connected_clients": 10,
+            "cluster_enabled": 0,
+            "total_commands_processed": 1000,
+        }
+        mock_client.execute_command.side_effect = [
+            "cmdstat_get:calls=100,usec=1000",
+            info,
+            "cmdstat_get:calls=400,usec=4000",
+            dict(info, total_commands_processed=4000),
+        ] + [redis.ConnectionError("Connection refused")] * 3
+
+        result = await process_node(
+            "test-section", self.mock_config(), "localhost:6379", True, 1
+        )
+
+        # The rates are measured over the first half of the window
+        assert result["Status"] == "partial"
+        assert "Connection refused" in result["Error"]
+        assert result["Throughput (Ops)"] == 100
+        assert result["GetTypeCmds"] == 10
+
+    @pytest.mark.asyncio
+    @patch("osstats.get_redis_client")
+    @patch("osstats.sleep")
+    async def test_process_node_unreachable(self, mock_sleep, mock_get_client):
+        mock_client = Mock()
+        mock_get_client.return_value = mock_client
+        mock_client.execute_command.side_effect = redis.TimeoutError("Timeout")
+
+        result = await process_node(
+            "test-section", self.mock_config(), "localhost:6379", False, 1
+        )
+
+        assert result["Status"] == "error"
+        assert result["NodeRole"] == "Replica"
+        assert mock_client.execute_command.call_count == 3
+
+
+class TestCallWithDeadline:
+    @pytest.mark.asyncio
+    @patch("osstats.sleep")
+    async def test_call_with_deadline_retries(self, mock_sleep):
+        fn = Mock(side_effect=[redis.ConnectionError(), "PONG"])
+        assert await call_with_deadline(fn, deadline=1, retries=1) == "PONG"
+        mock_sleep.assert_called_once_with(0.5)
+
+    @pytest.mark.asyncio
+    async def test_call_with_deadline_times_out(self):
+        with pytest.raises(asyncio.TimeoutError):
+            await call_with_deadline(
+                lambda: __import__("time").sleep(0.2), deadline=0.01
+            )
+
+    @pytest.mark.asyncio
+    async def test_call_with_deadline_starts_when_running(self):
+        # The second call waits for the only thread, but its deadline starts
+        # once it runs
+        executor = ThreadPoolExecutor(1)
+        token = DEADLINE_EXECUTOR.set(executor)
+        try:
+            calls = [
+                call_with_deadline(time.sleep, 0.2, deadline=0.3) for _ in range(2)
+            ]
+            await asyncio.gather(*calls)
+        finally:
+            DEADLINE_EXECUTOR.reset(token)
+            executor.shutdown()
+
+
+class TestIndexCategories:
+    def test_index_categories(self):
+        index = index_categories({"A": ("get", "sort"), "B": ("set", "sort")})
+        assert index == {"get": ["A"], "set": ["B"], "sort": ["A", "B"]}
+
+
+class TestSlowlogHarvester:
+    @staticmethod
+    def entry(entry_id, command, duration):
+        return {
+            "id": entry_id,
+            "start_time": 0,
+            "duration": duration,
+            "command": command,
+        }
+
+    def test_harvest_ignores_entries_before_window(self):
+        client = Mock()
+        client.slowlog_get.return_value = [self.entry(4, "GET a", 100)]
+        harvester = SlowlogHarvester()
+
+        assert harvester.harvest(client, "db", "node:1") == 0
+        assert list(harvester.rows()) == []
+
+    def test_harvest_only_new_entries(self):
+        client = Mock()
+        harvester = SlowlogHarvester()
+        client.slowlog_get.return_value = [self.entry(4, "GET a", 100)]
+        harvester.harvest(client, "db", "node:1")
+
+        client.slowlog_get.side_effect = [
+            [self.entry(6, "HSET h f v", 500)],
+            [self.entry(6, "HSET h f v", 500), self.entry(5, "GET b", 300)],
+        ]
+        assert harvester.harvest(client, "db", "node:1") == 2
+        client.slowlog_get.assert_called_with(2)
+
+        rows = list(harvester.rows())
+        commands = [row for row in rows if row["Type"] == "Command"]
+        assert [row["Name"] for row in commands] == ["hset", "get"]
+        categories = {row["Name"]: row for row in rows if row["Type"] == "Category"}
+        assert categories["HashBasedCmds"]["MaxDuration (us)"] == 500
+        assert categories["GetTypeCmds"]["Count"] == 1
+
+        # Nothing new since the previous harvest
+        client.slowlog_get.side_effect = [[self.entry(6, "HSET h f v", 500)]]
+        assert harvester.harvest(client, "db", "node:1") == 0
+
+    def test_harvest_counts_wrapped_entries(self):
+        client = Mock()
+        harvester = SlowlogHarvester(max_entries=2)
+        client.slowlog_get.return_value = [self.entry(1, "GET a", 100)]
+        harvester.harvest(client, "db", "node:1")
+
+        client.slowlog_get.side_effect = [
+            [self.entry(10, "GET a", 100)],
+            [self.entry(10, "GET a", 100), self.entry(9, "GET a", 200)],
+        ]
+        assert harvester.harvest(client, "db", "node:1") == 2
+        assert next(harvester.rows())["MissedEntries"] == 7
+
+    @pytest.mark.asyncio
+    async def test_poll_is_bounded_by_the_deadline(self):
+        client = Mock()
+        harvester = SlowlogHarvester()
+        client.slowlog_get.return_value = [self.entry(1, "GET a", 100)]
+        await harvester.poll(client, "db", "node:1")
+        client.slowlog_get.return_value = [self.entry(2, "GET a", 200)]
+        assert await harvester.poll(client, "db", "node:1") == 1
+
+        # An unreachable node doesn't hold the event loop up
+        client.slowlog_get.side_effect = lambda count: time.sleep(0.5)
+        started = time.monotonic()
+        ticks = []
+
+        async def tick():
+            for _ in range(5):
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        polled, _ = await asyncio.gather(
+            harvester.poll(client, "db", "node:1", deadline=0.1), tick()
+        )
+        assert polled == 0
+        assert time.monotonic() - started < 0.4
+        assert ticks[-1] - started < 0.1
+
+    @pytest.mark.asyncio
+    async def test_poll_past_deadline_keeps_entries(self):
+        client = Mock()
+        harvester = SlowlogHarvester()
+        client.slowlog_get.return_value = [self.entry(1, "GET a", 100)]
+        await harvester.poll(client, "db", "node:1")
+
+        def late(count):
+            time.sleep(0.3)
+            return [self.entry(2, "GET a", 200)]
+
+        # The entries of a call that ran past its deadline are fetched again
+        client.slowlog_get.side_effect = late
+        assert await harvester.poll(client, "db", "node:1", deadline=0.1) == 0
+        await asyncio.sleep(0.3)
+        client.slowlog_get.side_effect = None
+        client.slowlog_get.return_value = [self.entry(2, "GET a", 200)]
+        assert await harvester.poll(client, "db", "node:1") == 1
+
+
+class TestBuildCommandCategories:
+    REPLY = [
+        ["get", 2, ["readonly", "fast"], 1, 1, 1, ["@read", "@string", "@fast"]],
+        ["sort", -2, ["write", "denyoom"], 1, 1, 1, ["@write", "@set", "@slow"]],
+        ["eval", -3, ["noscript"], 0, 0, 0, ["@slow", "@scripting"]],
+        ["json.get", -2, ["readonly", "module"], 1, 1, 1, []],
+        [
+            "cluster",
+            -2,
+            [],
+            0,
+            0,
+            0,
+            ["@slow"],
+            [],
+            [],
+            [["cluster|info", 2, ["stale"], 0, 0, 0, ["@slow"]]],
+        ],
+    ]
+
+    def test_build_command_categories(self):
+        table = build_command_categories(self.REPLY)
+        assert table["GetTypeCmds"] == ("get", "json.get")
+        assert table["SetTypeCmds"] == ("sort",)
+        assert table["StringBasedCmds"] == ("get",)
+        assert table["EvalBasedCmds"] == ("eval",)
+        assert table["OtherTypeCmds"] == ("eval", "cluster", "cluster|info")
+        assert table["ClusterBasedCmds"] == ("cluster", "cluster|info")
+        assert list(table.keys()) == list(COMMAND_CATEGORIES.keys())
+
+    def test_build_command_categories_without_acl(self):
+        assert build_command_categories([["get", 2, ["readonly"], 1, 1, 1]]) is None
+
+
+class TestGetCommandCategories:
+    @patch("osstats.execute_raw")
+    def test_get_command_categories_cached(self, mock_raw, tmp_path):
+        client = Mock()
+        client.execute_command.return_value = {
+            "modules": [{"name": "ReJSON", "ver": 20000}]
+        }
+        mock_raw.return_value = TestBuildCommandCategories.REPLY
+        cache_file = str(tmp_path / "commands.json")
+        info = {"redis_version": "7.0.0"}
+
+        table = get_command_categories(client, info, cache_file, {})
+        assert table["GetTypeCmds"] == ("get", "json.get")
+
+        # A fresh run reads the table from the disk cache
+        memo = {}
+        table = get_command_categories(client, info, cache_file, memo)
+        assert mock_raw.call_count == 1
+        assert list(table["GetTypeCmds"]) == ["get", "json.get"]
+        assert list(memo) == ["7.0.0|ReJSON:20000"]
+
+    @patch("osstats.execute_raw")
+    def test_get_command_categories_fallback(self, mock_raw):
+        client = Mock()
+        client.execute_command.return_value = {}
+        mock_raw.side_effect = redis.ResponseError("unknown command")
+
+        table = get_command_categories(client, {"redis_version": "5.0.0"})
+        assert table is COMMAND_CATEGORIES
+
+
+class TestPercentile:
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile(values, 100) == 100
+        assert percentile([7], 99) == 7
+        assert percentile([], 50) is None
+
+
+class TestDiscountCommands:
+    def test_discount_commands(self):
+        cmds = {"cmdstat_ping": {"calls": 120, "usec": 10}}
+        info = {"total_commands_processed": 1000}
+        discount_commands(cmds, info, {"ping": 100, "info": 2})
+        assert cmds["cmdstat_ping"]["calls"] == 20
+        assert info["total_commands_processed"] == 898
+
+    def test_discount_subcommand_of_older_server(self):
+        # Servers older than Redis 7 only report the parent command
+        cmds = {"cmdstat_pubsub": {"calls": 10, "usec": 10}}
+        info = {"total_commands_processed": 100}
+        discount_commands(cmds, info, {"pubsub|numsub": 4})
+        assert cmds["cmdstat_pubsub"]["calls"] == 6
+        assert info["total_commands_processed"] == 96
+
+
+class TestLatencyProbe:
+    @pytest.mark.asyncio
+    @patch("osstats.sleep")
+    async def test_watch(self, mock_sleep):
+        client = MagicMock()
+        probe = LatencyProbe(pings=4, pipeline=10, bursts=2)
+
+        issued = await probe.watch(client, "db", "node:1", 60)
+
+        assert issued == 28
+        assert client.ping.call_count == 8
+        assert client.pipeline.return_value.ping.call_count == 20
+        mock_sleep.assert_called_with(20)
+        row = next(probe.rows())
+        assert row["ClusterId"] == "db"
+        assert row["Samples"] == 8
+        assert row["RttP50 (ms)"] <= row["RttP99 (ms)"] <= row["RttMax (ms)"]
+
+
+class TestKeyspace:
+    def test_space_saving(self):
+        sketch = SpaceSaving(capacity=2)
+        for item in ["a", "a", "b", "a", "c", "a"]:
+            sketch.add(item)
+
+        # c took the place of b and inherited its count
+        assert sketch.top() == [("a", 4, 0), ("c", 2, 1)]
+
+    def test_keyspace_table(self):
+        table = KeyspaceTable()
+        info1 = {"db0": {"keys": 100, "expires": 10, "avg_ttl": 5000}}
+        info2 = {
+            "db0": {"keys": 120, "expires": 15, "avg_ttl": 4000},
+            "db10": {"keys": 3, "expires": 0, "avg_ttl": 0},
+        }
+        table.add("db", "10.0.0.1:6379", info1, info2)
+
+        rows = list(table.rows())
+        assert [row["Db"] for row in rows] == [0, 10]
+        assert rows[0]["KeysChange"] == 20
+        assert rows[0]["ExpiresChange"] == 5
+        assert rows[0]["AvgTtl (s)"] == 4
+        assert rows[0]["AvgTtlChange (s)"] == -1
+        assert rows[1]["KeysChange"] == 3
+
+    @pytest.mark.asyncio
+    @patch("osstats.sleep")
+    async def test_key_prefix_sampler(self, mock_sleep):
+        sampler = KeyPrefixSampler(sample=0.5, budget=4, count=2)
+        pages = {
+            0: (7, ["user:1", "user:2"]),
+            7: (9, ["session:1", "user:3"]),
+            9: (0, ["counter", "user:4"]),
+        }
+        calls = []
+
+        def scan(client, db, cursor):
+            calls.append((db, cursor))
+            return pages[cursor]
+
+        sampler.scan = scan
+        info = {"db0": {"keys": 12}, "db1": {"keys": 0}}
+
+        issued = await sampler.watch(Mock(), "db", "10.0.0.1:6379", 60, info)
+        assert issued == {"scan": 2, "select": 0}
+        mock_sleep.assert_called_with(20)
+
+        # The next window carries on where the budget stopped the scan
+        issued = await sampler.watch(Mock(), "db", "10.0.0.1:6379", 60, info)
+        assert calls == [(0, 0), (0, 7), (0, 9)]
+        assert issued == {"scan": 1, "select": 0}
+
+        rows = list(sampler.rows())
+        assert [(row["Prefix"], row["SampledKeys"]) for row in rows] == [
+            ("user:", 4),
+            ("session:", 1),
+            ("(none)", 1),
+        ]
+        # The scan reached the end of the database, counts are exact
+        assert rows[0]["EstimatedKeys"] == 4
+        assert rows[0]["ScannedKeys"] == 6
+
+    def test_scan_selects_database(self):
+        client = Mock()
+        connection = client.connection_pool.get_connection.return_value
+        connection.read_response.side_effect = ["OK", ["5", ["a:1"]], "OK"]
+
+        cursor, keys = KeyPrefixSampler().scan(client, 2, 0)
+
+        assert (cursor, keys) == (5, ["a:1"])
+        assert [call.args for call in connection.send_command.call_args_list] == [
+            ("SELECT", 2),
+            ("SCAN", 0, "COUNT", 100),
+            ("SELECT", 0),
+        ]
+        client.connection_pool.release.assert_called_with(connection)
+
+
+class TestBacklogCollector:
+    @pytest.mark.asyncio
+    @patch("osstats.stream_pubsub_channels")
+    @patch("osstats.sleep")
+    async def test_watch(self, mock_sleep, mock_channels):
+        client = MagicMock()
+        mock_channels.return_value = iter(["news", "chat", "alerts"])
+        client.scan.return_value = (0, ["orders"])
+        pipe = client.pipeline.return_value
+        pipe.execute.side_effect = [
+            # Both NUMSUB calls go in one pipeline
+            [[("news", 1), ("chat", 5)], redis.ResponseError("ERR")],
+            [[{"name": "billing", "consumers": 2, "pending": 7, "lag": 40}]],
+        ]
+        backlog = BacklogCollector(top=1, batch=2)
+
+        issued = await backlog.watch(client, "db", "node:1")
+
+        assert issued == {
+            "pubsub|channels": 1,
+            "pubsub|numsub": 2,
+            "scan": 1,
+            "xinfo|groups": 1,
+        }
+        pipe.pubsub_numsub.assert_any_call("news", "chat")
+        pipe.pubsub_numsub.assert_any_call("alerts")
+        assert list(backlog.channel_rows()) == [
+            {"ClusterId": "db", "NodeId": "node", "Channel": "chat", "Subscribers": 5}
+        ]
+        # 6 subscribers over the 2 channels that answered
+        assert backlog.deliveries("db", "node:1", 10) == 30
+        assert list(backlog.stream_rows()) == [
+            {
+                "ClusterId": "db",
+                "NodeId": "node",
+                "Stream": "orders",
+                "Group": "billing",
+                "Consumers": 2,
+                "Pending": 7,
+                "Lag": 40,
+            }
+        ]
+
+        # The walk over the streams isn't repeated once it reached the end
+        pipe.execute.side_effect = [
+            [[{"name": "billing", "consumers": 2, "pending": 0, "lag": 0}]],
+        ]
+        mock_channels.return_value = iter([])
+        issued = await backlog.watch(client, "db", "node:1")
+        assert client.scan.call_count == 1
+        assert issued == {"pubsub|channels": 1, "xinfo|groups": 1}
+
+    @pytest.mark.asyncio
+    @patch("osstats.stream_pubsub_channels")
+    async def test_watch_error(self, mock_channels):
+        client = MagicMock()
+        mock_channels.side_effect = redis.ConnectionError("down")
+        backlog = BacklogCollector()
+
+        assert await backlog.watch(client, "db", "node:1") == {}
+        assert backlog.deliveries("db", "node:1", 10) == 0
+
+    def test_stream_pubsub_channels(self):
+        client = Mock()
+        connection = client.connection_pool.get_connection.return_value
+        connection.encoder.decode.side_effect = lambda value: value.decode()
+        reply = b"*3\r\n$4\r\nnews\r\n$4\r\nchat\r\n$6\r\nalerts\r\n"
+        connection._sock.makefile.return_value = io.BytesIO(reply)
+
+        assert list(stream_pubsub_channels(client, "*s")) == ["news", "chat", "alerts"]
+        connection.send_command.assert_called_with("PUBSUB", "CHANNELS", "*s")
+        connection.disconnect.assert_not_called()
+
+        # The rest of the reply isn't read, the connection is dropped instead
+        connection._sock.makefile.return_value = io.BytesIO(reply)
+        channels = stream_pubsub_channels(client)
+        assert list(itertools.islice(channels, 2)) == ["news", "chat"]
+        channels.close()
+        connection.disconnect.assert_called_once()
+        client.connection_pool.release.assert_called_with(connection)
+
+
+class TestBurstDetector:
+    def test_sum_rates(self):
+        series = [
+            [(0, 10, 100, 100), (10, 20, 200, 300)],
+            [(5, 15, 50, 50)],
+        ]
+        assert list(sum_rates(series)) == [
+            (0, 5, 100, 100),
+            (5, 10, 150, 150),
+            (10, 15, 250, 350),
+            (15, 20, 200, 300),
+        ]
+
+    @pytest.mark.asyncio
+    @patch("osstats.sleep")
+    async def test_watch(self, mock_sleep):
+        # 100 ops/sec, and 1000 ops/sec between 30 and 40 seconds in
+        origin = 1_000_000
+        clock = [origin]
+
+        async def advance(seconds):
+            clock[0] += seconds
+
+        def info(section):
+            assert section == "stats"
+            at = clock[0] - origin
+            return {
+                "total_commands_processed": 100 * at + 900 * max(0, min(at, 40) - 30),
+                "instantaneous_ops_per_sec": 1200 if at == 40 else 100,
+            }
+
+        mock_sleep.side_effect = advance
+        client = Mock()
+        client.info.side_effect = info
+        detector = BurstDetector(factor=3, fast=1, slow=10)
+
+        with patch("osstats.time.time", side_effect=lambda: clock[0]):
+            issued = await detector.watch(client, "db", "10.0.0.1:6379", 60)
+
+        # Polled faster while the burst was open, slower once it was over
+        assert [call.args[0] for call in mock_sleep.call_args_list] == [
+            10,
+            10,
+            10,
+            10,
+            1,
+            10,
+            9,
+        ]
+        assert issued == {"info": 8}
+        assert detector.summary("db", "10.0.0.1:6379") == (1200, 1)
+
+        rows = list(detector.rows())
+        assert [row["Scope"] for row in rows] == ["Node", "Cluster"]
+        for row in rows:
+            assert row["Start"] == time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(origin + 30)
+            )
+            assert row["Duration (s)"] == 10
+            assert row["PeakOps"] == 1200
+            assert row["BaselineOps"] == 100
+            assert row["Multiple"] == 12
+        assert rows[0]["NodeId"] == "10-0-0-1"
+
+    def test_tracker_follows_step_up(self):
+        tracker = BurstTracker(factor=3, window=4, min_ops=0, max_bursts=2)
+        for at in range(3):
+            assert not tracker.add(at, at + 1, 100)
+        # Four readings above the baseline are a new level, not a burst
+        assert [tracker.add(at, at + 1, 1000) for at in range(3, 7)] == [
+            True,
+            True,
+            True,
+            False,
+        ]
+        assert tracker.level() == 1000
+        assert not tracker.add(7, 8, 1000)
+        assert tracker.all() == [
+            {"start": 3, "end": 7, "peak": 1000, "baseline": 100},
+        ]
+
+        # Only the last bursts are kept
+        for at in range(8, 20, 2):
+            tracker.add(at, at + 1, 5000)
+            tracker.add(at + 1, at + 2, 1000)
+        assert [burst["start"] for burst in tracker.all()] == [16, 18]
+
+    def test_cluster_rates(self):
+        tracker = Mock(window=30)
+        rates = ClusterRates(tracker)
+        rates.join("n1", 0)
+        rates.join("n2", 5)
+        assert tracker.window == 60
+
+        # A reading is summed once every node reported past it
+        rates.add("n1", 0, 10, 100, 100)
+        rates.add("n2", 5, 15, 50, 50)
+        rates.add("n1", 10, 20, 200, 300)
+        assert [call.args for call in tracker.add.call_args_list] == [
+            (0, 5, 100, 100),
+            (5, 10, 150, 150),
+            (10, 15, 250, 350),
+        ]
+        assert rates.pending == {"n1": [(15, 20, 200, 300)], "n2": []}
+
+    def test_cluster_rates_stop_waiting(self):
+        tracker = Mock(window=30)
+        rates = ClusterRates(tracker, history=2)
+        rates.join("n1", 0)
+        rates.join("n2", 0)
+        for at in range(3):
+            rates.add("n1", at, at + 1, 100, 100)
+        # n2 fell behind, the readings of n1 are summed without it
+        assert tracker.add.call_count == 3
+        assert rates.pending["n1"] == []
+
+    @pytest.mark.asyncio
+    async def test_watch_error(self):
+        client = Mock()
+        client.info.side_effect = redis.ConnectionError("down")
+        detector = BurstDetector()
+
+        assert await detector.watch(client, "db", "10.0.0.1:6379", 60) == {"info": 0}
+        assert detector.summary("db", "10.0.0.1:6379") == ("", 0)
+        assert list(detector.rows()) == []
+
+
+class TestCommandRateTable:
+    def test_add_keeps_only_changed_commands(self):
+        table = CommandRateTable()
+        cmds1 = {
+            "cmdstat_get": {"calls": 100, "usec": 1000},
+            "cmdstat_set": {"calls": 50, "usec": 500},
+            "cmdstat_del": {"calls": 5, "usec": 50, "failed_calls": 1},
+        }
+        cmds2 = {
+            "cmdstat_get": {"calls": 160, "usec": 1600},
+            "cmdstat_set": {"calls": 50, "usec": 500},
+            "cmdstat_del": {"calls": 5, "usec": 50, "failed_calls": 4},
+            "cmdstat_hset": {"calls": 30, "usec": 900, "rejected_calls": 6},
+            "total_commands_processed": 1000,
+        }
+        table.add("db", "10.0.0.1:6379", cmds1, cmds2, 60)
+        table.add("db", "10.0.0.2:6379", cmds1, cmds2, 60)
+
+        assert table.names == ["get", "del", "hset"]
+        assert len(table.entries) == 6
+        rows = list(table.rows())
+        assert rows[0] == {
+            "ClusterId": "db",
+            "NodeId": "10-0-0-1",
+            "Command": "get",
+            "Calls/sec": 1.0,
+            "Usec/call": 10.0,
+            "Rejected/sec": 0.0,
+            "Failed/sec": 0.0,
+        }
+        assert rows[1]["Failed/sec"] == 0.05
+        assert rows[2]["Rejected/sec"] == 0.1
+
+
+class TestClientListSummary:
+    @staticmethod
+    def mock_client(reply):
+        client = Mock()
+        connection = client.connection_pool.get_connection.return_value
+        connection._sock.makefile.return_value = io.BytesIO(reply)
+        return client, connection
+
+    def test_sample_groups_clients(self):
+        lines = (
+            b"id=1 addr=10.0.0.1:5001 name=web idle=3 qbuf=10 omem=0 tot-mem=100 cmd=get\n"
+            b"id=2 addr=10.0.0.1:5002 name=web idle=9 qbuf=0 omem=50 tot-mem=200 cmd=get\n"
+            b"id=3 addr=10.0.0.2:5003 name=job idle=1 qbuf=0 omem=0 tot-mem=100 cmd=blpop\n"
+            b"id=4 addr=10.0.0.3:5004 name= idle=1 qbuf=0 omem=7 tot-mem=100 cmd=set\n"
+        )
+        client, connection = self.mock_client(b"$%d\r\n%s\r\n" % (len(lines), lines))
+        summary = ClientListSummary(top=2)
+
+        summary.sample(client, "db", "10.0.0.9:6379")
+
+        connection.send_command.assert_called_with("CLIENT", "LIST")
+        connection.disconnect.assert_not_called()
+        client.connection_pool.release.assert_called_with(connection)
+        rows = list(summary.rows())
+        assert [(row["Name"], row["Host"], row["Clients"]) for row in rows] == [
+            ("web", "10.0.0.1", 2),
+            ("job", "10.0.0.2", 1),
+            ("(other)", "", 1),
+        ]
+        assert rows[0]["MaxIdle (s)"] == 9
+        assert rows[0]["QueryBuffer (bytes)"] == 10
+        assert rows[0]["OutputBuffer (bytes)"] == 50
+        assert rows[0]["TotalMemory (bytes)"] == 300
+        assert rows[2]["MaxOutputBuffer (bytes)"] == 7
+
+    def test_sample_truncated_reply(self):
+        client, connection = self.mock_client(b"$100\r\nid=1 addr=10.0.0.1:5001\n")
+
+        with pytest.raises(redis.ConnectionError):
+            ClientListSummary().sample(client, "db", "10.0.0.9:6379")
+        connection.disconnect.assert_called_once()
+        client.connection_pool.release.assert_called_with(connection)
+
+
+class TestCapacityPlanner:
+    @staticmethod
+    def row(cluster, role, ops, writes=0, evals=0, memory=1.0, cpu=10.0):
+        row = dict.fromkeys(RESULT_COLUMNS, "")
+        row.update(
+            {
+                "ClusterId": cluster,
+                "NodeRole": role,
+                "Throughput (Ops)": ops,
+                "GetTypeCmds": ops - writes - evals,
+                "SetTypeCmds": writes,
+                "EvalBasedCmds": evals,
+                "MemoryUsed (Gb)": memory,
+                "CpuUsage (%)": cpu,
+                "Status": "ok",
+            }
+        )
+        return [row[column] for column in RESULT_COLUMNS]
+
+    def test_plan_keeps_peaks(self):
+        planner = CapacityPlanner(
+            CapacityModel(shard_ops=10000, shard_memory=10, headroom=0.5)
+        )
+        planner.add(
+            [
+                self.row("db", "Master", 6000, writes=2000, memory=4),
+                self.row("db", "Replica", 1000, memory=4),
+            ]
+        )
+        planner.add(
+            [
+                self.row("db", "Master", 4000, evals=1000, memory=7),
+                self.row("db", "Replica", 0, memory=7),
+            ]
+        )
+
+        plan = next(planner.rows())
+        # 7000 ops, 1000 of them writes weighted 1.5 (vs 4000 with evals x3)
+        assert plan["PeakOps"] == 7000
+        assert plan["WeightedOps"] == 8000
+        assert plan["ShardsByOps"] == 2
+        # Replicas don't add to the memory of a shard
+        assert plan["MemoryUsed (Gb)"] == 7
+        assert plan["ShardsByMemory"] == 2
+        assert plan["ShardsByCpu"] == 1
+        assert plan["RecommendedShards"] == 2
+        assert plan["LimitedBy"] == "Ops"
+        assert plan["Headroom (%)"] == 60
+        assert plan["CurrentShards"] == 1
+
+    def test_plan_counts_replicated_writes_once(self):
+        planner = CapacityPlanner(CapacityModel(write_cost=1.5))
+        # The replica replays the 3000 writes/sec of its master and serves
+        # 500 reads/sec of its own
+        planner.add(
+            [
+                self.row("db", "Master", 5000, writes=3000),
+                self.row("db", "Replica", 3500, writes=3000),
+            ]
+        )
+
+        plan = next(planner.rows())
+        assert plan["PeakOps"] == 5500
+        assert plan["Writes (%)"] == 54.5
+        assert plan["Reads (%)"] == 45.5
+        assert plan["WeightedOps"] == 7000
+
+    def test_plan_skips_failed_nodes(self):
+        planner = CapacityPlanner()
+        failed = self.row("db", "Master", 0, memory=50)
+        failed[RESULT_COLUMNS.index("Status")] = "error"
+        planner.add([failed, self.row("db", "Master", 100)])
+
+        plan = next(planner.rows())
+        assert plan["Nodes"] == 1
+        assert plan["Reads (%)"] == 100
+
+
+class TestNormalizeAddress:
+    def test_normalize_address(self):
+        assert normalize_address("localhost:6379") == "127.0.0.1:6379"
+        assert normalize_address("10.0.0.1:6380") == "10.0.0.1:6380"
+
+
+class TestIdentifyTargets:
+    @pytest.mark.asyncio
+    @patch("osstats.get_config_client")
+    async def test_identify_targets_merges_same_run_id(self, mock_get_client):
+        clients = {
+            "10.0.0.1:6379": {"run_id": "a"},
+            "10.0.0.2:6379": {"run_id": "a"},
+            "10.0.0.3:6379": redis.ConnectionError(),
+        }
+
+        def get_client(config, node, socket_timeout):
+            client = Mock()
+            client.execute_command.side_effect = [clients[node]]
+            return client
+
+        mock_get_client.side_effect = get_client
+        targets = {
+            node: {
+                "config": None,
+                "node": node,
+                "addresses": [(section, node)],
+                "references": [(section, True)],
+            }
+            for node, section in zip(clients, ["db1", "db2", "db3"])
+        }
+
+        identified = await identify_targets(targets, deadline=1)
+
+        assert list(identified) == ["a", "10.0.0.3:6379"]
+        assert identified["a"]["references"] == [("db1", True), ("db2", True)]
+        assert identified["10.0.0.3:6379"]["run_id"] == ""
+
+
+class TestProcessDatabases:
+    @patch("osstats.progress")
+    @patch("osstats.identify_targets")
+    @patch("osstats.process_node")
+    @patch("osstats.discover_nodes")
+    def test_process_databases_shares_nodes(
+        self, mock_discover, mock_process_node, mock_identify, mock_progress
+    ):
+        mock_discover.side_effect = [
+            ([("10.0.0.1:6379", True), ("10.0.0.2:6379", False)], {}),
+            ([("10.0.0.1:6379", True)], {}),
+        ]
+
+        async def identify(targets, deadline):
+            for target in targets.values():
+                target["run_id"] = target["node"]
+            return targets
+
+        async def sample(section, config, node, is_master_shard, *args):
+            context.keyspace.add(section, node, {}, {"db0": {"keys": 1}})
+            entries = [{"id": 0, "command": "GET k", "duration": 10}]
+            context.slowlog.fold(section, node, entries, -1, 0, COMMAND_CATEGORIES)
+            return {"ClusterId": section, "NodeId": node, "Status": "ok"}
+
+        mock_identify.side_effect = identify
+        mock_process_node.side_effect = sample
+        context = RunContext(keyspace=KeyspaceTable(), slowlog=SlowlogHarvester())
+        loop = asyncio.new_event_loop()
+
+        results = process_databases(
+            {"db1": Mock(), "db2": Mock()}, ResultTable(), 1, loop, context
+        )
+        loop.close()
+
+        assert mock_process_node.call_count == 2
+        rows = list(results)
+        assert [(row[1], row[2], row[3]) for row in rows] == [
+            ("db1", "10.0.0.1:6379", "Master"),
+            ("db1", "10.0.0.2:6379", "Replica"),
+            ("db2", "10.0.0.1:6379", "Master"),
+        ]
+        assert context.shared_nodes["10.0.0.1:6379"]["Sections"] == "db1, db2"
+
+        # The side tables of the shared node are listed under both sections
+        sheets = collect_sheets(context)
+        assert [(row["ClusterId"], row["NodeId"]) for row in sheets["Keyspace"]] == [
+            ("db1", "10-0-0-1"),
+            ("db2", "10-0-0-1"),
+            ("db1", "10-0-0-2"),
+        ]
+        counts = {
+            row["ClusterId"]: row["Count"]
+            for row in sheets["SlowLog"]
+            if row["Type"] == "Command"
+        }
+        assert counts == {"db1": 2, "db2": 1}
+
+    @patch("osstats.progress")
+    @patch("osstats.identify_targets")
+    @patch("osstats.process_node")
+    @patch("osstats.discover_sentinel")
+    def test_process_databases_sentinel(
+        self, mock_discover, mock_process_node, mock_identify, mock_progress
+    ):
+        mock_discover.return_value = [
+            ("ha/cache", [("10.0.0.1:6379", True), ("10.0.0.2:6379", False)], {}),
+            ("ha/queue", [("10.0.0.3:6379", True)], {}),
+        ]
+
+        async def identify(targets, deadline):
+            for target in targets.values():
+                target["run_id"] = target["node"]
+            return targets
+
+        statuses = iter(["ok", "ok", "ok", "ok", "error", "ok"])
+
+        async def sample(section, config, node, is_master_shard, *args):
+            return {"ClusterId": section, "NodeId": node, "Status": next(statuses)}
+
+        mock_identify.side_effect = identify
+        mock_process_node.side_effect = sample
+        context = RunContext()
+        configs = {"ha": {"host": "10.0.0.9", "port": "26379", "sentinel": "yes"}}
+        loop = asyncio.new_event_loop()
+
+        results = process_databases(configs, ResultTable(), 1, loop, context)
+        assert "ha" in context.discovery
+        process_databases(configs, results, 1, loop, context)
+        loop.close()
+
+        # The discovery is reused until a node fails
+        assert mock_discover.call_count == 1
+        assert "ha" not in context.discovery
+        rows = list(results)[:3]
+        assert [(row[1], row[2], row[3]) for row in rows] == [
+            ("ha/cache", "10.0.0.1:6379", "Master"),
+            ("ha/cache", "10.0.0.2:6379", "Replica"),
+            ("ha/queue", "10.0.0.3:6379", "Master"),
+        ]
+
+    @patch("osstats.progress")
+    @patch("osstats.identify_targets")
+    @patch("osstats.process_node")
+    @patch("osstats.discover_databases")
+    def test_process_databases_sentinel_failover(
+        self, mock_discover, mock_process_node, mock_identify, mock_progress
+    ):
+        mock_discover.return_value = [
+            ("ha/cache", [("10.0.0.1:6379", True), ("10.0.0.2:6379", False)], {}),
+        ]
+
+        async def identify(targets, deadline):
+            for target in targets.values():
+                target["run_id"] = target["node"]
+            return targets
+
+        # A planned failover swapped the roles, both nodes still answer
+        roles = {"10.0.0.1:6379": "Replica", "10.0.0.2:6379": "Master"}
+
+        async def sample(section, config, node, is_master_shard, *args):
+            return {"ClusterId": section, "NodeRole": roles[node], "Status": "ok"}
+
+        mock_identify.side_effect = identify
+        mock_process_node.side_effect = sample
+        context = RunContext()
+        context.discovery["ha"] = mock_discover.return_value
+        configs = {"ha": {"host": "10.0.0.9", "port": "26379", "sentinel": "yes"}}
+        loop = asyncio.new_event_loop()
+
+        results = process_databases(configs, ResultTable(), 1, loop, context)
+        loop.close()
+
+        assert "ha" not in context.discovery
+        assert [row[3] for row in results] == ["Replica", "Master"]
+
+
+class TestDiscoverSentinel:
+    @patch("osstats.get_config_client")
+    @patch("osstats.get_redis_client")
+    def test_discover_sentinel(self, mock_get_redis_client, mock_get_config_client):
+        def state(ip, flags):
+            return {
+                "ip": ip,
+                "port": 6379,
+                "is_sdown": "s_down" in flags,
+                "is_odown": False,
+                "is_disconnected": False,
+            }
+
+        sentinel = mock_get_redis_client.return_value
+        sentinel.sentinel_masters.return_value = {
+            "queue": state("10.0.0.3", "master"),
+            "cache": state("10.0.0.1", "master"),
+        }
+        sentinel.sentinel_slaves.side_effect = lambda name: {
+            "cache": [state("10.0.0.2", "slave"), state("10.0.0.4", "s_down,slave")],
+            "queue": [],
+        }[name]
+        mock_get_config_client.return_value.execute_command.side_effect = (
+            redis.ConnectionError()
+        )
+        config = configparser.ConfigParser()
+        config.read_dict(
+            {"ha": {"host": "10.0.0.9", "port": "26379", "sentinel": "yes"}}
+        )
+
+        discovered = discover_databases(config["ha"], "ha")
+
+        assert mock_get_redis_client.call_args.kwargs["port"] == 26379
+        assert discovered == [
+            (
+                "ha/cache",
+                [("10.0.0.1:6379", True), ("10.0.0.2:6379", False)],
+                COMMAND_CATEGORIES,
+            ),
+            ("ha/queue", [("10.0.0.3:6379", True)], COMMAND_CATEGORIES),
+        ]
+
+
+class TestWorkerPool:
+    @patch("osstats.progress")
+    def test_process_databases_merges_workers(self, mock_progress):
+        def worker(pid, sections, reply):
+            connection = Mock()
+            connection.recv.return_value = reply
+            return (Mock(pid=pid), connection, sections)
+
+        def row(section):
+            row = dict.fromkeys(RESULT_COLUMNS, "")
+            row.update({"ClusterId": section, "Status": "ok"})
+            return [row[column] for column in RESULT_COLUMNS]
+
+        pool = WorkerPool.__new__(WorkerPool)
+        pool.workers = [
+            worker(
+                1,
+                ["db1", "db3"],
+                ({"db3": [row("db3")]}, {"SlowLog": [{"a": 1}]}, None, None),
+            ),
+            worker(
+                2, ["db2"], ({"db2": [row("db2")]}, {"SlowLog": [{"a": 2}]}, None, None)
+            ),
+            worker(3, ["db4"], (None, {}, "RuntimeError: boom", None)),
+        ]
+        context = RunContext()
+        context.interval = 3
+        loop = asyncio.new_event_loop()
+
+        results = pool.process_databases(
+            {"db2": None, "db3": None, "db4": None}, ResultTable(), 1, loop, context
+        )
+        loop.close()
+
+        # Every worker is asked for its pending sections only, with one start time
+        requests = [worker[1].send.call_args.args[0] for worker in pool.workers]
+        assert [request[2] for request in requests] == [["db3"], ["db2"], ["db4"]]
+        assert len({request[:2] for request in requests}) == 1
+        rows = list(results)
+        assert [row[1] for row in rows] == ["db2", "db3"]
+        assert context.worker_sheets == {
+            0: {"SlowLog": [{"a": 1}]},
+            1: {"SlowLog": [{"a": 2}]},
+        }
+
+    @patch("osstats.build_context")
+    @patch("osstats.sample_databases")
+    def test_run_worker(self, mock_sample, mock_build_context, tmp_path):
+        config_file = tmp_path / "config.ini"
+        config_file.write_text("[db1]\nhost = 10.0.0.1\n[db2]\nhost = 10.0.0.2\n")
+        args = Mock(
+            configFile=str(config_file),
+            duration=1,
+            checkpointFile=None,
+            resume=False,
+            profileFile=None,
+        )
+        # Every run builds a context of its own, as a new worker process does
+        mock_build_context.side_effect = lambda args: RunContext()
+        mock_sample.return_value = {"db2": [["row"]]}
+        connection, child = multiprocessing.Pipe()
+        thread = threading.Thread(target=run_worker, args=(child, args, ["db1", "db2"]))
+        thread.start()
+
+        assert connection.recv() == "ready"
+        connection.send((2, time.time(), ["db2"]))
+        rows, sheets, error, trace = connection.recv()
+        connection.send(None)
+        thread.join(5)
+
+        assert rows == {"db2": [["row"]]}
+        assert error is None
+        configs, duration, loop, context = mock_sample.call_args.args
+        assert list(configs) == ["db2"]
+        assert configs["db2"]["host"] == "10.0.0.2"
+        assert context.interval == 2
+        assert context.progress is False
+
+    @patch("osstats.build_context")
+    @patch("osstats.sample_databases")
+    def test_run_worker_checkpoint(self, mock_sample, mock_build_context, tmp_path):
+        config_file = tmp_path / "config.ini"
+        config_file.write_text("[db1]\nhost = 10.0.0.1\n")
+        path = str(tmp_path / "run.checkpoint")
+        args = Mock(
+            configFile=str(config_file),
+            duration=1,
+            checkpointFile=path,
+            resume=False,
+            profileFile=None,
+        )
+        # Every run builds a context of its own, as a new worker process does
+        mock_build_context.side_effect = lambda args: RunContext()
+
+        def sample(configs, duration, loop, context):
+            context.checkpoint.save_snapshot(
+                context.interval, "db1", "n1:6379", {}, {"interval": context.interval}
+            )
+            return {"db1": [["row"]]}
+
+        mock_sample.side_effect = sample
+
+        def run(messages):
+            connection, child = multiprocessing.Pipe()
+            thread = threading.Thread(target=run_worker, args=(child, args, ["db1"], 1))
+            thread.start()
+            assert connection.recv() == "ready"
+            replies = []
+            for message in messages:
+                connection.send(message)
+                replies.append(connection.recv())
+            connection.send(None)
+            thread.join(5)
+            return replies
+
+        # The worker journals to a file of its own, and drops the snapshots
+        # of an interval once the next one is requested
+        run([(1, time.time(), ["db1"]), (2, time.time(), ["db1"])])
+        resumed = Checkpoint(path + ".1", resume=True)
+        resumed.close()
+        assert resumed.snapshot(1, "db1", "n1:6379") is None
+        assert resumed.snapshot(2, "db1", "n1:6379")[1] == {"interval": 2}
+
+        # A resumed worker reloads its checkpoint, and keeps it until it moves
+        # on to another interval
+        args.resume = True
+        mock_sample.side_effect = lambda configs, duration, loop, context: {
+            "db1": [[context.checkpoint.snapshot(2, "db1", "n1:6379")[1]]]
+        }
+        [(rows, sheets, error, trace)] = run([(2, time.time(), ["db1"])])
+        assert rows == {"db1": [[{"interval": 2}]]}
+        [(rows, sheets, error, trace)] = run([(2, time.time(), ["db1"])])
+        assert rows == {"db1": [[{"interval": 2}]]}
+        assert os.path.exists(path + ".1")
+        assert not os.path.exists(path)
+
+
+class TestCheckpoint:
+    def test_checkpoint_roundtrip(self, tmp_path):
+        path = str(tmp_path / "run.checkpoint")
+        checkpoint = Checkpoint(path)
+        checkpoint.save_snapshot(1, "db", "n1:6379", {"cmdstat_get": {"calls": 1}}, {})
+        checkpoint.save_result(1, "db", "n2:6379", {"Status": "ok"})
+        checkpoint.save_rows(1, "other", [["OSS", "other"]])
+        checkpoint.close()
+        with open(path, "a") as f:
+            f.write('{"type": "result", "inter')
+
+        resumed = Checkpoint(path, resume=True)
+        cmds, info, taken_at = resumed.snapshot(1, "db", "n1:6379")
+        assert cmds == {"cmdstat_get": {"calls": 1}}
+        assert taken_at <= time.time()
+        assert resumed.result(1, "db", "n2:6379") == {"Status": "ok"}
+        assert resumed.completed(1) == {"other": [["OSS", "other"]]}
+        assert resumed.snapshot(2, "db", "n1:6379") is None
+
+        # The output file holds the rows of a finished interval
+        resumed.compact(1, 3)
+        assert resumed.completed(1) == {}
+        resumed.close()
+        again = Checkpoint(path, resume=True)
+        again.close(remove=True)
+        assert again.snapshot(1, "db", "n1:6379") is None
+        assert again.completed(1) == {}
+        assert again.finished == [3]
+
+    def test_resume_after_two_crashes(self, tmp_path):
+        config_file = tmp_path / "config.ini"
+        config_file.write_text("[db1]\nhost = a\n[db2]\nhost = b\n[db3]\nhost = c\n")
+        output = str(tmp_path / "out.xlsx")
+        argv = ["osstats.py", "-c", str(config_file), "-o", output, "-i", "4"]
+        argv += ["--checkpoint", str(tmp_path / "run.checkpoint")]
+        saves = []
+
+        def sample(configs, results, duration, loop, context):
+            for section in configs:
+                row = ResultRow()
+                row["ClusterId"] = section
+                row["Throughput (Ops)"] = context.interval
+                row["Status"] = "ok"
+                store_rows(results, {section: [list(row)]}, context)
+                saves.append(section)
+                if len(saves) in crashes:
+                    raise KeyboardInterrupt
+            return results
+
+        # The first run stops once interval 2 is saved but not written, the
+        # second one halfway through interval 3
+        crashes = {6, 8}
+        with patch("osstats.process_databases", side_effect=sample), patch(
+            "osstats.asyncio.get_event_loop", side_effect=asyncio.new_event_loop
+        ):
+            for resume in ([], ["--resume"], ["--resume"]):
+                with patch("sys.argv", argv + resume):
+                    main()
+                if len(saves) == 8:
+                    # Interval 2 was resumed from the checkpoint alone, and
+                    # still recorded as finished
+                    checkpoint = Checkpoint(str(tmp_path / "run.checkpoint"), True)
+                    checkpoint.close()
+                    assert checkpoint.finished == [3, 6]
+
+        rows = list(iter_result_file(output))
+        intervals = [
+            value for _, _, column, value in rows if column == "Throughput (Ops)"
+        ]
+        assert sorted(intervals) == [1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4]
+
+    def test_resume_results(self, tmp_path):
+        path = str(tmp_path / "out.xlsx")
+        table = ResultTable()
+        for node in ("n1", "n2", "n1"):
+            row = ResultRow()
+            row["ClusterId"] = "db"
+            row["NodeId"] = node
+            row["Throughput (Ops)"] = 10
+            table.append(row)
+        save_results(path, table, {})
+        args = Mock(printOnly=False, outputFile=path)
+        context = RunContext(planner=Mock())
+
+        results = ResultTable()
+        resume_results(results, args, context, [2, 3])
+        assert [row["NodeId"] for row in map(ResultRow.of, results)] == [
+            "n1",
+            "n2",
+            "n1",
+        ]
+        assert [len(call.args[0]) for call in context.planner.add.call_args_list] == [
+            2,
+            1,
+        ]
+
+        # Rows that don't match the checkpoint are left out
+        results = ResultTable()
+        resume_results(results, args, context, [2, 4])
+        assert len(results) == 0
+
+    @pytest.mark.asyncio
+    @patch("osstats.get_redis_client")
+    @patch("osstats.sleep")
+    async def test_process_node_resumes_first_snapshot(
+        self, mock_sleep, mock_get_client, tmp_path
+    ):
+        info = {
+            "redis_version": "7.0.0",
+            "os": "Linux",
+            "total_system_memory": 8589934592,
+            "used_memory_peak": 1048576,
+            "connected_clients": 10,
+            "cluster_enabled": 0,
+            "total_commands_processed": 1000,
+        }
+        checkpoint = Checkpoint(str(tmp_path / "run.checkpoint"))
+        checkpoint.snapshots[(1, "db", "localhost:6379")] = (
+            {"cmdstat_get": {"calls": 100}},
+            info,
+            time.time() - 30,
+        )
+        mock_client = Mock()
+        mock_get_client.return_value = mock_client
+        mock_client.execute_command.side_effect = [
+            info,
+            "cmdstat_get:calls=130,usec=1000",
+            dict(info, total_commands_processed=1300),
+            "cmdstat_get:calls=160,usec=1000",
+            dict(info, total_commands_processed=1600),
+        ]
+
+        result = await process_node(
+            "db",
+            TestProcessNode.mock_config(),
+            "localhost:6379",
+            True,
+            1,
+            RunContext(checkpoint=checkpoint),
+        )
+        checkpoint.close(remove=True)
+
+        assert mock_client.execute_command.call_count == 5
+        assert 29 <= mock_sleep.call_args_list[0][0][0] <= 30
+        assert result["Throughput (Ops)"] == 10
+        assert result["GetTypeCmds"] == 1
+
+    @pytest.mark.asyncio
+    @patch("osstats.get_redis_client")
+    @patch("osstats.sleep")
+    async def test_process_node_resumes_after_the_window(
+        self, mock_sleep, mock_get_client, tmp_path
+    ):
+        info = {
+            "redis_version": "7.0.0",
+            "os": "Linux",
+            "total_system_memory": 8589934592,
+            "used_memory_peak": 1048576,
+            "connected_clients": 10,
+            "cluster_enabled": 0,
+            "run_id": "abc",
+            "total_commands_processed": 1000,
+        }
+        checkpoint = Checkpoint(str(tmp_path / "run.checkpoint"))
+        # Resumed an hour after a 1 minute window was opened
+        checkpoint.snapshots[(1, "db", "localhost:6379")] = (
+            {"cmdstat_get": {"calls": 100}},
+            info,
+            time.time() - 3600,
+        )
+        mock_client = Mock()
+        mock_get_client.return_value = mock_client
+        mock_client.execute_command.side_effect = [
+            info,
+            "cmdstat_get:calls=3700,usec=1000",
+            dict(info, total_commands_processed=37000),
+        ]
+
+        result = await process_node(
+            "db",
+            TestProcessNode.mock_config(),
+            "localhost:6379",
+            True,
+            1,
+            RunContext(checkpoint=checkpoint),
+        )
+        checkpoint.close(remove=True)
+
+        mock_sleep.assert_called_once_with(0)
+        assert result["Throughput (Ops)"] == 10
+        assert result["GetTypeCmds"] == 1
+
+    @pytest.mark.asyncio
+    @patch("osstats.get_redis_client")
+    @patch("osstats.sleep")
+    async def test_process_node_drops_snapshot_of_restarted_node(
+        self, mock_sleep, mock_get_client, tmp_path
+    ):
+        info = {
+            "redis_version": "7.0.0",
+            "os": "Linux",
+            "total_system_memory": 8589934592,
+            "used_memory_peak": 1048576,
+            "connected_clients": 10,
+            "cluster_enabled": 0,
+            "run_id": "abc",
+            "total_commands_processed": 5000,
+        }
+        checkpoint = Checkpoint(str(tmp_path / "run.checkpoint"))
+        checkpoint.snapshots[(1, "db", "localhost:6379")] = (
+            {"cmdstat_get": {"calls": 4000}},
+            info,
+            time.time() - 30,
+        )
+        mock_client = Mock()
+        mock_get_client.return_value = mock_client
+        mock_client.execute_command.side_effect = [
+            dict(info, run_id="def"),
+            "cmdstat_get:calls=10,usec=1000",
+            dict(info, run_id="def", total_commands_processed=100),
+            "cmdstat_get:calls=40,usec=1000",
+            dict(info, run_id="def", total_commands_processed=400),
+            "cmdstat_get:calls=70,usec=1000",
+            dict(info, run_id="def", total_commands_processed=700),
+        ]
+
+        result = await process_node(
+            "db",
+            TestProcessNode.mock_config(),
+            "localhost:6379",
+            True,
+            1,
+            RunContext(checkpoint=checkpoint),
+        )
+        checkpoint.close(remove=True)
+
+        # The window starts over from a new first snapshot
+        assert mock_sleep.call_args_list[0][0][0] == 60
+        assert result["Throughput (Ops)"] == 10
+        assert result["GetTypeCmds"] == 1
+
+
+class TestHistoryStore:
+    @staticmethod
+    def row(cluster, node, role, throughput):
+        row = dict.fromkeys(RESULT_COLUMNS, "")
+        row.update(
+            {
+                "Source": "OSS",
+                "ClusterId": cluster,
+                "NodeId": node,
+                "NodeRole": role,
+                "Throughput (Ops)": throughput,
+                "Status": "ok",
+            }
+        )
+        return list(row.values())
+
+    def test_append_and_query(self, tmp_path):
+        store = HistoryStore(str(tmp_path / "history.db"))
+        for sample in range(1, 21):
+            store.append(
+                [
+                    self.row("db1", "n1", "Master", sample * 10),
+                    self.row("db1", "n2", "Replica", sample),
+                    self.row("db2", "n3", "Master", 5),
+                ],
+                ts=1000 + sample,
+            )
+
+        results = store.query("Throughput (Ops)", 95)
+        assert results == [
+            {
+                "ClusterId": "db1",
+                "Category": "Throughput (Ops)",
+                "Samples": 20,
+                "P95": 209,
+                "Max": 220,
+            },
+            {
+                "ClusterId": "db2",
+                "Category": "Throughput (Ops)",
+                "Samples": 20,
+                "P95": 5,
+                "Max": 5,
+            },
+        ]
+
+        results = store.query(
+            "Throughput (Ops)", 50, since=1011, cluster="db1", role="Master"
+        )
+        assert results[0]["Samples"] == 10
+        assert results[0]["P50"] == 150
+
+        assert store.query("Throughput (Ops)", 50, agg="avg")[0]["Max"] == 110
+        assert store.query("Throughput (Ops)", 50, agg="max")[0]["Max"] == 200
+        assert store.query("Missing", 50) == []
+        store.close()
+
+    def test_iter_run(self, tmp_path):
+        store = HistoryStore(str(tmp_path / "history.db"))
+        address = RESULT_COLUMNS.index("NodeAddress")
+        rows = []
+        items = RESULT_COLUMNS.index("CurrItems")
+        for port, ops in ((7000, 100), (7001, 300)):
+            row = self.row("db1", "127-0-0-1", "Master", ops)
+            row[address] = "127.0.0.1:{}".format(port)
+            row[items] = 5
+            rows.append(row)
+        store.append(rows, ts=1000)
+
+        assert sorted(store.iter_run(store.run)) == [
+            ("db1", "127-0-0-1:7000", "CurrItems", 5),
+            ("db1", "127-0-0-1:7000", "Throughput (Ops)", 100),
+            ("db1", "127-0-0-1:7001", "CurrItems", 5),
+            ("db1", "127-0-0-1:7001", "Throughput (Ops)", 300),
+        ]
+        plan = store.db.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM samples WHERE run = ?", (1,)
+        ).fetchall()
+        assert "samples_run" in str(plan)
+        store.close()
+
+
+class TestCompare:
+    def test_iter_result_file(self, tmp_path):
+        wb = openpyxl.Workbook()
+        wb.active.title = "ClusterData"
+        wb.active.append(RESULT_COLUMNS)
+        wb.active.append(TestHistoryStore.row("db1", "n1", "Master", 120))
+        path = str(tmp_path / "results.xlsx")
+        wb.save(path)
+
+        samples = list(iter_result_file(path))
+        assert samples == [("db1", "n1", "Throughput (Ops)", 120)]
+
+    def test_iter_result_file_keeps_nodes_of_a_host_apart(self, tmp_path):
+        wb = openpyxl.Workbook()
+        wb.active.title = "ClusterData"
+        wb.active.append(RESULT_COLUMNS)
+        address = RESULT_COLUMNS.index("NodeAddress")
+        for port, ops in ((7000, 100), (7001, 300)):
+            row = TestHistoryStore.row("db1", "127-0-0-1", "Master", ops)
+            row[address] = "127.0.0.1:{}".format(port)
+            wb.active.append(row)
+        path = str(tmp_path / "results.xlsx")
+        wb.save(path)
+
+        stats = aggregate_samples(iter_result_file(path))
+        assert stats[("db1", "127-0-0-1:7000")]["Throughput (Ops)"][:2] == [1, 100]
+        assert stats[("db1", "127-0-0-1:7001")]["Throughput (Ops)"][:2] == [1, 300]
+
+    def test_aggregate_samples(self):
+        stats = aggregate_samples(
+            ("db", "n1", "Throughput (Ops)", value)
+            for value in [2, 4, 4, 4, 5, 5, 7, 9]
+        )
+        count, mean, m2 = stats[("db", "n1")]["Throughput (Ops)"]
+        assert (count, mean, m2) == (8, 5.0, 32.0)
+
+    def test_welch_test(self):
+        # [1, 2, 3, 4, 5] against [3, 4, 5, 6, 7]: t=-2, df=8
+        assert welch_test([5, 3.0, 10.0], [5, 5.0, 10.0]) == pytest.approx(
+            0.0805, abs=1e-4
+        )
+        assert welch_test([1, 3.0, 0.0], [5, 5.0, 10.0]) is None
+
+    def test_compare_results(self):
+        before = {
+            ("db", "n1"): {"Throughput (Ops)": [1, 100.0, 0.0]},
+            ("db", "n2"): {"MemoryUsed (Gb)": [1, 1.0, 0.0]},
+        }
+        after = {
+            ("db", "n1"): {"Throughput (Ops)": [1, 150.0, 0.0]},
+            ("db", "n3"): {"MemoryUsed (Gb)": [1, 2.0, 0.0]},
+        }
+
+        rows = list(compare_results(before, after))
+
+        assert [(row["NodeId"], row["Status"]) for row in rows] == [
+            ("n1", "matched"),
+            ("n2", "removed"),
+            ("n3", "added"),
+        ]
+        assert rows[0]["Change"] == 50
+        assert rows[0]["Change (%)"] == 50
+        assert rows[0]["PValue"] == ""
+        assert rows[2]["Change (%)"] == ""
+
+
+class TestWriteSheet:
+    def test_write_sheet(self):
+        wb = openpyxl.Workbook()
+        wb.active.title = "ClusterData"
+        write_sheet(wb, "Extra", [{"a": 1, "b": 2}, {"a": 3, "b": 4}])
+        write_sheet(wb, "Extra", [{"a": 5, "b": 6}])
+        ws = wb["Extra"]
+        assert [[cell.value for cell in row] for row in ws.iter_rows()] == [
+            ["a", "b"],
+            [5, 6],
+        ]
+        assert wb.active.title == "ClusterData"
+
+
+class TestResultTable:
+    def test_result_row(self):
+        row = ResultRow()
+        row["Status"] = "ok"
+        assert row[RESULT_COLUMNS.index("Status")] == "ok"
+        assert row.get("Status") == "ok"
+        assert row.get("Unknown", 1) == 1
+        assert list(row.keys()) == RESULT_COLUMNS
+        assert ResultRow.of({"Status": "error"})["Status"] == "error"
+        assert ResultRow.of(list(row)) == row
+
+    def test_roundtrip(self):
+        table = ResultTable()
+        first = ResultRow()
+        first["ClusterId"] = "db"
+        first["Throughput (Ops)"] = 5
+        first["MemoryUsed (Gb)"] = 1.5
+        second = ResultRow()
+        second["ClusterId"] = "db"
+        second["Throughput (Ops)"] = 2**40
+        second["CurrItems"] = True
+        second["Status"] = None
+        table.extend([first, second, ResultRow()])
+
+        assert len(table) == 3
+        assert list(table) == [list(first), list(second), [""] * len(RESULT_COLUMNS)]
+        assert list(table.rows(2)) == [[""] * len(RESULT_COLUMNS)]
+        # The column widened to fit the second value, text is stored once
+        assert table.columns[RESULT_COLUMNS.index("Throughput (Ops)")].typecode == "q"
+        assert table.strings == ["", "db"]
+        assert table.nbytes() < 1000
+
+
+class TestTracer:
+    def test_disabled_span_is_shared(self):
+        tracer = Tracer()
+        assert tracer.span("info", "node1") is tracer.span("cluster nodes")
+        with tracer.span("info"):
+            pass
+        assert tracer.spans == []
+
+    def test_trace_file(self, tmp_path):
+        tracer = Tracer()
+        tracer.enable()
+        with tracer.span("connect", args={"section": "db1"}):
+            pass
+        with tracer.span("info", "10.0.0.1:6379"):
+            pass
+        tracer.lags.append((time.perf_counter(), 0.002))
+
+        path = str(tmp_path / "trace.json")
+        tracer.save(path)
+        with open(path) as f:
+            events = json.load(f)["traceEvents"]
+
+        spans = [event for event in events if event["ph"] == "X"]
+        assert [(event["name"], event["tid"]) for event in spans] == [
+            ("connect", 0),
+            ("info", 1),
+        ]
+        assert spans[0]["args"] == {"section": "db1"}
+        assert [event["args"]["name"] for event in events if event["ph"] == "M"] == [
+            "main",
+            "10.0.0.1:6379",
+        ]
+        assert [event["args"]["ms"] for event in events if event["ph"] == "C"] == [2]
+
+        summary = tracer.summary()
+        assert summary[0].split() == ["Phase", "Count", "Total", "Max"]
+        assert any(line.startswith("Event loop lag") for line in summary)
+
+    def test_merge_worker_trace(self):
+        worker = Tracer()
+        worker.enable()
+        with worker.span("info", "10.0.0.1:6379"):
+            pass
+        worker.lags.append((time.perf_counter(), 0.002))
+        trace = worker.drain()
+        assert worker.spans == [] and worker.lags == []
+
+        tracer = Tracer()
+        tracer.enable()
+        tracer.merge(trace, "worker 0")
+        [(name, lane, start, _, _)] = tracer.spans
+        assert (name, lane) == ("info", "worker 0 10.0.0.1:6379")
+        # Both processes share the wall clock, the times stay in place
+        assert abs(start - time.perf_counter()) < 1
+        assert len(tracer.lags) == 1
 
 
 if __name__ == "__main__":